@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 from flask.ext.script import Manager, Shell, Server
-from spacewiki import model
+from spacewiki import model, audit, backup, benchmark, move, profiling, \
+        typeahead, uploads
 import logging
 import sys
 import os
+import time
 import os.path
 import colorlog
 from flask_assets import ManageAssets
@@ -17,40 +19,82 @@ MANAGER = Manager(APP)
 MANAGER.add_command('db', model.MANAGER)
 MANAGER.add_command("shell", Shell())
 MANAGER.add_command('assets', ManageAssets())
+MANAGER.add_command('bench', benchmark.MANAGER)
+MANAGER.add_command('profile', profiling.MANAGER)
+MANAGER.add_command('uploads', uploads.MANAGER)
 
 @MANAGER.option('-s', '--syncdb', dest='syncdb', help='Run syncdb on boot',
         default=False, action='store_true')
-def runserver(syncdb):
+@MANAGER.option('-w', '--workers', dest='workers', type=int, default=0,
+        help='Pre-fork this many worker processes sharing the socket')
+@MANAGER.option('--max-requests', dest='max_requests', type=int, default=0,
+        help='Recycle a worker after it serves this many requests')
+@MANAGER.option('--max-rss', dest='max_rss', type=int, default=0,
+        help='Recycle a worker once it uses this many megabytes')
+@MANAGER.option('--warm-pages', dest='warm_pages', type=int, default=50,
+        help='Render this many recently edited pages before taking traffic')
+def runserver(syncdb, workers, max_requests, max_rss, warm_pages):
+    port = int(os.environ.get('PORT', 5000))
     if (syncdb):
         model.syncdb()
+    if workers:
+        from spacewiki.server import Arbiter
+        Arbiter(APP, ('', port), workers, max_requests, max_rss * 1024 * 1024,
+                warm_pages=warm_pages).run()
+        return
+    model.get_db()
+    typeahead.title_index()
     from gevent.wsgi import WSGIServer
-    serv = WSGIServer(('', int(os.environ.get('PORT', 5000))), APP, log=logging.getLogger("http"))
+    serv = WSGIServer(('', port), APP, log=logging.getLogger("http"))
     serv.serve_forever()
 
+@MANAGER.option('output', help='Directory to write the static site to')
+@MANAGER.option('-j', '--processes', dest='processes', type=int, default=None,
+        help='Number of render processes, defaults to one per CPU')
+@MANAGER.option('-i', '--incremental', dest='incremental', default=False,
+        action='store_true', help='Only render pages that changed since the last export')
+@MANAGER.option('-b', '--base-url', dest='base_url', default='http://localhost/',
+        help='URL the exported site will be served from')
+def export(output, processes, incremental, base_url):
+    """Renders every page to a static HTML tree"""
+    from spacewiki.export import export_site
+    count = export_site(APP, output, processes, incremental, base_url)
+    logging.info("Rendered %d pages", count)
+
 @MANAGER.command
 def import_docs():
     from spacewiki import model
-    from spacewiki.auth.tripcodes import new_anon_user
+    from spacewiki.importer import BulkImporter, read_directory
     model.get_db()
-    anon_user = new_anon_user()
     doc_path = os.path.sep.join((os.path.dirname(__file__), 'doc'))
-    for root, dirs, files in os.walk(doc_path):
-        for fname in files:
-            if fname.endswith(".md"):
-                title = '.'.join(fname.split(".")[0:-1])
-                slug = 'docs/' + title
-            else:
-                continue
-            logging.info("Importing %s", fname)
-            if title == 'README':
-                title = 'SpaceWiki Documentation'
-                slug = 'docs'
-            try:
-                p = model.Page.get(slug=slug)
-            except model.Page.DoesNotExist:
-                p = model.Page.create(title=title, slug=slug)
-            p.newRevision(open(os.path.sep.join((root, fname)), 'r').read(),
-                    'Imported from %s' % fname, anon_user)
+
+    def docs():
+        for record in read_directory(doc_path, 'docs'):
+            logging.info("Importing %s", record['slug'])
+            if record['title'] == 'README':
+                record['title'] = 'SpaceWiki Documentation'
+                record['slug'] = 'docs'
+            yield record
+
+    BulkImporter().import_all(docs())
+
+@MANAGER.option('source', help='Directory of markdown files, JSONL dump or tarball')
+@MANAGER.option('-p', '--prefix', dest='prefix', default='',
+        help='Slug to import markdown files under')
+@MANAGER.option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+        help='Revisions to insert per transaction')
+@MANAGER.option('-a', '--author', dest='author', default='Anonymous',
+        help='Tripcode to credit revisions that have no author')
+def bulk_import(source, prefix, batch_size, author):
+    """Imports pages and their history in large batches"""
+    from spacewiki import model
+    from spacewiki.importer import BulkImporter, read_source
+    model.get_db()
+    importer = BulkImporter(batch_size, author)
+    importer.import_all(read_source(source, prefix))
+    logging.info("Imported %d revisions of %d pages in %.1fs",
+            importer.revision_count, len(importer.imported_slugs),
+            time.time() - importer.started)
 
 if __name__ == "__main__":
     handler = colorlog.StreamHandler()
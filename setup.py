@@ -14,7 +14,8 @@ setup(name='spacewiki',
           'bleach',
           'GitPython',
           'mistune',
-          'pillow',
+          # uploads.thumbnail_size copies how this version rounds
+          'pillow==6.2.2',
           'slugify',
           'flask-script',
           'colorlog',
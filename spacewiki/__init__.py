@@ -1 +1,8 @@
 import wikiformat
+import cache
+import prerender
+import typeahead
+import redirects
+import storage
+import offload
+import events
@@ -0,0 +1,271 @@
+"""Keeps expensive routes from crowding out everything else
+
+Diffs, previews, thumbnails and searches can each cost orders of magnitude
+more than a page view. ADMISSION_LIMITS gives each such route, by endpoint,
+a Gate with any of:
+
+* ``concurrency`` requests running at once, with up to ``queue`` more
+  waiting up to ``timeout`` seconds for their turn. Anything past that is
+  turned away at once with a 503 and a Retry-After of ``retry_after``
+  seconds, by default the timeout.
+* ``rate`` requests a second from each client, in bursts of up to
+  ``burst``, kept with a token bucket. A client over its rate gets a 429
+  with a Retry-After of when its next token is due.
+
+Clients are told apart by their address, or by ADMISSION_CLIENT_HEADER when
+the wiki is behind a proxy that sets it. Work that is only sometimes
+expensive can be gated by name with admitted() instead, like scaling an
+image to a size that hasn't been thumbnailed yet, as
+``uploads.thumbnail``.
+
+Limits and counts are kept per process, so a pre-forked server lets each
+worker run its own share. Queue depths and rejections are served at
+/.metrics, in the Prometheus text format."""
+
+import collections
+import contextlib
+from flask import Blueprint, Response, abort, current_app, g, request
+import math
+import threading
+import time
+
+from spacewiki import offload
+
+BLUEPRINT = Blueprint('admission', __name__)
+
+# Token buckets kept per route, least recently used dropped first
+MAX_CLIENTS = 10000
+
+_LOCK = threading.Lock()
+
+
+def _event():
+    """Returns an event to wait on that lets the gevent hub keep serving,
+    if there is one"""
+    if offload._cooperative():  # pylint: disable=protected-access
+        import gevent.event
+        return gevent.event.Event()
+    return threading.Event()
+
+
+class Limiter(object):
+    """Lets concurrency requests run at once, and up to queue more wait
+    timeout seconds for one to finish, first come first served"""
+
+    def __init__(self, concurrency, queue=0, timeout=0):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        """The number of requests waiting their turn"""
+        return len(self._waiters)
+
+    def acquire(self):
+        """Returns 'ok' once the caller may go ahead, or why it may not:
+        'queue' if the queue is full, or 'timeout' if its turn didn't come
+        in time"""
+        with self._lock:
+            if self.active < self.concurrency and not self._waiters:
+                self.active += 1
+                return 'ok'
+            if len(self._waiters) >= self.queue:
+                return 'queue'
+            waiter = _event()
+            self._waiters.append(waiter)
+        waiter.wait(self.timeout)
+        with self._lock:
+            # Set by release() handing over its slot
+            if waiter.is_set():
+                return 'ok'
+            self._waiters.remove(waiter)
+            return 'timeout'
+
+    def release(self):
+        """Hands the caller's slot to the next in the queue, if any"""
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self.active -= 1
+
+
+class TokenBuckets(object):
+    """A token bucket for each client, refilled at rate tokens a second up
+    to burst tokens"""
+
+    def __init__(self, rate, burst, clients=MAX_CLIENTS):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clients = clients
+        # client -> (tokens, when they were counted)
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client, now=None):
+        """Takes a token from client's bucket, returning 0 if there was one,
+        or else the number of seconds until there will be"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            tokens, then = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - then) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[client] = (tokens, now)
+            # A forgotten client starts again with a full bucket
+            while len(self._buckets) > self.clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class Gate(object):
+    """The limits on one route, and counts of what they let through"""
+
+    def __init__(self, concurrency=None, queue=0, timeout=0, rate=None,
+                 burst=None, retry_after=None):
+        self.limiter = None
+        if concurrency is not None:
+            self.limiter = Limiter(concurrency, queue, timeout)
+        self.buckets = None
+        if rate is not None:
+            self.buckets = TokenBuckets(rate, burst or max(1, int(rate)))
+        if retry_after is None:
+            retry_after = timeout
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.admitted = 0
+        self.rejected = {'queue': 0, 'timeout': 0, 'rate': 0}
+        self._lock = threading.Lock()
+
+    def _rejected(self, reason):
+        with self._lock:
+            self.rejected[reason] += 1
+
+    def enter(self, client):
+        """Returns None if the request from client may go ahead, in which
+        case leave() must be called once it is done. Otherwise returns the
+        response to turn it away with."""
+        if self.buckets is not None:
+            wait = self.buckets.take(client)
+            if wait:
+                self._rejected('rate')
+                return self.refuse(429, "Too many requests, slow down",
+                                   int(math.ceil(wait)))
+        if self.limiter is not None:
+            outcome = self.limiter.acquire()
+            if outcome != 'ok':
+                self._rejected(outcome)
+                return self.refuse(503, "Too busy, try again shortly",
+                                   self.retry_after)
+        with self._lock:
+            self.admitted += 1
+        return None
+
+    def leave(self):
+        """Frees the slot taken by a request enter() let through"""
+        if self.limiter is not None:
+            self.limiter.release()
+
+    @staticmethod
+    def refuse(status, message, retry_after):
+        """Returns a response turning a request away"""
+        return Response(message + "\n", status=status, mimetype='text/plain',
+                        headers={'Retry-After': str(retry_after)})
+
+
+def gates():
+    """Returns the Gate of every limited route in the current app, by
+    route"""
+    routes = current_app.extensions.get('spacewiki_admission')
+    if routes is None:
+        with _LOCK:
+            routes = current_app.extensions.get('spacewiki_admission')
+            if routes is None:
+                limits = current_app.config.get('ADMISSION_LIMITS') or {}
+                routes = dict((endpoint, Gate(**limit))
+                              for endpoint, limit in limits.items())
+                current_app.extensions['spacewiki_admission'] = routes
+    return routes
+
+
+def client():
+    """Returns what tells the client making the current request apart"""
+    header = current_app.config.get('ADMISSION_CLIENT_HEADER')
+    if header and header in request.headers:
+        return request.headers[header].split(',')[0].strip()
+    return request.remote_addr
+
+
+@BLUEPRINT.before_app_request
+def admit():
+    """Holds or turns away requests to limited routes"""
+    gate = gates().get(request.endpoint)
+    if gate is None:
+        return None
+    refusal = gate.enter(client())
+    if refusal is not None:
+        return refusal
+    g.admission_gate = gate
+    return None
+
+
+@contextlib.contextmanager
+def admitted(name):
+    """Runs the block within the limits of the gate called name, if there
+    is one, turning the request away if they don't let it in"""
+    gate = gates().get(name)
+    if gate is None:
+        yield
+        return
+    refusal = gate.enter(client())
+    if refusal is not None:
+        abort(refusal)
+    try:
+        yield
+    finally:
+        gate.leave()
+
+
+@BLUEPRINT.teardown_app_request
+def leave(exc):  # pylint: disable=unused-argument
+    """Lets the next request to a limited route in"""
+    gate = g.pop('admission_gate', None)
+    if gate is not None:
+        gate.leave()
+
+
+@BLUEPRINT.route('/.metrics')
+def metrics():
+    """Serves the queue depth and counts of every limited route"""
+    lines = []
+    for name, kind, help_text in (
+            ('active', 'gauge', 'Requests running'),
+            ('queued', 'gauge', 'Requests waiting their turn'),
+            ('admitted_total', 'counter', 'Requests let through'),
+            ('rejected_total', 'counter', 'Requests turned away')):
+        lines.append('# HELP spacewiki_admission_%s %s' % (name, help_text))
+        lines.append('# TYPE spacewiki_admission_%s %s' % (name, kind))
+        for route_name, gate in sorted(gates().items()):
+            if name == 'rejected_total':
+                for reason, count in sorted(gate.rejected.items()):
+                    lines.append(
+                        'spacewiki_admission_%s{route="%s",reason="%s"} %d' %
+                        (name, route_name, reason, count))
+                continue
+            if name == 'admitted_total':
+                value = gate.admitted
+            elif gate.limiter is None:
+                continue
+            else:
+                value = getattr(gate.limiter, name)
+            lines.append('spacewiki_admission_%s{route="%s"} %d' %
+                         (name, route_name, value))
+    return Response('\n'.join(lines) + '\n',
+                    mimetype='text/plain; version=0.0.4')
@@ -4,7 +4,7 @@ from flask import Flask
 from flask_assets import Environment, Bundle
 
 from spacewiki import context, history, model, pages, specials, \
-        uploads, editor, assets, auth, middleware
+        uploads, editor, assets, auth, middleware, events, admission
 
 def create_app(with_config=True):
     APP = Flask(__name__,
@@ -19,8 +19,11 @@ def create_app(with_config=True):
     if 'LOG_CONFIG' in APP.config:
         logging.config.dictConfig(APP.config['LOG_CONFIG'])
 
+    # First, so requests it turns away do no other work
+    APP.register_blueprint(admission.BLUEPRINT)
     APP.register_blueprint(context.BLUEPRINT)
     APP.register_blueprint(model.BLUEPRINT)
+    APP.register_blueprint(events.BLUEPRINT)
     APP.register_blueprint(uploads.BLUEPRINT)
     APP.register_blueprint(pages.BLUEPRINT)
     APP.register_blueprint(history.BLUEPRINT)
@@ -30,6 +33,11 @@ def create_app(with_config=True):
     assets.ASSETS.init_app(APP)
     auth.LOGIN_MANAGER.init_app(APP)
 
+    if APP.config.get('PROFILE_SPOOL_DIR'):
+        APP.wsgi_app = middleware.SamplingProfiler(
+            APP.wsgi_app, APP.url_map, APP.config['PROFILE_SPOOL_DIR'],
+            APP.config.get('PROFILE_SAMPLE_RATE', 0.0),
+            APP.config.get('PROFILE_SECRET'))
     APP.wsgi_app = middleware.ReverseProxied(APP.wsgi_app)
 
     return APP
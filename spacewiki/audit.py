@@ -0,0 +1,95 @@
+"""Checks the query plans of the queries the wiki runs most often"""
+
+import re
+
+import peewee
+
+from spacewiki import model
+
+SQLITE_SCAN = re.compile(r'^SCAN ')
+
+
+def hot_queries():
+    """Returns (name, query) for the queries behind every page view, edit
+    and listing. The values compared against are placeholders; only the
+    plans matter."""
+    Page, Revision = model.Page, model.Revision
+    return [
+        ('latest revision', Revision.select().join(Page)
+         .where(Page.slug == 'index').order_by(Revision.id.desc()).limit(1)),
+        ('previous revision', Revision.select()
+         .where(Revision.page == 1, Revision.id < 2)
+         .order_by(Revision.id.desc()).limit(1)),
+        ('page history', Revision.select().where(Revision.page == 1)
+         .order_by(Revision.id.desc())),
+        ('recent changes', Revision.select()
+         .order_by(Revision.timestamp.desc()).limit(50)),
+        ('page by slug', Page.select().where(Page.slug == 'index')),
+        ('all pages', Page.select().order_by(Page.title)),
+        ('softlink', model.Softlink.select().where(
+            model.Softlink.src == 1, model.Softlink.dest == 2)),
+        ('softlinks out', model.Softlink.select()
+         .where(model.Softlink.src == 1)),
+        ('softlinks in', model.Softlink.select()
+         .where(model.Softlink.dest == 1)),
+        ('backlinks', Page.select().join(model.PageLink, on=model.PageLink.src)
+         .where(model.PageLink.dest_slug == 'index',
+                model.PageLink.kind == model.PageLink.LINK)
+         .order_by(Page.title)),
+        ('orphaned pages', Page.orphaned()),
+        ('wanted pages', Page.wanted()),
+        ('identity', model.Identity.select().where(
+            model.Identity.auth_type == 'tripcode',
+            model.Identity.auth_id == 'Anonymous')),
+        ('attachment', model.Attachment.select().where(
+            model.Attachment.slug == 'file.png')),
+        ('attachment revisions', model.AttachmentRevision.select()
+         .where(model.AttachmentRevision.attachment == 1)),
+    ]
+
+
+def explain(query):
+    """Returns the plan for a query as a list of lines, and the lines that
+    read a whole table"""
+    sql, params = query.sql()
+    database = model.DATABASE.obj
+    if isinstance(database, peewee.SqliteDatabase):
+        cursor = database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params,
+                                      require_commit=False)
+        lines = [row[-1] for row in cursor.fetchall()]
+        return lines, [line for line in lines
+                       if SQLITE_SCAN.match(line) and 'INDEX' not in line]
+    cursor = database.execute_sql('EXPLAIN ' + sql, params,
+                                  require_commit=False)
+    if isinstance(database, peewee.MySQLDatabase):
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        lines = [' '.join('%s=%s' % (column, row[column])
+                          for column in columns) for row in rows]
+        return lines, [line for line, row in zip(lines, rows)
+                       if row['type'] == 'ALL']
+    lines = [row[0] for row in cursor.fetchall()]
+    return lines, [line.strip() for line in lines if 'Seq Scan on ' in line]
+
+
+def audit_queries():
+    """Explains every hot query, returning (name, plan, full scans)"""
+    return [(name,) + explain(query) for name, query in hot_queries()]
+
+
+@model.MANAGER.command
+def audit():
+    """Explains the hot queries and flags full table scans"""
+    model.get_db()
+    flagged = 0
+    for name, lines, scans in audit_queries():
+        if scans:
+            flagged += 1
+            print "SCAN  %s: %s" % (name, '; '.join(scans))
+        else:
+            print "OK    %s" % (name,)
+        for line in lines:
+            print "        " + line
+    if flagged:
+        print "%d queries scan whole tables" % (flagged,)
+        return 1
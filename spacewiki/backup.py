@@ -0,0 +1,275 @@
+"""Streaming dumps and restores of the whole wiki, history included.
+
+A dump is a tar stream holding:
+
+* ``spacewiki-dump.json``, describing the dump
+* ``records/<table>/<first id>-<last id>.jsonl``, chunks of rows in id order
+* ``blobs/<sha256>``, the contents of every uploaded file, once per sha
+
+Rows are read a chunk at a time with keyset pagination and blobs are
+streamed from the blob store, so dumping and restoring both run in constant
+memory. A fresh dump reads every table in one read transaction, so edits
+made while it runs can't leave it with revisions of pages it never saw. A
+resumed dump can't pick up the snapshot it was interrupted in, so only
+resume one while nothing is being edited."""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sys
+import tarfile
+import time
+from StringIO import StringIO
+
+import peewee
+
+from spacewiki import cache, events, model, redirects, storage
+from spacewiki.importer import chunked, parse_timestamp
+
+FORMAT_VERSION = 1
+HEADER = 'spacewiki-dump.json'
+
+TABLES = (model.Identity, model.Page, model.Revision, model.Softlink,
+          model.PageLink, model.Attachment, model.AttachmentRevision)
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def _add_member(tarball, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tarball.addfile(info, StringIO(data))
+
+
+def _member_end(member):
+    return member.offset_data + ((member.size + tarfile.BLOCKSIZE - 1) //
+                                 tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def scan_dump(path):
+    """Finds where an interrupted, uncompressed dump can be resumed. Returns
+    the offset just past the last complete member, the highest id already
+    dumped for each table, and the set of blob shas already dumped."""
+    last_ids = {}
+    blobs = set()
+    end = 0
+    size = os.path.getsize(path)
+    try:
+        with tarfile.open(path, 'r:') as tarball:
+            for member in tarball:
+                if _member_end(member) > size:
+                    break
+                parts = member.name.split('/')
+                if parts[0] == 'records':
+                    last_id = int(parts[2].split('.')[0].split('-')[1])
+                    last_ids[parts[1]] = max(last_ids.get(parts[1], 0),
+                                             last_id)
+                elif parts[0] == 'blobs':
+                    blobs.add(parts[1])
+                end = _member_end(member)
+    except (tarfile.ReadError, EOFError):
+        pass
+    return end, last_ids, blobs
+
+
+@contextlib.contextmanager
+def snapshot():
+    """Reads the database as of a single moment for the duration of the
+    block"""
+    database = model.DATABASE.obj
+    if isinstance(database, peewee.PostgresqlDatabase):
+        with database.transaction():
+            database.execute_sql('SET TRANSACTION ISOLATION LEVEL '
+                                 'REPEATABLE READ READ ONLY',
+                                 require_commit=False)
+            yield
+    elif isinstance(database, peewee.SqliteDatabase):
+        # DEFERRED rather than the IMMEDIATE a writer would take, so that in
+        # WAL mode writers can go on
+        with database.transaction('DEFERRED'):
+            yield
+    else:
+        with database.transaction():
+            yield
+
+
+def write_dump(fileobj, compress=True, chunk_size=1000, last_ids=None,
+               blobs=None):
+    """Writes every row and upload to fileobj as a tar stream. last_ids and
+    blobs, as returned by scan_dump, skip what an earlier dump wrote."""
+    last_ids = last_ids or {}
+    blobs = set(blobs or ())
+    resuming = bool(last_ids or blobs)
+    mode = 'w|gz' if compress else 'w|'
+    tarball = tarfile.open(fileobj=fileobj, mode=mode)
+    try:
+        if resuming:
+            _write_contents(tarball, chunk_size, last_ids, blobs)
+        else:
+            _add_member(tarball, HEADER, json.dumps({
+                'format': FORMAT_VERSION,
+                'created': datetime.datetime.now().isoformat(),
+                'tables': [table._meta.db_table for table in TABLES],
+            }))
+            with snapshot():
+                _write_contents(tarball, chunk_size, last_ids, blobs)
+    finally:
+        tarball.close()
+
+
+def _write_contents(tarball, chunk_size, last_ids, blobs):
+    for table in TABLES:
+        name = table._meta.db_table
+        last_id = last_ids.get(name, 0)
+        count = 0
+        while True:
+            rows = list(table.select()
+                        .where(table.id > last_id)
+                        .order_by(table.id)
+                        .limit(chunk_size)
+                        .dicts())
+            if not rows:
+                break
+            first_id, last_id = rows[0]['id'], rows[-1]['id']
+            _add_member(tarball, 'records/%s/%d-%d.jsonl' % (
+                name, first_id, last_id), '\n'.join(
+                    json.dumps(row, default=_encode) for row in rows))
+            count += len(rows)
+        logging.info("Dumped %d rows from %s", count, name)
+
+    uploads = model.AttachmentRevision.select(
+        model.AttachmentRevision.sha) \
+        .order_by(model.AttachmentRevision.id) \
+        .tuples() \
+        .iterator()
+    store = storage.blob_store()
+    for (sha,) in uploads:
+        if sha in blobs:
+            continue
+        key = model.Attachment.hashPath(sha)
+        if not store.exists(key):
+            logging.warning("Missing upload %s", sha)
+            continue
+        blobs.add(sha)
+        info = tarfile.TarInfo('blobs/' + sha)
+        info.size = store.size(key)
+        info.mtime = time.time()
+        fh = store.open(key)
+        try:
+            tarball.addfile(info, fh)
+        finally:
+            fh.close()
+    logging.info("Dumped %d blobs", len(blobs))
+
+
+def _restore_rows(table, lines):
+    rows = [json.loads(line) for line in lines if line.strip()]
+    for field in table._meta.sorted_fields:
+        if isinstance(field, peewee.DateTimeField):
+            for row in rows:
+                if row.get(field.name) is not None:
+                    row[field.name] = parse_timestamp(row[field.name])
+    existing = set()
+    for chunk in chunked([row['id'] for row in rows], 1):
+        existing.update(id for (id,) in table.select(table.id)
+                        .where(table.id << chunk).tuples())
+    rows = [row for row in rows if row['id'] not in existing]
+    columns = len(table._meta.sorted_fields)
+    with model.DATABASE.transaction():
+        for chunk in chunked(rows, columns):
+            table.insert_many(chunk).execute()
+    return len(rows)
+
+
+def _restore_blob(sha, fileobj, size):
+    store = storage.blob_store()
+    key = model.Attachment.hashPath(sha)
+    if not store.exists(key):
+        store.put(key, fileobj, size)
+
+
+def reset_sequences():
+    """Moves Postgres id sequences past the restored ids"""
+    if not isinstance(model.DATABASE.obj, peewee.PostgresqlDatabase):
+        return
+    for table in TABLES:
+        name = table._meta.db_table
+        model.DATABASE.execute_sql(
+            "SELECT setval(pg_get_serial_sequence('\"%s\"', 'id'), "
+            "COALESCE(MAX(id), 1)) FROM \"%s\"" % (name, name))
+
+
+def read_dump(fileobj):
+    """Restores a dump written by write_dump() from a stream. Rows that already
+    exist are skipped, so an interrupted restore can simply be re-run."""
+    tables = dict((table._meta.db_table, table) for table in TABLES)
+    counts = {}
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tarball:
+        for member in tarball:
+            parts = member.name.split('/')
+            if member.name == HEADER:
+                header = json.load(tarball.extractfile(member))
+                if header['format'] > FORMAT_VERSION:
+                    raise ValueError("Dump format %s is newer than %s" % (
+                        header['format'], FORMAT_VERSION))
+            elif parts[0] == 'records' and parts[1] in tables:
+                lines = tarball.extractfile(member).read().split('\n')
+                counts[parts[1]] = counts.get(parts[1], 0) + \
+                    _restore_rows(tables[parts[1]], lines)
+            elif parts[0] == 'blobs':
+                _restore_blob(parts[1], tarball.extractfile(member),
+                              member.size)
+                counts['blobs'] = counts.get('blobs', 0) + 1
+    reset_sequences()
+    # Renders kept from before may be of revisions the dump reused ids for
+    cache.render_cache().clear()
+    redirects.forget()
+    events.publish('all')
+    return counts
+
+
+@model.MANAGER.option('output', help="Dump file, or - for stdout")
+@model.MANAGER.option('--no-compress', dest='compress', default=True,
+                      action='store_false', help="Write a plain tar stream")
+@model.MANAGER.option('--resume', dest='resume', default=False,
+                      action='store_true',
+                      help="Continue an interrupted uncompressed dump, "
+                      "while nothing is being edited")
+def dump(output, compress, resume):
+    """Streams every page, revision, identity and upload to a tarball"""
+    model.get_db()
+    if output == '-':
+        write_dump(sys.stdout, compress)
+        return
+    if resume and os.path.exists(output):
+        if compress:
+            raise ValueError("Only uncompressed dumps can be resumed")
+        end, last_ids, blobs = scan_dump(output)
+        with open(output, 'r+b') as fh:
+            fh.truncate(end)
+            fh.seek(end)
+            write_dump(fh, False, last_ids=last_ids, blobs=blobs)
+        return
+    with open(output, 'wb') as fh:
+        write_dump(fh, compress)
+
+
+@model.MANAGER.option('source', help="Dump file, or - for stdin")
+def restore(source):
+    """Restores a dump into the configured database and upload store"""
+    model.syncdb()
+    model.get_db()
+    if source == '-':
+        counts = read_dump(sys.stdin)
+    else:
+        with open(source, 'rb') as fh:
+            counts = read_dump(fh)
+    for name, count in sorted(counts.items()):
+        logging.info("Restored %d %s", count, name)
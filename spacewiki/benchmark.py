@@ -0,0 +1,359 @@
+"""Synthetic wikis and benchmarks for the render pipeline and hot routes"""
+
+from flask_script import Manager
+import json
+import logging
+import math
+import os
+from PIL import Image
+import random
+import shutil
+import tempfile
+import time
+
+from spacewiki import model, wikiformat
+from spacewiki.wikiformat import Resolver, markdown
+
+SCALES = {
+    'tiny': {'pages': 20, 'revisions': 3, 'templates': 2, 'attachments': 2,
+             'history': 10},
+    'small': {'pages': 200, 'revisions': 5, 'templates': 5, 'attachments': 10,
+              'history': 100},
+    'medium': {'pages': 2000, 'revisions': 10, 'templates': 20,
+               'attachments': 50, 'history': 500},
+    'large': {'pages': 20000, 'revisions': 20, 'templates': 50,
+              'attachments': 200, 'history': 2000},
+}
+
+# Size of each revision of the page with a long history
+HISTORY_BODY = 100 * 1024
+
+WORDS = (
+    'airlock', 'bench', 'cable', 'drill', 'epoxy', 'fuse', 'gantry', 'hinge',
+    'laser', 'lathe', 'meeting', 'membership', 'mill', 'oscilloscope',
+    'printer', 'reflow', 'router', 'solder', 'spindle', 'welder', 'workshop',
+)
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Registers a function as a benchmark. The function is called once per
+    iteration with the SyntheticWiki and a seeded Random."""
+    def decorator(func):  # pylint: disable=missing-docstring
+        BENCHMARKS.append((name, func))
+        return func
+    return decorator
+
+
+class SyntheticWiki(object):
+    """A reproducible, randomly generated wiki living in a temporary
+    directory"""
+
+    def __init__(self, app, scale='small', seed=0):
+        self.app = app
+        self.scale = scale
+        self.params = SCALES[scale]
+        self.seed = seed
+        self.pages = []
+        self.templates = []
+        self.revisions = {}
+        self.attachments = []
+        # A page with params['history'] revisions of HISTORY_BODY bytes
+        self.history = None
+        self.client = app.test_client()
+
+    def get(self, url):
+        """Fetches url with the test client, failing on any error status"""
+        resp = self.client.get(url)
+        resp.get_data()
+        if resp.status_code != 200:
+            raise RuntimeError("%s returned %s" % (url, resp.status_code))
+        return resp
+
+    def _words(self, rng, count):
+        return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+    def _body(self, rng):
+        paragraphs = []
+        for i in range(rng.randint(5, 20)):
+            if i % 5 == 0:
+                paragraphs.append('## %s' % (self._words(rng, 3).title()))
+            text = self._words(rng, rng.randint(20, 80))
+            if self.pages:
+                link = rng.choice(self.pages)
+                text += ' See [[%s]] and [[%s|the %s page]].' % (
+                    link, 'missing-%d' % rng.randint(0, 100), link)
+            paragraphs.append(text)
+            if i % 7 == 3:
+                paragraphs.append('\n'.join('* ' + self._words(rng, 5)
+                                            for _ in range(4)))
+            if i % 9 == 4:
+                paragraphs.append('    ' + self._words(rng, 8))
+        if self.templates and rng.random() < 0.3:
+            paragraphs.insert(0, '{{%s}}' % (rng.choice(self.templates),))
+        return '\n\n'.join(paragraphs)
+
+    def generate(self):
+        """Populates the database and upload store"""
+        rng = random.Random(self.seed)
+        model.get_db()
+        model.syncdb()
+        author = model.Identity.get_or_create_from_id(
+            'tripcode:benchmark', display='benchmark', handle='benchmark')
+
+        for i in range(self.params['templates']):
+            slug = 'templates/box-%d' % (i,)
+            page = model.Page.create(title='box-%d' % (i,), slug=slug)
+            page.newRevision('> ' + self._words(rng, 15), '', author)
+            self.templates.append(slug)
+
+        with model.DATABASE.transaction():
+            for i in range(self.params['pages']):
+                title = '%s %d' % (rng.choice(WORDS).title(), i)
+                if i % 4 == 0 or not self.pages:
+                    slug = model.SlugField.slugify(title)
+                else:
+                    slug = rng.choice(self.pages).split('/')[0] + '/' + \
+                        model.SlugField.slugify(title)
+                page = model.Page.create(title=title, slug=slug)
+                revs = []
+                for _ in range(rng.randint(1, self.params['revisions'])):
+                    revs.append(page.newRevision(self._body(rng), 'Edit',
+                                                 author).id)
+                self.pages.append(slug)
+                self.revisions[slug] = revs
+
+        with model.DATABASE.transaction():
+            self.history = 'meeting-minutes'
+            page = model.Page.create(title='Meeting Minutes',
+                                     slug=self.history)
+            body = ''
+            while len(body) < HISTORY_BODY:
+                body += self._body(rng) + '\n\n'
+            for i in range(self.params['history']):
+                body = body[:HISTORY_BODY] + '\n\n' + self._words(rng, 10)
+                page.newRevision(body, 'Minutes %d' % (i,), author)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for i in range(self.params['attachments']):
+                slug = rng.choice(self.pages)
+                page = model.Page.get(slug=slug)
+                fname = 'image-%d.png' % (i,)
+                src = os.path.join(tmpdir, fname)
+                Image.new('RGB', (rng.randint(200, 800), rng.randint(200, 800)),
+                          (rng.randint(0, 255), 0, 0)).save(src, format='png')
+                page.attachUpload(src, fname)
+                self.attachments.append((slug, fname))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+@benchmark('render_wikitext')
+def bench_render(wiki, rng):
+    """Renders the latest revision of a random page"""
+    slug = rng.choice(wiki.pages)
+    with wiki.app.test_request_context('/'):
+        model.get_db()
+        revision = model.Page.latestRevision(slug)
+        wikiformat.render_wikitext(revision.body, slug)
+
+
+@benchmark('wikiformat.markdown')
+def bench_markdown(wiki, rng):
+    """Tokenizes and renders a random page, without sanitizing it"""
+    slug = rng.choice(wiki.pages)
+    with wiki.app.test_request_context('/'):
+        model.get_db()
+        revision = model.Page.latestRevision(slug)
+        markdown.render(revision.body, slug, Resolver())
+
+
+@benchmark('wikiformat.emit')
+def bench_emit(wiki, rng):
+    """Renders a random page from its cached parse, as after a page it links
+    to changes, without sanitizing it"""
+    slug = rng.choice(wiki.pages)
+    with wiki.app.test_request_context('/'):
+        model.get_db()
+        revision = model.Page.latestRevision(slug)
+        markdown.emit(wikiformat.parsed(revision), slug, Resolver(),
+                      wikiformat.parsed)
+
+
+@benchmark('pages.view')
+def bench_view(wiki, rng):
+    """Views a random page"""
+    return wiki.get('/' + rng.choice(wiki.pages))
+
+
+@benchmark('history.history')
+def bench_history(wiki, rng):
+    """Lists the history of a random page"""
+    return wiki.get('/%s/history' % (rng.choice(wiki.pages),))
+
+
+@benchmark('history.diff')
+def bench_diff(wiki, rng):
+    """Diffs the oldest and newest revisions of a random page"""
+    slug = rng.choice(wiki.pages)
+    revs = wiki.revisions[slug]
+    return wiki.get('/%s/%s..%s' % (slug, revs[0], revs[-1]))
+
+
+@benchmark('model.history')
+def bench_revision_metadata(wiki, rng):  # pylint: disable=unused-argument
+    """Lists the id, time, message and author of every revision of a page
+    with a long history of large revisions, as the history view does"""
+    with wiki.app.test_request_context('/'):
+        model.get_db()
+        page = model.Page.get(slug=wiki.history)
+        for revision in page.history():
+            (revision.id, revision.timestamp, revision.message,  # pylint: disable=pointless-statement
+             revision.author.display_name)
+        model.Page.latestRevision(wiki.history, body=False).is_latest  # pylint: disable=pointless-statement
+
+
+@benchmark('specials.search')
+def bench_search(wiki, rng):
+    """Searches titles for a random word"""
+    return wiki.get('/.search?q=' + rng.choice(WORDS))
+
+
+@benchmark('uploads.get_attachment')
+def bench_attachment(wiki, rng):
+    """Fetches a random attachment, thumbnailed half of the time"""
+    slug, fname = rng.choice(wiki.attachments)
+    url = '/%s/file/%s' % (slug, fname)
+    if rng.random() < 0.5:
+        url += '/%d' % (rng.choice((64, 128, 256)),)
+    return wiki.get(url)
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not samples:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(samples))) - 1
+    return samples[max(0, min(rank, len(samples) - 1))]
+
+
+def run_benchmarks(wiki, iterations=100, warmup=10, only=None):
+    """Runs every registered benchmark against wiki, returning a dict of
+    results keyed on benchmark name"""
+    results = {}
+    for name, func in BENCHMARKS:
+        if only and name not in only:
+            continue
+        rng = random.Random(wiki.seed)
+        for _ in range(warmup):
+            func(wiki, rng)
+        samples = []
+        for _ in range(iterations):
+            start = time.time()
+            func(wiki, rng)
+            samples.append(time.time() - start)
+        total = sum(samples)
+        samples.sort()
+        results[name] = {
+            'iterations': iterations,
+            'throughput': iterations / total if total else 0.0,
+            'p50': percentile(samples, 50),
+            'p99': percentile(samples, 99),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Returns a list of (name, metric, baseline, current) for every
+    latency that regressed more than tolerance past the baseline"""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in ('p50', 'p99'):
+            old = baseline[name][metric]
+            if result[metric] > old * (1 + tolerance):
+                regressions.append((name, metric, old, result[metric]))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    """Formats results as a plain text table"""
+    lines = ['%-24s %10s %10s %10s %10s' % ('benchmark', 'req/s', 'p50 ms',
+                                           'p99 ms', 'vs base')]
+    for name, result in sorted(results.items()):
+        delta = ''
+        if baseline and name in baseline and baseline[name]['p50']:
+            delta = '%+.1f%%' % (
+                (result['p50'] / baseline[name]['p50'] - 1) * 100)
+        lines.append('%-24s %10.1f %10.2f %10.2f %10s' % (
+            name, result['throughput'], result['p50'] * 1000,
+            result['p99'] * 1000, delta))
+    return '\n'.join(lines)
+
+
+def create_benchmark_app():
+    """Creates an app with its own scratch database and upload store"""
+    from spacewiki.app import create_app
+    app = create_app(False)
+    tmpdir = tempfile.mkdtemp()
+    app.config['DATABASE_URL'] = 'sqlite:///' + tmpdir + '/bench.sqlite3'
+    app.config['UPLOAD_PATH'] = os.path.join(tmpdir, 'uploads')
+    app.secret_key = 'benchmark'
+    return app, tmpdir
+
+MANAGER = Manager(usage='Benchmarks for the render pipeline and hot routes')
+
+
+@MANAGER.option('-s', '--scale', dest='scale', default='small',
+                choices=sorted(SCALES.keys()))
+@MANAGER.option('-n', '--iterations', dest='iterations', default=100, type=int)
+@MANAGER.option('-b', '--baseline', dest='baseline', default=None,
+                help='JSON file of previous results to compare against, '
+                'if it exists')
+@MANAGER.option('--save', dest='save', default=None,
+                help='Write results to this JSON file')
+@MANAGER.option('-t', '--tolerance', dest='tolerance', default=0.2, type=float,
+                help='Allowed slowdown before a result is a regression')
+@MANAGER.option('-o', '--only', dest='only', default=None, action='append',
+                help='Only run the named benchmark')
+@MANAGER.option('--seed', dest='seed', default=0, type=int)
+def run(scale, iterations, baseline, save, tolerance, only, seed):
+    """Generates a synthetic wiki and benchmarks it"""
+    app, tmpdir = create_benchmark_app()
+    try:
+        with app.test_request_context('/'):
+            wiki = SyntheticWiki(app, scale, seed)
+            logging.info("Generating %s wiki", scale)
+            wiki.generate()
+        results = run_benchmarks(wiki, iterations, only=only)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    previous = None
+    if baseline is not None and not os.path.exists(baseline):
+        logging.warning("No baseline at %s to compare against, save one "
+                        "with --save", baseline)
+    elif baseline is not None:
+        with open(baseline, 'r') as fh:
+            previous = json.load(fh).get(scale, {})
+    print format_results(results, previous)
+
+    if save is not None:
+        saved = {}
+        if os.path.exists(save):
+            with open(save, 'r') as fh:
+                saved = json.load(fh)
+        saved[scale] = results
+        with open(save, 'w') as fh:
+            json.dump(saved, fh, indent=2, sort_keys=True)
+
+    if previous:
+        regressions = compare(results, previous, tolerance)
+        for name, metric, old, new in regressions:
+            logging.error("%s %s regressed: %.2fms -> %.2fms", name, metric,
+                          old * 1000, new * 1000)
+        if regressions:
+            return 1
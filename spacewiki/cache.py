@@ -0,0 +1,428 @@
+"""Caches of rendered wikitext
+
+By default each process keeps its own RenderCache. With RENDER_CACHE_PATH
+set, renders and diffs are kept in a SharedCache instead: a sqlite file that
+every worker on the machine reads through the same memory mapped pages, so a
+render made by one worker is found by all of them and outlives recycling.
+The file is emptied when it was filled from another database or by another
+RENDER_VERSION.
+
+Rendering reads other pages, which may change before the render is put, so
+callers take a generation() before rendering and pass it to put(), which
+refuses the render if anything it depended on was invalidated since."""
+
+import collections
+from flask import current_app
+import logging
+import marshal
+import os
+import sqlite3
+import threading
+import time
+
+# Bump whenever the same wikitext starts rendering differently, so renders
+# kept in a shared cache by an older version aren't served
+RENDER_VERSION = 1
+
+# Slugs looked up in one statement, well within sqlite's limit on variables
+CHUNK_SIZE = 500
+
+
+class RenderCache(object):
+    """A bounded LRU of rendered revision HTML. Every entry is indexed by the
+    slugs its rendering depended on, so that an edit to one page can drop
+    the renders that linked to or included it."""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._dependents = {}
+        # slug -> the generation it was last invalidated in
+        self._invalidated = {}
+        self._generation = 0
+        self._cleared = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, revision_id):
+        """Returns the cached HTML for a revision, or None"""
+        with self._lock:
+            entry = self._entries.pop(revision_id, None)
+            if entry is None:
+                return None
+            self._entries[revision_id] = entry
+            return entry[0]
+
+    def generation(self):
+        """Returns the generation to pass to put() for a render that is about
+        to begin"""
+        with self._lock:
+            return self._generation
+
+    def put(self, revision_id, html, dependencies, generation=None):
+        """Caches the HTML for a revision, along with the set of slugs it was
+        rendered from, unless one of them was invalidated after generation.
+        Returns True if the HTML was cached."""
+        with self._lock:
+            if generation is not None and (
+                    self._cleared > generation or
+                    any(self._invalidated.get(slug, 0) > generation
+                        for slug in dependencies)):
+                return False
+            self._discard(revision_id)
+            self._entries[revision_id] = (html, frozenset(dependencies))
+            for slug in dependencies:
+                self._dependents.setdefault(slug, set()).add(revision_id)
+            while len(self._entries) > self.size:
+                self._discard(next(iter(self._entries)))
+            return True
+
+    def invalidate(self, slug):
+        """Drops every render that depended on slug, returning the ids of
+        the revisions that were dropped"""
+        with self._lock:
+            self._generation += 1
+            self._invalidated[slug] = self._generation
+            stale = list(self._dependents.get(slug, ()))
+            for revision_id in stale:
+                self._discard(revision_id)
+            return stale
+
+    def clear(self):
+        """Drops every cached render"""
+        with self._lock:
+            self._generation += 1
+            self._cleared = self._generation
+            self._entries.clear()
+            self._dependents.clear()
+            self._invalidated.clear()
+
+    def _discard(self, revision_id):
+        entry = self._entries.pop(revision_id, None)
+        if entry is None:
+            return
+        for slug in entry[1]:
+            dependents = self._dependents.get(slug)
+            if dependents is not None:
+                dependents.discard(revision_id)
+                if not dependents:
+                    del self._dependents[slug]
+
+
+class ParseCache(object):
+    """A bounded LRU of parsed revisions. A revision never changes, so its
+    parse never goes stale and only leaves to make room."""
+
+    def __init__(self, size=5000):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the cached parse for a key, or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, document):
+        """Caches the parse for a key"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = document
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS renders (
+    revision INTEGER PRIMARY KEY,
+    html TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS dependencies (
+    slug TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    PRIMARY KEY (slug, revision)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS dependencies_revision ON dependencies (revision);
+CREATE TABLE IF NOT EXISTS diffs (
+    old INTEGER NOT NULL,
+    new INTEGER NOT NULL,
+    lines BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (old, new));
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    bytes INTEGER NOT NULL);
+INSERT OR IGNORE INTO usage VALUES (1, 0);
+CREATE TABLE IF NOT EXISTS invalidations (
+    slug TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    identity TEXT,
+    generation INTEGER NOT NULL,
+    cleared INTEGER NOT NULL);
+INSERT OR IGNORE INTO state VALUES (1, NULL, 0, 0);
+CREATE TRIGGER IF NOT EXISTS renders_added AFTER INSERT ON renders BEGIN
+    UPDATE usage SET bytes = bytes + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS renders_dropped AFTER DELETE ON renders BEGIN
+    UPDATE usage SET bytes = bytes - old.size;
+    DELETE FROM dependencies WHERE revision = old.revision;
+END;
+CREATE TRIGGER IF NOT EXISTS diffs_added AFTER INSERT ON diffs BEGIN
+    UPDATE usage SET bytes = bytes + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS diffs_dropped AFTER DELETE ON diffs BEGIN
+    UPDATE usage SET bytes = bytes - old.size;
+END;
+"""
+
+# Entries are marked as used at most this often, to spare readers a write
+# on every hit
+TOUCH_INTERVAL = 60
+
+
+class SharedCache(object):
+    """Rendered revisions and diffs in a sqlite file shared by every process
+    on the machine, evicting the least recently used entries once they take
+    up more than max_bytes. Each thread of each process has its own
+    connection. Failing to write to the cache is logged and otherwise
+    ignored; the cache is only ever a shortcut.
+
+    identity names what the entries were rendered from and by. A file kept
+    under any other identity is emptied on opening."""
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, timeout=5,
+                 identity=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.identity = identity
+        self._local = threading.local()
+        with self._db() as db:
+            db.executescript(SCHEMA)
+        if identity is not None:
+            with self._db() as db:
+                # Also takes the write lock, so only one opener clears it
+                if db.execute('UPDATE state SET identity = ? '
+                              'WHERE identity IS NOT ?',
+                              (identity, identity)).rowcount:
+                    logging.info("Emptying the render cache in %s, which was "
+                                 "made for something else", path)
+                    self._clear(db)
+
+    def _db(self):
+        # Connections don't survive a fork, so each process opens its own
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout)
+            db.text_factory = unicode
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute('PRAGMA mmap_size = %d' % (self.max_bytes * 2,))
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def _write(self, sql, *args):
+        try:
+            with self._db() as db:
+                return db.execute(sql, args).rowcount
+        except sqlite3.OperationalError:
+            logging.warning("Could not write to the render cache",
+                            exc_info=True)
+            return 0
+
+    def __len__(self):
+        return self._db().execute('SELECT COUNT(*) FROM renders').fetchone()[0]
+
+    @property
+    def bytes(self):
+        """The total size of every cached render and diff"""
+        return self._db().execute('SELECT bytes FROM usage').fetchone()[0]
+
+    def get(self, revision_id):
+        """Returns the cached HTML for a revision, or None"""
+        row = self._db().execute(
+            'SELECT html, used FROM renders WHERE revision = ?',
+            (revision_id,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < time.time() - TOUCH_INTERVAL:
+            self._write('UPDATE renders SET used = ? WHERE revision = ?',
+                        time.time(), revision_id)
+        return row[0]
+
+    def generation(self):
+        """Returns the generation to pass to put() for a render that is about
+        to begin"""
+        return self._db().execute(
+            'SELECT generation FROM state').fetchone()[0]
+
+    def put(self, revision_id, html, dependencies, generation=None):
+        """Caches the HTML for a revision, along with the set of slugs it was
+        rendered from, unless one of them was invalidated after generation.
+        Returns True if the HTML was cached."""
+        try:
+            with self._db() as db:
+                # Writing first takes the write lock, so nothing can be
+                # invalidated between the check and the insert
+                db.execute('DELETE FROM renders WHERE revision = ?',
+                           (revision_id,))
+                if generation is not None and \
+                        self._changed_since(db, dependencies, generation):
+                    return False
+                db.execute('INSERT INTO renders VALUES (?, ?, ?, ?)',
+                           (revision_id, html, len(html), time.time()))
+                db.executemany('INSERT INTO dependencies VALUES (?, ?)',
+                               [(slug, revision_id) for slug in dependencies])
+        except sqlite3.OperationalError:
+            logging.warning("Could not write to the render cache",
+                            exc_info=True)
+            return False
+        self._evict()
+        return True
+
+    @staticmethod
+    def _changed_since(db, dependencies, generation):
+        if db.execute('SELECT cleared FROM state').fetchone()[0] > generation:
+            return True
+        slugs = list(dependencies)
+        for start in range(0, len(slugs), CHUNK_SIZE):
+            chunk = slugs[start:start + CHUNK_SIZE]
+            if db.execute(
+                    'SELECT 1 FROM invalidations WHERE generation > ? AND '
+                    'slug IN (%s) LIMIT 1' % (', '.join('?' * len(chunk)),),
+                    [generation] + chunk).fetchone():
+                return True
+        return False
+
+    def get_diff(self, old_id, new_id):
+        """Returns the cached diff between two revisions, or None. Either id
+        may be 0 for the empty page."""
+        row = self._db().execute(
+            'SELECT lines, used FROM diffs WHERE old = ? AND new = ?',
+            (old_id, new_id)).fetchone()
+        if row is None:
+            return None
+        if row[1] < time.time() - TOUCH_INTERVAL:
+            self._write('UPDATE diffs SET used = ? WHERE old = ? AND new = ?',
+                        time.time(), old_id, new_id)
+        return marshal.loads(str(row[0]))
+
+    def put_diff(self, old_id, new_id, lines):
+        """Caches the diff between two revisions. Revisions never change, so
+        diffs are only ever evicted, not invalidated."""
+        data = marshal.dumps(lines)
+        if self._write('INSERT OR REPLACE INTO diffs VALUES (?, ?, ?, ?, ?)',
+                       old_id, new_id, buffer(data), len(data), time.time()):
+            self._evict()
+
+    def _evict(self):
+        if self.bytes <= self.max_bytes:
+            return
+        # Make some room, so the next few puts needn't evict again
+        target = self.max_bytes * 9 / 10
+        try:
+            with self._db() as db:
+                excess = db.execute('SELECT bytes FROM usage').fetchone()[0] \
+                    - target
+                renders, diffs = [], []
+                for old, new, size, _ in db.execute(
+                        'SELECT revision, NULL, size, used FROM renders '
+                        'UNION ALL SELECT old, new, size, used FROM diffs '
+                        'ORDER BY used'):
+                    if excess <= 0:
+                        break
+                    if new is None:
+                        renders.append((old,))
+                    else:
+                        diffs.append((old, new))
+                    excess -= size
+                db.executemany('DELETE FROM renders WHERE revision = ?',
+                               renders)
+                db.executemany('DELETE FROM diffs WHERE old = ? AND new = ?',
+                               diffs)
+        except sqlite3.OperationalError:
+            logging.warning("Could not evict from the render cache",
+                            exc_info=True)
+
+    def invalidate(self, slug):
+        """Drops every render that depended on slug, returning the ids of
+        the revisions that were dropped"""
+        try:
+            with self._db() as db:
+                db.execute('UPDATE state SET generation = generation + 1')
+                db.execute('INSERT OR REPLACE INTO invalidations '
+                           'SELECT ?, generation FROM state', (slug,))
+                stale = [revision for (revision,) in db.execute(
+                    'SELECT revision FROM dependencies WHERE slug = ?',
+                    (slug,))]
+                db.executemany('DELETE FROM renders WHERE revision = ?',
+                               [(revision,) for revision in stale])
+        except sqlite3.OperationalError:
+            # A stale render is worse than a slow one
+            logging.exception("Could not invalidate renders of %s", slug)
+            raise
+        return stale
+
+    def clear(self):
+        """Drops every cached render and diff"""
+        with self._db() as db:
+            self._clear(db)
+
+    @staticmethod
+    def _clear(db):
+        db.execute('UPDATE state SET generation = generation + 1')
+        db.execute('UPDATE state SET cleared = generation')
+        # Older than the clear, so put() needn't look at them
+        db.execute('DELETE FROM invalidations')
+        db.execute('DELETE FROM renders')
+        db.execute('DELETE FROM diffs')
+
+
+def render_cache():
+    """Returns the render cache for the current app"""
+    cache = current_app.extensions.get('spacewiki_render_cache')
+    if cache is None:
+        path = current_app.config.get('RENDER_CACHE_PATH')
+        if path:
+            fresh = SharedCache(
+                path,
+                current_app.config.get('RENDER_CACHE_BYTES',
+                                       256 * 1024 * 1024),
+                identity='%d %s' % (RENDER_VERSION,
+                                    current_app.config.get('DATABASE_URL')))
+        else:
+            fresh = RenderCache(current_app.config.get('RENDER_CACHE_SIZE',
+                                                       1000))
+        cache = current_app.extensions.setdefault('spacewiki_render_cache',
+                                                  fresh)
+    return cache
+
+
+def parse_cache():
+    """Returns the parse cache for the current app. Parses are Python objects,
+    so each process keeps its own even with RENDER_CACHE_PATH set."""
+    cache = current_app.extensions.get('spacewiki_parse_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault(
+            'spacewiki_parse_cache',
+            ParseCache(current_app.config.get('PARSE_CACHE_SIZE', 5000)))
+    return cache
+
+
+def diff_cache():
+    """Returns the cache diffs are kept in, or None if there is none"""
+    cache = render_cache()
+    if isinstance(cache, SharedCache):
+        return cache
+    return None
@@ -40,13 +40,17 @@ def add_site_settings():
     """Adds the contents of settings.py to the template context"""
     return dict(settings=current_app.config)
 
-@BLUEPRINT.app_context_processor
-def add_nav_pages():
+def navigation_pages():
+    """Returns the pages listed in .spacewiki/navigation-list"""
     pages = []
     nav_page = model.Page.latestRevision('.spacewiki/navigation-list')
     if nav_page:
         for link in nav_page.body.split('\n'):
-            pageRev = model.Page.latestRevision(link)
+            pageRev = model.Page.latestRevision(link, body=False)
             if pageRev:
                 pages.append(pageRev.page)
-    return dict(NAVIGATION_PAGES=pages)
+    return pages
+
+@BLUEPRINT.app_context_processor
+def add_nav_pages():
+    return dict(NAVIGATION_PAGES=navigation_pages())
@@ -0,0 +1,126 @@
+"""Database connections, including a production profile for SQLite
+
+By default every app context connects to DATABASE_URL on its own. With
+SQLITE_PRODUCTION set, a sqlite:// DATABASE_URL instead gets one database
+per app that runs in WAL mode with SQLITE_PRAGMAS applied to every
+connection, and funnels every write through a single writer thread. Readers
+each keep their own connection and, thanks to WAL, never wait on a writer,
+while writers never contend with each other for the lock.
+
+DATABASE_REPLICA_URLS lists read replicas of DATABASE_URL. Read-only requests
+send their SELECTs to one of them, see model.route_reads."""
+
+import atexit
+from flask import current_app
+import random
+import threading
+
+import peewee
+from playhouse.db_url import connect, parse
+from playhouse.sqliteq import AsyncCursor, SqliteQueueDatabase, SHUTDOWN
+
+_LOCK = threading.Lock()
+
+
+class _immediate_transaction(peewee.transaction_sqlite):
+    """A transaction that runs on the calling thread's own connection,
+    bypassing the writer queue until it ends"""
+    __slots__ = ()
+
+    def __enter__(self):
+        self.db._direct.depth = getattr(self.db._direct, 'depth', 0) + 1
+        try:
+            return super(_immediate_transaction, self).__enter__()
+        except:
+            self.db._direct.depth -= 1
+            raise
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            return super(_immediate_transaction, self).__exit__(
+                exc_type, exc_val, exc_tb)
+        finally:
+            self.db._direct.depth -= 1
+
+
+class WriterQueueDatabase(SqliteQueueDatabase):
+    """A SqliteQueueDatabase that waits for each queued write to finish, so
+    callers still read their own writes and see their own errors.
+
+    Transactions can't be split across the writer thread, so they take the
+    write lock up front with BEGIN IMMEDIATE on the caller's connection
+    instead. The writer thread waits out busy_timeout behind them rather
+    than failing with 'database is locked'."""
+
+    def __init__(self, *args, **kwargs):
+        self._direct = threading.local()
+        super(WriterQueueDatabase, self).__init__(*args, **kwargs)
+
+    def in_transaction(self):
+        """Returns True if this thread is inside a transaction"""
+        return getattr(self._direct, 'depth', 0) > 0
+
+    def execute_sql(self, sql, params=None, require_commit=True,
+                    timeout=None):
+        if self.in_transaction():
+            return self._execute(sql, params, require_commit)
+        cursor = super(WriterQueueDatabase, self).execute_sql(
+            sql, params, require_commit, timeout)
+        if isinstance(cursor, AsyncCursor):
+            cursor._wait()  # pylint: disable=protected-access
+        return cursor
+
+    def stop(self):
+        """Stops the writer thread once it has done the writes queued so
+        far. Unlike SqliteQueueDatabase.stop, waits for it without holding
+        the connection lock, which a writer that hasn't connected yet needs
+        before it can see it is being stopped."""
+        with self._conn_lock:
+            if self._is_stopped:
+                return False
+            self._is_stopped = True
+            self._write_queue.put(SHUTDOWN)
+        self._writer.join()
+        return True
+
+    def transaction(self, transaction_type='IMMEDIATE'):
+        return _immediate_transaction(self, transaction_type)
+
+    atomic = transaction
+
+
+def production_database(url, pragmas):
+    """Opens a WriterQueueDatabase for a sqlite:// URL"""
+    kwargs = parse(url)
+    if pragmas:
+        kwargs['pragmas'] = sorted(pragmas.items())
+    database = WriterQueueDatabase(**kwargs)
+    atexit.register(database.stop)
+    return database
+
+
+def connect_database():
+    """Returns the database for the current app context"""
+    url = current_app.config['DATABASE_URL']
+    if not current_app.config.get('SQLITE_PRODUCTION') or \
+       not url.startswith('sqlite'):
+        current_app.logger.info("Using database at %s", url)
+        return connect(url)
+    with _LOCK:
+        database = current_app.extensions.get('spacewiki_database')
+        if database is None:
+            current_app.logger.info("Using database at %s with a writer queue",
+                                    url)
+            database = production_database(
+                url, current_app.config.get('SQLITE_PRAGMAS'))
+            current_app.extensions['spacewiki_database'] = database
+    return database
+
+
+def connect_replica():
+    """Returns a connection to a random read replica, or None if there are
+    no replicas configured"""
+    urls = current_app.config.get('DATABASE_REPLICA_URLS')
+    if not urls:
+        return None
+    return connect(random.choice(urls))
@@ -1,9 +1,10 @@
 """Routes to handle the realtime editor"""
 
 from flask import (Blueprint, current_app, render_template, request, redirect,
-        url_for)
+        url_for, jsonify)
 from flask_login import current_user
-from spacewiki import model, auth
+from spacewiki import model, auth, move, typeahead, \
+        preview as live_preview
 import peewee
 
 import logging
@@ -11,9 +12,15 @@ BLUEPRINT = Blueprint('editor', __name__)
 
 @BLUEPRINT.route("/preview", methods=['POST'])
 def preview():
-    """Render some markup as HTML"""
-    return model.Revision.render_text(request.form['body'],
-                                      request.form['slug'])
+    """Render some markup as HTML. Editors that send a session token get an
+    incremental patch instead, see spacewiki.preview"""
+    if 'session' not in request.form:
+        return model.Revision.render_text(request.form['body'],
+                                          request.form['slug'])
+    return jsonify(live_preview.render_patch(
+        request.form['session'], int(request.form['seq']),
+        int(request.form.get('base', -1)), request.form['body'],
+        request.form['slug']))
 
 @BLUEPRINT.route("/<path:slug>/edit", methods=['GET'])
 def edit(slug, redirectFrom=None, preview=None, collision=None):
@@ -60,14 +67,29 @@ def save(slug=None):
     try:
         page = model.Page.get(slug=slug)
         logging.debug("Updating existing page: %s", page.slug)
+        if newslug != slug:
+            try:
+                move.move_subtree(slug, newslug,
+                                  current_user._get_current_object(),
+                                  redirects='redirect' in request.form,
+                                  rewrite_links='rewrite_links' in request.form)
+            except ValueError as e:
+                logging.debug("Could not move %s to %s: %s", slug, newslug, e)
+                return edit(slug, collision="Cannot change URL! %s." % (e,))
+            page = model.Page.get(slug=newslug)
         page.title = title
-        page.slug = newslug
         page.save()
+        titles = typeahead.indexed()
+        if titles is not None:
+            titles.add(page.slug, page.title)
     except peewee.DoesNotExist:
         print "Saving '%s' at '%s'" %(title, slug)
         page = model.Page.create(title=title,
                                  slug=slug)
         logging.debug("Created new page: %s (%s)", page.title, page.slug)
+        titles = typeahead.indexed()
+        if titles is not None:
+            titles.add(page.slug, page.title)
     page.newRevision(request.form['body'], request.form['message'],
                      current_user._get_current_object())
 
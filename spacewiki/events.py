@@ -0,0 +1,255 @@
+"""Tells the other processes serving the wiki, on this node and others, that
+something they may have cached has changed
+
+Every process keeps its own title index, redirect map and, unless they share
+a RENDER_CACHE_PATH, rendered pages. The process that makes a change updates
+its own caches directly and then publishes an event, and every other process
+hands the event to the subscribers the cache modules registered with
+subscribe(). Events are:
+
+* ``page``, with the slug of a page that was edited, moved or had a file
+  attached (as ``attachment:<slug>``);
+* ``all``, after changes too big to describe, like a bulk import.
+
+EVENT_BUS picks the transport:
+
+* ``postgres`` sends events with NOTIFY on EVENT_CHANNEL, through the
+  connection making the change, so they are only delivered once it commits.
+  Every process LISTENs on a connection of its own, and after losing it
+  treats reconnecting as an ``all`` event, since whatever was sent in
+  between is lost.
+* ``socket`` sends events as datagrams to every unix socket in
+  EVENT_SOCKET_DIR, one per process. It only reaches processes on one host,
+  which is enough for a pre-forked server or for testing.
+
+Without EVENT_BUS, events go nowhere."""
+
+import errno
+from flask import Blueprint, current_app
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import uuid
+
+from playhouse.db_url import connect
+
+from spacewiki import model
+
+BLUEPRINT = Blueprint('events', __name__)
+
+SUBSCRIBERS = {'page': [], 'all': []}
+
+# What a receiving process makes of events it may have missed
+MISSED = json.dumps({'origin': None, 'kind': 'all', 'key': None})
+
+_LOCK = threading.Lock()
+
+
+def subscribe(kind):
+    """Registers the decorated function to be called with the key of every
+    event of kind published by another process. It is called from the
+    listening thread, inside a request context with the database set up."""
+    def decorator(func):  # pylint: disable=missing-docstring
+        SUBSCRIBERS[kind].append(func)
+        return func
+    return decorator
+
+
+class SocketTransport(object):
+    """Datagrams between the unix sockets of every process in a directory"""
+
+    def __init__(self, directory, origin):
+        self.directory = directory
+        self.path = os.path.join(directory, origin + '.sock')
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+
+    def send(self, payload):
+        """Sends payload to every other process"""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.sock') or path == self.path:
+                continue
+            try:
+                self._sock.sendto(payload, path)
+            except socket.error as exc:
+                if exc.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                    # The process is there, but missed this event
+                    logging.warning("Could not send an event to %s: %s",
+                                    path, exc)
+                    continue
+                # Left behind by a process that is gone
+                logging.info("Removing stale event socket %s", path)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def receive(self, timeout):
+        """Returns the payloads that arrive within timeout seconds"""
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        if not readable:
+            return []
+        return [self._sock.recv(65536)]
+
+    def close(self):
+        """Stops receiving"""
+        self._sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class PostgresTransport(object):
+    """NOTIFY and LISTEN on a Postgres channel"""
+
+    def __init__(self, url, channel):
+        self.url = url
+        self.channel = channel
+        self._conn = None
+        self._listened = False
+
+    def send(self, payload):
+        """Queues payload to be delivered when the current transaction
+        commits"""
+        model.DATABASE.execute_sql('SELECT pg_notify(%s, %s)',
+                                   (self.channel, payload))
+
+    def receive(self, timeout):
+        """Returns the payloads that arrive within timeout seconds. After
+        the connection is lost, raises, and the next call listens again."""
+        payloads = []
+        try:
+            if self._conn is None:
+                self._conn = connect(self.url).get_conn()
+                self._conn.set_isolation_level(0)
+                self._conn.cursor().execute('LISTEN "%s"' % (self.channel,))
+                if self._listened:
+                    payloads.append(MISSED)
+                self._listened = True
+            readable, _, _ = select.select([self._conn], [], [], timeout)
+            if readable:
+                self._conn.poll()
+        except Exception:
+            self.close()
+            raise
+        payloads.extend(notify.payload for notify in self._conn.notifies)
+        del self._conn.notifies[:]
+        return payloads
+
+    def close(self):
+        """Stops receiving"""
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+            self._conn = None
+
+
+class EventBus(object):
+    """Publishes this process's events and hands everyone else's to the
+    subscribers, from a listening thread"""
+
+    def __init__(self, app, transport, origin):
+        self.app = app
+        self.transport = transport
+        self.origin = origin
+        self.pid = os.getpid()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, kind, key=None):
+        """Sends an event to every other process"""
+        self.transport.send(json.dumps({'origin': self.origin, 'kind': kind,
+                                        'key': key}))
+
+    def deliver(self, payload):
+        """Calls the subscribers to an event, unless this process sent it"""
+        event = json.loads(payload)
+        if event['origin'] == self.origin:
+            return
+        with self.app.test_request_context('/'):
+            model.get_db()
+            for subscriber in SUBSCRIBERS.get(event['kind'], ()):
+                try:
+                    subscriber(event['key'])
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Could not handle %s event for %s",
+                                      event['kind'], event['key'])
+
+    def stop(self):
+        """Stops listening"""
+        self._stopped.set()
+        self._thread.join(5)
+        self.transport.close()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                for payload in self.transport.receive(1):
+                    self.deliver(payload)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Event bus failed, listening again")
+                self._stopped.wait(1)
+
+
+def open_transport(config, origin):
+    """Opens the transport an app's config describes, or returns None"""
+    kind = config.get('EVENT_BUS')
+    if not kind:
+        return None
+    if kind == 'socket':
+        return SocketTransport(config['EVENT_SOCKET_DIR'], origin)
+    if kind == 'postgres':
+        return PostgresTransport(config['DATABASE_URL'],
+                                 config.get('EVENT_CHANNEL', 'spacewiki'))
+    raise ValueError("Unknown EVENT_BUS %r" % (kind,))
+
+
+def bus():
+    """Returns the event bus for the current app, starting it if need be,
+    or None if there is none"""
+    events = current_app.extensions.get('spacewiki_events')
+    # A forked worker can't use its parent's listening thread
+    if events is not None and events.pid == os.getpid():
+        return events
+    if not current_app.config.get('EVENT_BUS'):
+        return None
+    with _LOCK:
+        events = current_app.extensions.get('spacewiki_events')
+        if events is None or events.pid != os.getpid():
+            origin = uuid.uuid4().hex
+            events = EventBus(current_app._get_current_object(),
+                              open_transport(current_app.config, origin),
+                              origin)
+            current_app.extensions['spacewiki_events'] = events
+    return events
+
+
+@BLUEPRINT.before_app_request
+def listen():
+    """Makes sure this process hears about changes made by others"""
+    bus()
+
+
+def publish(kind, key=None):
+    """Tells every other process about a change"""
+    events = bus()
+    if events is not None:
+        events.publish(kind, key)
+
+
+def page_changed(slug):
+    """Tells every other process that the page at slug changed"""
+    publish('page', slug)
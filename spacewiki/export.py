@@ -0,0 +1,334 @@
+"""Exports the wiki as a tree of static HTML"""
+
+from flask import render_template
+from jinja2 import escape
+from flask_login import login_user
+import cPickle
+import errno
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import peewee
+
+from spacewiki import context, model, redirects, storage, uploads
+
+MANIFEST = '.spacewiki-export.json'
+# Bumped when pages start depending on something new, so pages in an older
+# export are all rendered again
+MANIFEST_VERSION = 2
+
+ATTACHMENT_URL = re.compile(
+    r'''(href|src)="([^"]*?)/file/([^/"?#]+)(?:/(\d+))?"''')
+
+REDIRECT_PAGE = '''<!DOCTYPE html>
+<html><head><meta http-equiv="refresh" content="0; url=%(url)s">
+<link rel="canonical" href="%(url)s"></head>
+<body><a href="%(url)s">%(url)s</a></body></html>
+'''
+
+_WORKER_APP = None
+_WORKER_STATE = None
+
+
+def _fingerprint(items):
+    """Returns a short digest of a sequence of strings"""
+    digest = hashlib.sha1()
+    for item in items:
+        digest.update(item.encode('utf-8') + '\0')
+    return digest.hexdigest()
+
+
+def site_state():
+    """Returns a dict of everything a page render can depend on, mapping
+    each key to a value that changes whenever it is edited:
+
+    * page slug -> id of its latest revision
+    * attachment:<slug> -> id of the newest upload of that attachment
+    * attachments-of:<page slug> -> id of the newest upload on that page
+    * tree: -> the slugs and titles of every top level page, and
+      tree:<slug> -> those of every page under a top level page, which the
+      navtree shows parts of
+    * backlinks:<slug> -> the pages linking to a page
+    * softlinks:<slug> -> the softlinks from and to a page
+    * navigation: -> the pages in NAVIGATION_PAGES"""
+    state = {}
+    latest = model.Revision.select(
+        model.Page.slug, peewee.fn.Max(model.Revision.id).alias('latest')) \
+        .join(model.Page) \
+        .group_by(model.Page.slug) \
+        .tuples()
+    for slug, revision_id in latest:
+        state[slug] = revision_id
+    uploaded = model.AttachmentRevision.select(
+        model.Attachment.slug, model.Page.slug,
+        peewee.fn.Max(model.AttachmentRevision.id)) \
+        .join(model.Attachment) \
+        .join(model.Page) \
+        .group_by(model.Attachment.slug, model.Page.slug) \
+        .tuples()
+    for fileslug, page_slug, upload_id in uploaded:
+        key = 'attachment:' + fileslug
+        state[key] = max(state.get(key, 0), upload_id)
+        key = 'attachments-of:' + page_slug
+        state[key] = max(state.get(key, 0), upload_id)
+
+    trees = {}
+    for slug, title in model.Page.select(model.Page.slug, model.Page.title) \
+            .order_by(model.Page.slug).tuples():
+        tree = '' if '/' not in slug else slug.split('/')[0]
+        trees.setdefault('tree:' + tree, []).extend((slug, title))
+    backlinks = {}
+    for dest, slug, title in model.PageLink.select(
+            model.PageLink.dest_slug, model.Page.slug, model.Page.title) \
+            .join(model.Page) \
+            .where(model.PageLink.kind == model.PageLink.LINK) \
+            .order_by(model.PageLink.dest_slug, model.Page.slug).tuples():
+        backlinks.setdefault('backlinks:' + dest, []).extend((slug, title))
+    softlinks = {}
+    dest = model.Page.alias()
+    for src_slug, dest_slug, dest_title in model.Softlink.select(
+            model.Page.slug, dest.slug, dest.title) \
+            .join(model.Page, on=model.Softlink.src) \
+            .switch(model.Softlink) \
+            .join(dest, on=model.Softlink.dest) \
+            .order_by(model.Softlink.id).tuples():
+        softlinks.setdefault('softlinks:' + src_slug, []).extend(
+            ('out', dest_slug, dest_title))
+        softlinks.setdefault('softlinks:' + dest_slug, []).extend(
+            ('in', dest_slug, dest_title))
+    for fingerprints in (trees, backlinks, softlinks):
+        for key, items in fingerprints.items():
+            state[key] = _fingerprint(items)
+    state['navigation:'] = _fingerprint(
+        item for page in context.navigation_pages()
+        for item in (page.slug, page.title))
+    return state
+
+
+def structure_dependencies(slug):
+    """Returns the keys of site_state() that the parts of a page around its
+    revision depend on"""
+    return set(['tree:', 'tree:' + slug.split('/')[0], 'backlinks:' + slug,
+                'softlinks:' + slug, 'navigation:'])
+
+
+def is_dirty(slug, state, manifest):
+    """Returns True if the exported copy of a page is out of date"""
+    exported = manifest.get(slug)
+    if exported is None or exported['revision'] != state.get(slug):
+        return True
+    for key, value in exported['dependencies'].items():
+        if state.get(key) != value:
+            return True
+    return False
+
+
+def page_path(output, slug):
+    """Where the static copy of a page lives"""
+    return os.path.join(output, slug, 'index.html')
+
+
+def thumbnail_path(slug, fileslug, size):
+    """Where the static copy of a thumbnail lives, relative to the export"""
+    return '/'.join((slug, 'file', 'thumb-%s' % (size,), fileslug))
+
+
+def _write_atomic(dest, data=None, src=None):
+    """Writes data, or the output of src(tmpname), to dest without ever
+    exposing a partial file"""
+    dest_dir = os.path.dirname(dest)
+    try:
+        os.makedirs(dest_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    handle, tmpname = tempfile.mkstemp(dir=dest_dir, prefix='.export-')
+    os.close(handle)
+    try:
+        if src is not None:
+            src(tmpname)
+        else:
+            with open(tmpname, 'w') as fh:
+                fh.write(data)
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, dest)
+    except:
+        os.unlink(tmpname)
+        raise
+
+
+def export_attachments(html, output, script_root):
+    """Copies every attachment and thumbnail referenced by html into the
+    export, returning html with thumbnail URLs rewritten to their static
+    locations"""
+    store = storage.blob_store()
+
+    def copy_blob(key, dest):  # pylint: disable=missing-docstring
+        src = store.open(key)
+        try:
+            with open(dest, 'wb') as fh:
+                shutil.copyfileobj(src, fh)
+        finally:
+            src.close()
+
+    def export_attachment(match):  # pylint: disable=missing-docstring
+        attr, prefix, fileslug, size = match.groups()
+        if not prefix.startswith(script_root):
+            return match.group(0)
+        slug = prefix[len(script_root):].strip('/')
+        attachment = model.Attachment.findAttachment(slug, fileslug)
+        if attachment is None:
+            return match.group(0)
+        key = model.Attachment.hashPath(attachment.revisions[0].sha)
+        if size is None:
+            dest = os.path.join(output, slug, 'file', fileslug)
+            if not os.path.exists(dest):
+                _write_atomic(dest, src=lambda tmp: copy_blob(key, tmp))
+            return match.group(0)
+        relative = thumbnail_path(slug, fileslug, size)
+        dest = os.path.join(output, relative)
+        if not os.path.exists(dest):
+            thumbnail = uploads.thumbnail_path(key, int(size))
+            if not store.exists(thumbnail):
+                uploads.store_thumbnail(store, key, thumbnail, int(size))
+            _write_atomic(dest, src=lambda tmp: copy_blob(thumbnail, tmp))
+        return '%s="%s/%s"' % (attr, script_root, relative)
+
+    return ATTACHMENT_URL.sub(export_attachment, html)
+
+
+def _init_worker(config, state):
+    """Sets up the app in a freshly forked export process, along with the
+    state of the site that every page's dependencies are looked up in"""
+    global _WORKER_APP, _WORKER_STATE  # pylint: disable=global-statement
+    _WORKER_STATE = state
+    from spacewiki.app import create_app
+    _WORKER_APP = create_app(False)
+    _WORKER_APP.config.update(cPickle.loads(config))
+    # Export workers are already one per CPU, and have nobody to keep waiting
+    _WORKER_APP.config['OFFLOAD_POOL'] = None
+    if not _WORKER_APP.secret_key:
+        _WORKER_APP.secret_key = os.urandom(16)
+    with _WORKER_APP.app_context():
+        model.get_db()
+
+
+def export_page(job):
+    """Renders one page into the export. Returns the slug, the exported
+    revision id, and the state of everything it depended on."""
+    slug, output, base_url = job
+    app = _WORKER_APP
+    with app.test_request_context('/', base_url=base_url) as ctx:
+        model.get_db()
+        login_user(model.Identity.get_from_id('tripcode:Anonymous',
+                                              display='Anonymous',
+                                              handle='Anonymous'))
+        revision = model.Page.latestRevision(slug)
+        if revision is None:
+            return slug, None, {}
+        target = redirects.redirect_target(revision.body)
+        if target is not None:
+            url = ctx.request.script_root + '/' + \
+                model.SlugField.slugify(target) + '/'
+            html = REDIRECT_PAGE % {'url': escape(url)}
+            dependencies = set([slug])
+        else:
+            _, dependencies = revision.render()
+            dependencies |= structure_dependencies(slug)
+            html = render_template('page.html', revision=revision,
+                                   page=revision.page, redirectFrom=None,
+                                   missingIndex=False)
+            html = export_attachments(html, output, ctx.request.script_root)
+        html = html.encode('utf-8') if isinstance(html, unicode) else html
+        _write_atomic(page_path(output, slug), html)
+        if slug == app.config['INDEX_PAGE']:
+            _write_atomic(os.path.join(output, 'index.html'), html)
+    dependencies.add('attachments-of:' + slug)
+    return slug, revision.id, dict((key, _WORKER_STATE.get(key))
+                                   for key in dependencies)
+
+
+def _picklable_config(config):
+    ret = {}
+    for key, value in config.items():
+        try:
+            cPickle.dumps(value)
+        except Exception:  # pylint: disable=broad-except
+            continue
+        ret[key] = value
+    return cPickle.dumps(ret)
+
+
+def export_site(app, output, processes=None, incremental=False,
+                base_url='http://localhost/'):
+    """Renders the latest revision of every page into output with a pool of
+    processes. In incremental mode, only pages whose revision or
+    dependencies changed since the last export are rendered again. Returns
+    the number of pages rendered."""
+    manifest_path = os.path.join(output, MANIFEST)
+    manifest = {}
+    if incremental and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as fh:
+            exported = json.load(fh)
+        if exported.get('version') == MANIFEST_VERSION:
+            manifest = exported['pages']
+
+    with app.test_request_context('/'):
+        model.get_db()
+        state = site_state()
+        model.Identity.get_or_create_from_id('tripcode:Anonymous',
+                                             display='Anonymous',
+                                             handle='Anonymous')
+        model.DATABASE.close()
+
+    slugs = [slug for slug in state
+             if ':' not in slug and is_dirty(slug, state, manifest)]
+    for slug in set(manifest) - set(slug for slug in state if ':' not in slug):
+        logging.info("Removing %s", slug)
+        del manifest[slug]
+        if os.path.exists(page_path(output, slug)):
+            os.unlink(page_path(output, slug))
+
+    logging.info("Exporting %d of %d pages to %s", len(slugs),
+                 len([s for s in state if ':' not in s]), output)
+    start = time.time()
+    jobs = [(slug, output, base_url) for slug in sorted(slugs)]
+    config = _picklable_config(app.config)
+    if processes == 1:
+        _init_worker(config, state)
+        results = (export_page(job) for job in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (config, state))
+        results = pool.imap_unordered(export_page, jobs, chunksize=16)
+    try:
+        for count, (slug, revision_id, dependencies) in enumerate(results):
+            if revision_id is None:
+                manifest.pop(slug, None)
+            else:
+                manifest[slug] = {'revision': revision_id,
+                                  'dependencies': dependencies}
+            if count % 100 == 99:
+                logging.info("Exported %d pages, %.1f pages/s", count + 1,
+                             (count + 1) / (time.time() - start))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    static_output = os.path.join(output, 'static')
+    if os.path.exists(static_output):
+        shutil.rmtree(static_output)
+    shutil.copytree(app.static_folder, static_output)
+
+    _write_atomic(manifest_path, json.dumps({'version': MANIFEST_VERSION,
+                                             'pages': manifest},
+                                            indent=1, sort_keys=True))
+    return len(slugs)
@@ -0,0 +1,236 @@
+"""Bulk import of pages and their history"""
+
+import datetime
+import gzip
+import json
+import logging
+import os
+import tarfile
+import time
+# datetime.strptime imports this lazily, which races when threads call it
+# for the first time at once
+import _strptime  # pylint: disable=unused-import
+
+import peewee
+
+from spacewiki import cache, events, model, redirects
+from spacewiki.auth import tripcodes
+from spacewiki.wikiformat import markdown
+
+# SQLite refuses statements with more than 999 bound parameters
+MAX_PARAMETERS = 900
+
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                     '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+
+def parse_timestamp(value):
+    """Parses an ISO 8601 timestamp without a timezone"""
+    if value is None:
+        return datetime.datetime.now()
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Unparseable timestamp: %r" % (value,))
+
+
+def markdown_record(path, body, prefix=''):
+    """Turns a markdown file at a relative path into an import record"""
+    name = path.rsplit('.', 1)[0]
+    if prefix:
+        name = prefix.rstrip('/') + '/' + name
+    if isinstance(body, str):
+        body = body.decode('utf-8')
+    return {'slug': model.SlugField.slugify(name),
+            'title': name.split('/')[-1],
+            'body': body,
+            'message': 'Imported from %s' % (path,)}
+
+
+def read_directory(root, prefix=''):
+    """Yields a record for every markdown file under root"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if not fname.endswith('.md'):
+                continue
+            path = os.path.join(dirpath, fname)
+            with open(path, 'r') as fh:
+                yield markdown_record(os.path.relpath(path, root), fh.read(),
+                                      prefix)
+
+
+def read_jsonl(stream):
+    """Yields a record for every line of a JSONL dump. Each line is an object
+    with a slug and body, and optionally a title, message, author tripcode
+    and ISO 8601 timestamp. Several lines for the same slug are imported as
+    successive revisions."""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_tarball(path, prefix=''):
+    """Yields records from the markdown files and JSONL dumps in a tarball,
+    without extracting it"""
+    with tarfile.open(path, 'r|*') as tarball:
+        for member in tarball:
+            if not member.isfile():
+                continue
+            if member.name.endswith('.md'):
+                yield markdown_record(member.name,
+                                      tarball.extractfile(member).read(),
+                                      prefix)
+            elif member.name.endswith('.jsonl'):
+                for record in read_jsonl(tarball.extractfile(member)):
+                    yield record
+
+
+def read_source(path, prefix=''):
+    """Yields records from a directory, tarball or (gzipped) JSONL dump"""
+    if os.path.isdir(path):
+        return read_directory(path, prefix)
+    if path.endswith('.jsonl'):
+        return read_jsonl(open(path, 'r'))
+    if path.endswith('.jsonl.gz'):
+        return read_jsonl(gzip.open(path, 'r'))
+    return read_tarball(path, prefix)
+
+
+def chunked(rows, columns):
+    """Splits rows into chunks that stay under the bound parameter limit"""
+    size = max(1, MAX_PARAMETERS // columns)
+    for start in xrange(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+class BulkImporter(object):
+    """Imports records in large batches. Each batch resolves its authors and
+    pages with a handful of set-based queries and inserts its revisions with
+    insert_many inside a single transaction. Work that newRevision would
+    normally do per revision is deferred to finish(), which records the
+    links of every imported page from the records it already read."""
+
+    def __init__(self, batch_size=1000, default_author='Anonymous'):
+        self.batch_size = batch_size
+        self.default_author = default_author
+        self.identities = {}
+        self.pages = {}
+        self.imported_slugs = set()
+        # slug -> PageLink rows of its newest imported revision
+        self.links = {}
+        self.revision_count = 0
+        self.started = time.time()
+        self._batch = []
+
+    def add(self, record):
+        """Queues a record, importing the batch once it is full"""
+        self._batch.append(record)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def import_all(self, records):
+        """Imports every record from an iterable, then finishes up"""
+        for record in records:
+            self.add(record)
+        self.finish()
+
+    def _resolve_identities(self, tripcodes_wanted):
+        missing = dict(
+            (tripcodes.hash_tripcode(code), code)
+            for code in tripcodes_wanted if code not in self.identities)
+        if not missing:
+            return
+        hashed = missing.keys()
+        for chunk in chunked(hashed, 1):
+            for identity in model.Identity.select().where(
+                    model.Identity.auth_type == 'tripcode',
+                    model.Identity.auth_id << chunk):
+                self.identities[missing.pop(identity.auth_id)] = identity.id
+        rows = [{'auth_type': 'tripcode', 'auth_id': name,
+                 'display_name': name, 'handle': name} for name in missing]
+        for chunk in chunked(rows, 4):
+            model.Identity.insert_many(chunk).execute()
+        for chunk in chunked(missing.keys(), 1):
+            for identity in model.Identity.select().where(
+                    model.Identity.auth_type == 'tripcode',
+                    model.Identity.auth_id << chunk):
+                self.identities[missing[identity.auth_id]] = identity.id
+
+    def _resolve_pages(self, titles):
+        missing = [slug for slug in titles if slug not in self.pages]
+        if not missing:
+            return
+        for chunk in chunked(missing, 1):
+            for page_id, slug in model.Page.select(model.Page.id,
+                                                   model.Page.slug) \
+                    .where(model.Page.slug << chunk).tuples():
+                self.pages[slug] = page_id
+        rows = [{'slug': slug, 'title': titles[slug]}
+                for slug in missing if slug not in self.pages]
+        for chunk in chunked(rows, 2):
+            model.Page.insert_many(chunk).execute()
+        for chunk in chunked([row['slug'] for row in rows], 1):
+            for page_id, slug in model.Page.select(model.Page.id,
+                                                   model.Page.slug) \
+                    .where(model.Page.slug << chunk).tuples():
+                self.pages[slug] = page_id
+
+    def flush(self):
+        """Imports every queued record in one transaction"""
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        with model.DATABASE.transaction():
+            titles = {}
+            for record in batch:
+                if record['slug'] not in titles:
+                    titles[record['slug']] = record.get('title') or \
+                        model.SlugField.split_title(record['slug'])[1]
+            self._resolve_identities(set(
+                record.get('author') or self.default_author
+                for record in batch))
+            self._resolve_pages(titles)
+            rows = [{
+                'page': self.pages[record['slug']],
+                'body': record['body'],
+                'message': record.get('message') or '',
+                'timestamp': parse_timestamp(record.get('timestamp')),
+                'author': self.identities[record.get('author') or
+                                          self.default_author],
+            } for record in batch]
+            for chunk in chunked(rows, 5):
+                model.Revision.insert_many(chunk).execute()
+        self.imported_slugs.update(titles)
+        self.revision_count += len(batch)
+        latest = dict((record['slug'], record['body']) for record in batch)
+        for slug, body in latest.items():
+            self.links[slug] = model.PageLink.rows(
+                self.pages[slug], markdown.parse(body))
+        elapsed = time.time() - self.started
+        logging.info("Imported %d revisions of %d pages, %.1f revisions/s",
+                     self.revision_count, len(self.imported_slugs),
+                     self.revision_count / elapsed if elapsed else 0)
+
+    def finish(self):
+        """Imports any queued records, then catches up on the work that was
+        deferred while importing"""
+        self.flush()
+        page_ids = [self.pages[slug] for slug in sorted(self.links)]
+        rows = [row for slug in sorted(self.links) for row in self.links[slug]]
+        with model.DATABASE.transaction():
+            for chunk in chunked(page_ids, 1):
+                model.PageLink.delete() \
+                    .where(model.PageLink.src << chunk).execute()
+            for chunk in chunked(rows, 3):
+                model.PageLink.insert_many(chunk).execute()
+        self.links = {}
+        cache.render_cache().clear()
+        redirects.forget()
+        events.publish('all')
+        # Refresh the query planner's statistics now that the tables grew
+        if not isinstance(model.DATABASE.obj, peewee.MySQLDatabase):
+            model.DATABASE.execute_sql('ANALYZE')
@@ -1,3 +1,12 @@
+import cProfile
+import errno
+import os
+import random
+import time
+
+import werkzeug.exceptions
+
+
 class ReverseProxied(object):
     def __init__(self, app):
         self.app = app
@@ -7,3 +16,58 @@ class ReverseProxied(object):
         if scheme is not None:
             environ['wsgi.url_scheme'] = scheme
         return self.app(environ, start_response)
+
+
+class SamplingProfiler(object):
+    """Profiles a random sample of requests, plus any request that carries
+    the X-Spacewiki-Profile header with the configured secret, and dumps
+    pstats files to spool_dir/<endpoint>/"""
+    def __init__(self, app, url_map, spool_dir, rate=0.0, secret=None):
+        self.app = app
+        self.url_map = url_map
+        self.spool_dir = spool_dir
+        self.rate = rate
+        self.secret = secret
+
+    def should_profile(self, environ):
+        if self.secret and \
+           environ.get('HTTP_X_SPACEWIKI_PROFILE', None) == self.secret:
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+    def endpoint(self, environ):
+        try:
+            endpoint, _ = self.url_map.bind_to_environ(environ).match()
+        except werkzeug.exceptions.HTTPException:
+            endpoint = 'unrouted'
+        return endpoint
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.app(environ, start_response)
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            # Consume the body while profiling so streamed responses, like
+            # attachments, are measured too.
+            body = self.app(environ, start_response)
+            try:
+                chunks = list(body)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+        finally:
+            profiler.disable()
+            self.dump(profiler, self.endpoint(environ))
+        return chunks
+
+    def dump(self, profiler, endpoint):
+        route_dir = os.path.join(self.spool_dir, endpoint)
+        try:
+            os.makedirs(route_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        profiler.dump_stats(os.path.join(route_dir, '%f-%d.prof' % (
+            time.time(), os.getpid())))
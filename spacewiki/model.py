@@ -1,22 +1,27 @@
 """spacewiki database models"""
+import contextlib
 import crypt
 import difflib
 import datetime
-from flask import g, current_app, Blueprint
+from flask import g, current_app, Blueprint, has_app_context, request, \
+    session
 from flask_login import current_user, login_user, UserMixin, AnonymousUserMixin
 from flask_script import Manager
 import os
 import peewee
 import playhouse.migrate
-from playhouse.db_url import connect
-import shutil
 import slugify
+import time
 import traceback
 import urlparse
 import urllib
 import hashlib
+import mimetypes
+from PIL import Image
+from StringIO import StringIO
 
 import spacewiki
+from spacewiki.database import connect_database, connect_replica
 
 BLUEPRINT = Blueprint('model', __name__)
 
@@ -26,18 +31,89 @@ def get_db():
     """Sets up the database"""
     db = getattr(g, '_database', None)
     if db is None:
-        current_app.logger.info("Using database at %s", current_app.config['DATABASE_URL'])
-        g._database = db = connect(current_app.config['DATABASE_URL'])
+        g._database = db = connect_database()
     DATABASE.initialize(db)
 
 DATABASE = peewee.Proxy()
 
+# Blueprints whose GET requests may read from a replica
+REPLICA_BLUEPRINTS = ('pages', 'history', 'specials', 'uploads')
+
+# Session key holding when this user may go back to reading from replicas
+PRIMARY_UNTIL = '_primary_until'
+
+
+@BLUEPRINT.before_app_request
+def route_reads():
+    """Sends the SELECTs of read-only requests to a replica, unless the user
+    wrote something recently and might not see it there yet"""
+    g._read_database = None
+    if request.method not in ('GET', 'HEAD') or \
+       request.blueprint not in REPLICA_BLUEPRINTS:
+        return
+    if session.get(PRIMARY_UNTIL, 0) > time.time():
+        return
+    g._read_database = getattr(g, '_replica', None)
+    if g._read_database is None:
+        g._replica = g._read_database = connect_replica()
+
+
+@BLUEPRINT.after_app_request
+def stick_to_primary(response):
+    """Keeps a user who just wrote something reading from the primary until
+    the replicas have caught up"""
+    # Without a secret key there is no session to remember this in
+    if request.method not in ('GET', 'HEAD') and current_app.secret_key and \
+       current_app.config.get('DATABASE_REPLICA_URLS'):
+        session[PRIMARY_UNTIL] = time.time() + \
+            current_app.config.get('REPLICA_STICKY_SECONDS', 30)
+    return response
+
+
+@contextlib.contextmanager
+def use_primary():
+    """Reads from the primary for the duration of the block, for reads that
+    decide what gets written"""
+    if not has_app_context():
+        yield
+        return
+    previous = getattr(g, '_read_database', None)
+    g._read_database = None
+    try:
+        yield
+    finally:
+        g._read_database = previous
+
+
+def read_database():
+    """Returns the replica SELECTs should be sent to, or None for the
+    primary"""
+    if not has_app_context():
+        return None
+    return getattr(g, '_read_database', None)
+
 
 class BaseModel(peewee.Model):
     """Base class for SpaceWiki models, so all models share the same database"""
     class Meta:  # pylint: disable=missing-docstring,no-init,old-style-class,too-few-public-methods
         database = DATABASE
 
+    @classmethod
+    def select(cls, *args, **kwargs):
+        query = super(BaseModel, cls).select(*args, **kwargs)
+        replica = read_database()
+        if replica is not None:
+            query.database = replica
+        return query
+
+    @classmethod
+    def raw(cls, *args, **kwargs):
+        query = super(BaseModel, cls).raw(*args, **kwargs)
+        replica = read_database()
+        if replica is not None and query._sql.lower().startswith('select'):
+            query.database = replica
+        return query
+
 
 class SlugField(peewee.CharField):
     """Normalizes strings into a url-friendly 'slug'"""
@@ -70,9 +146,37 @@ class SlugField(peewee.CharField):
           return (subslug, title)
         return ('/'.join((slug, subslug)), title)
 
+
+class DeferredDescriptor(peewee.FieldDescriptor):
+    """Loads a field left out of the query that fetched an instance the
+    first time it is read"""
+
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self.field
+        if self.att_name not in instance._data:
+            model_class = type(instance)
+            pk = instance._get_pk_value()
+            if pk is None:
+                return None
+            instance._data[self.att_name] = model_class \
+                .select(self.field) \
+                .where(model_class._meta.primary_key == pk) \
+                .scalar(convert=True)
+        return instance._data[self.att_name]
+
+
+class DeferredTextField(peewee.TextField):
+    """A TextField that queries can leave out, to be loaded on demand"""
+
+    def add_to_class(self, model_class, name):
+        super(DeferredTextField, self).add_to_class(model_class, name)
+        setattr(model_class, name, DeferredDescriptor(self))
+
+
 class Page(BaseModel):
     """A wiki page"""
-    title = peewee.CharField(unique=False)
+    title = peewee.CharField(unique=False, index=True)
     slug = SlugField(unique=True)
 
     @staticmethod
@@ -102,8 +206,62 @@ class Page(BaseModel):
     def newRevision(self, body, message, author):
         """Creates a new Revision of this Page with the given body"""
         current_app.logger.debug("Creating new revision on %s", self.slug)
-        return Revision.create(page=self, body=body, message=message,
-                               author=author)
+        revision = Revision.create(page=self, body=body, message=message,
+                                   author=author)
+        self.updateLinks(body, revision)
+        redirects = spacewiki.redirects.indexed()
+        if redirects is not None:
+            redirects.set(self.slug, spacewiki.redirects.redirect_target(body))
+        spacewiki.prerender.page_changed(self.slug, revision)
+        spacewiki.events.page_changed(self.slug)
+        return revision
+
+    def updateLinks(self, body, revision=None):
+        """Replaces the links recorded from this page with the ones in body.
+        Pass the revision body belongs to, if any, to reuse its parse."""
+        if revision is None:
+            document = spacewiki.wikiformat.markdown.parse(body)
+        else:
+            document = spacewiki.wikiformat.parsed(revision)
+        rows = PageLink.rows(self.id, document)
+        PageLink.delete().where(PageLink.src == self).execute()
+        # Three parameters a row, staying under SQLite's limit of 999
+        for start in xrange(0, len(rows), 300):
+            PageLink.insert_many(rows[start:start + 300]).execute()
+
+    @property
+    def backlinks(self):
+        """Pages that link to this one, by title"""
+        return Page.select() \
+            .join(PageLink, on=PageLink.src) \
+            .where(PageLink.dest_slug == self.slug,
+                   PageLink.kind == PageLink.LINK) \
+            .order_by(Page.title)
+
+    @classmethod
+    def orphaned(cls):
+        """Pages that no other page links to"""
+        return cls.select() \
+            .join(PageLink, peewee.JOIN.LEFT_OUTER,
+                  on=((PageLink.dest_slug == cls.slug) &
+                      (PageLink.kind == PageLink.LINK))) \
+            .where(PageLink.id >> None,
+                   cls.slug != current_app.config['INDEX_PAGE']) \
+            .order_by(cls.title)
+
+    @classmethod
+    def wanted(cls):
+        """Slugs that are linked to but don't exist, with how many pages link
+        to each, most wanted first"""
+        return PageLink.select(PageLink.dest_slug,
+                               peewee.fn.Count(PageLink.id).alias('count')) \
+            .join(cls, peewee.JOIN.LEFT_OUTER,
+                  on=(PageLink.dest_slug == cls.slug)) \
+            .where(cls.id >> None, PageLink.kind == PageLink.LINK) \
+            .group_by(PageLink.dest_slug) \
+            .order_by(peewee.fn.Count(PageLink.id).desc(),
+                      PageLink.dest_slug) \
+            .tuples()
 
     def makeSoftlinkFrom(self, prev):
         current_app.logger.debug("Linking from %s to %s", prev.slug, self.slug)
@@ -113,7 +271,8 @@ class Page(BaseModel):
             return
 
         try:
-            Softlink.get(Softlink.src == prev, Softlink.dest == self)
+            with use_primary():
+                Softlink.get(Softlink.src == prev, Softlink.dest == self)
             current_app.logger.debug("Link exists!")
         except peewee.DoesNotExist:
             Softlink.create(src=prev, dest=self)
@@ -122,22 +281,29 @@ class Page(BaseModel):
         Softlink.update(hits=Softlink.hits + 1) \
                 .where(Softlink.src == prev, Softlink.dest == self) \
                 .execute()
+        titles = spacewiki.typeahead.indexed()
+        if titles is not None:
+            titles.hit(self.slug)
 
-    def attachUpload(self, src, filename, uploadPath):
+    def attachUpload(self, src, filename):
         assert isinstance(src, basestring)
         assert isinstance(filename, basestring)
-        assert isinstance(uploadPath, basestring)
 
-        current_app.logger.info("Attaching upload %s (%s), saved at %s",
-                     src, filename, uploadPath)
+        current_app.logger.info("Attaching upload %s (%s)", src, filename)
 
         hex_sha = Attachment.hashFile(src)
-        saved_name = os.path.join(uploadPath,
-                                 Attachment.hashPath(hex_sha, filename))
-
-        if not os.path.exists(os.path.dirname(saved_name)):
-            os.makedirs(os.path.dirname(saved_name))
-        shutil.move(src, saved_name)
+        size = Attachment.imageSize(src)
+        saved_name = Attachment.hashPath(hex_sha)
+        store = spacewiki.storage.blob_store()
+
+        if store.exists(saved_name):
+            current_app.logger.debug("Already stored %s", hex_sha)
+            # Keeps uploads gc from sweeping it before the revision below
+            # that references it is committed
+            store.touch(saved_name)
+            os.remove(src)
+        else:
+            store.put_file(saved_name, src)
 
         # FIXME: These db queries should be handled by the model
         try:
@@ -153,20 +319,41 @@ class Page(BaseModel):
             current_app.logger.debug("Duplicate file upload: %s", attachment.slug)
         except peewee.DoesNotExist:
             AttachmentRevision.create(attachment=attachment, sha=hex_sha)
+            attachment.width, attachment.height = size or (None, None)
+            attachment.save()
             current_app.logger.debug("New upload: %s -> %s", attachment.slug, hex_sha)
 
         current_app.logger.info("Uploaded file %s to %s", filename, saved_name)
+        return attachment
 
     @classmethod
-    def latestRevision(cls, slug):
+    def latestRevision(cls, slug, body=True):
+        """Returns the latest revision of the page at slug, or None. Unless
+        body is set, the body is only loaded if it is read."""
+        query = Revision.select() if body else Revision.without_body()
         try:
-            return Revision.select() \
+            return query \
                 .join(cls) \
                 .where(cls.slug == slug) \
                 .order_by(Revision.id.desc())[0]  # pylint: disable=no-member
         except IndexError:
             return None
 
+    def history(self):
+        """Returns every revision of this page, oldest first, with its author
+        but without its body, each knowing the one before it"""
+        revisions = list(
+            Revision.without_body(Identity)
+            .join(Identity)
+            .where(Revision.page == self)
+            .order_by(Revision.id))
+        prev = None
+        for revision in revisions:
+            revision.page = self
+            revision._prev = prev  # pylint: disable=protected-access
+            prev = revision
+        return revisions
+
     @property
     def subpages(self):
         return Page.select().where(peewee.fn.Substr(Page.slug, 1,
@@ -213,6 +400,38 @@ class Softlink(BaseModel):
     dest = peewee.ForeignKeyField(Page, related_name='softlinks_in')
     hits = peewee.IntegerField(default=0)
 
+    class Meta:  # pylint: disable=missing-docstring,no-init,old-style-class,too-few-public-methods
+        indexes = (
+            (('src', 'dest'), False),
+        )
+
+class PageLink(BaseModel):
+    """A [[link]] or {{include}} in the latest revision of a page, to a page
+    that might not exist yet"""
+    LINK = 'link'
+    INCLUDE = 'include'
+
+    src = peewee.ForeignKeyField(Page, related_name='links_out')
+    dest_slug = SlugField(index=True)
+    kind = peewee.CharField(default=LINK)
+
+    class Meta:  # pylint: disable=missing-docstring,no-init,old-style-class,too-few-public-methods
+        indexes = (
+            (('src', 'dest_slug', 'kind'), True),
+        )
+
+    @classmethod
+    def rows(cls, src_id, document):
+        """Returns the rows to insert for the links and includes of a parsed
+        page"""
+        rows = [{'src': src_id, 'dest_slug': slug, 'kind': cls.LINK}
+                for slug in sorted(
+                    spacewiki.wikiformat.links.in_document(document))]
+        rows += [{'src': src_id, 'dest_slug': slug, 'kind': cls.INCLUDE}
+                 for slug in sorted(
+                     spacewiki.wikiformat.directives.includes(document))]
+        return rows
+
 class Identity(BaseModel, UserMixin):
     """An identity in the wiki"""
     display_name = peewee.CharField()
@@ -220,6 +439,11 @@ class Identity(BaseModel, UserMixin):
     auth_id = peewee.CharField()
     auth_type = peewee.CharField()
 
+    class Meta:  # pylint: disable=missing-docstring,no-init,old-style-class,too-few-public-methods
+        indexes = (
+            (('auth_type', 'auth_id'), False),
+        )
+
     def __repr__(self):
         return "Identity(%s, %s)"%(self.id, self.get_id())
 
@@ -238,7 +462,10 @@ class Identity(BaseModel, UserMixin):
     def get_from_id(user_id, display=None, handle=None):
         provider, id = user_id.split(':', 1)
         try:
-            ret = Identity.get(auth_type=provider, auth_id=id)
+            # Identities are created on demand, so a replica that hasn't
+            # caught up would lead to duplicates
+            with use_primary():
+                ret = Identity.get(auth_type=provider, auth_id=id)
             return ret
         except:
             ret = Identity(auth_type=provider, auth_id=id)
@@ -251,96 +478,136 @@ class Identity(BaseModel, UserMixin):
     @staticmethod
     def get_or_create_from_id(*args, **kwargs):
         ret = Identity.get_from_id(*args, **kwargs)
-        ret.save()
+        if ret.is_dirty():
+            ret.save()
         return ret
 
 class Revision(BaseModel):
     """A page revision"""
     page = peewee.ForeignKeyField(Page, related_name='revisions')
-    body = peewee.TextField()
+    body = DeferredTextField()
     message = peewee.TextField(default='')
-    timestamp = peewee.DateTimeField(default=datetime.datetime.now)
+    timestamp = peewee.DateTimeField(default=datetime.datetime.now,
+                                     index=True)
     author = peewee.ForeignKeyField(Identity, related_name='revisions')
 
+    class Meta:  # pylint: disable=missing-docstring,no-init,old-style-class,too-few-public-methods
+        indexes = (
+            (('page', 'id'), False),
+        )
+
+    @classmethod
+    def without_body(cls, *selection):
+        """Selects revisions, and anything else in selection, without their
+        bodies, which are loaded one at a time if they are read"""
+        fields = [field for field in cls._meta.sorted_fields
+                  if field is not cls.body]
+        return cls.select(*(fields + list(selection)))
+
     @property
     def summary(self):
         return self.body[0:500]
 
     @staticmethod
-    def render_text(body, slug):
-        """Renders a string of wiki text as HTML"""
+    def render_text(body, slug, resolver=None, revision=None):
+        """Renders a string of wiki text as HTML. Pass the revision body
+        belongs to, if any, to reuse its parse."""
         try:
-            return spacewiki.wikiformat.render_wikitext(body, slug)
+            return spacewiki.wikiformat.render_wikitext(body, slug, resolver,
+                                                        revision)
         except Exception:  # pylint: disable=broad-except
             return "Error in processing wikitext:" + \
                 "<pre>" + \
                 traceback.format_exc() + \
                 "</pre>"
 
+    def render(self):
+        """Renders this revision into the render cache, unless it was read
+        from a replica, returning the HTML and the set of slugs the
+        rendering depended on"""
+        renders = spacewiki.cache.render_cache()
+        # Taken first, so a page changing mid-render keeps it out of the cache
+        generation = renders.generation()
+        slug = self.page.slug  # pylint: disable=no-member
+        resolver = spacewiki.wikiformat.Resolver()
+        html = self.render_text(self.body, slug, resolver, self)
+        dependencies = resolver.dependencies | set([slug])
+        # A replica may not have caught up with what invalidated the cache
+        if not resolver.partial and read_database() is None:
+            renders.put(self.id, html, dependencies, generation)
+        return html, dependencies
+
     @property
     def html(self):
-        """Renders this revision's body (which is wikitext) as HTML"""
-        return self.render_text(self.body,
-                                self.page.slug)  # pylint: disable=no-member
+        """Renders this revision's body (which is wikitext) as HTML, using the
+        render cache when possible"""
+        html = spacewiki.cache.render_cache().get(self.id)
+        if html is None:
+            html, _ = self.render()
+        return html
 
     @property
     def is_latest(self):
         """Returns True if this is the latest revision of a page, false
         otherwise"""
-        return Page.latestRevision(self.page.slug) == self  # pylint: disable=no-member
+        return not Revision.select(Revision.id) \
+            .where(Revision.page == self.page_id, Revision.id > self.id) \
+            .exists()
 
     @property
     def prev(self):
-        """Returns the previous revision if there is one, None otherwise"""
+        """Returns the previous revision if there is one, None otherwise.
+        Its body is only loaded if it is read."""
+        prev = getattr(self, '_prev', False)
+        if prev is not False:
+            return prev
         try:
-            return Revision.select() \
-                           .where(Revision.page == self.page,
+            prev = Revision.without_body() \
+                           .where(Revision.page == self.page_id,
                                   Revision.id < self.id) \
                            .order_by(Revision.id.desc()) \
                            .limit(1)[0]
         except IndexError:
-            return None
+            prev = None
+        # Revisions are only ever added after the latest one
+        self._prev = prev  # pylint: disable=attribute-defined-outside-init
+        return prev
 
     @classmethod
     def _makeDiff(cls, r1, r2):
         if r1 is None:
-            diff = difflib.unified_diff("",
-                                        r2.body.split("\n"),
-                                        lineterm="",
-                                        fromfile="%s@%s" % (r2.page.slug, 0),
-                                        tofile="%s@%s" % (r2.page.slug, r2.id))
+            names = ("%s@%s" % (r2.page.slug, 0),
+                     "%s@%s" % (r2.page.slug, r2.id))
         elif r2 is None:
-            diff = difflib.unified_diff(r1.body.split("\n"),
-                                        "",
-                                        lineterm="",
-                                        fromfile="%s@%s" % (
-                                            r1.page.slug,
-                                            r1.id),
-                                        tofile="%s@%s" % (r1.page.slug, 0))
+            names = ("%s@%s" % (r1.page.slug, r1.id),
+                     "%s@%s" % (r1.page.slug, 0))
         else:
-            diff = difflib.unified_diff(r1.body.split("\n"),
-                                        r2.body.split("\n"),
-                                        lineterm="",
-                                        fromfile="%s@%s" % (
-                                            r1.page.slug,
-                                            r1.id),
-                                        tofile="%s@%s" % (r2.page.slug, r2.id))
-        return cls._parseDiff(diff)
-
-    @staticmethod
-    def _parseDiff(diff):
-        ret = []
-        for line in diff:
-            if line.startswith('+++') or line.startswith('---'):
-                line_type = 'meta'
-            elif line.startswith('@@'):
-                line_type = 'context'
-            elif line.startswith('+'):
-                line_type = 'addition'
-            elif line.startswith('-'):
-                line_type = 'subtraction'
-            ret.append({'contents': line, 'type': line_type})
-        return ret
+            names = ("%s@%s" % (r1.page.slug, r1.id),
+                     "%s@%s" % (r2.page.slug, r2.id))
+        cache = spacewiki.cache.diff_cache()
+        key = (r1.id if r1 else 0, r2.id if r2 else 0)
+        if cache is not None:
+            hunks = cache.get_diff(*key)
+            if hunks is not None:
+                # The ---/+++ header is left out of the cache, as it names
+                # the page, which may since have moved
+                return parse_diff(["--- " + names[0], "+++ " + names[1]]) + \
+                    hunks if hunks else []
+        # Only read the bodies once the cache has missed
+        args = (r1.body.split("\n") if r1 else "",
+                r2.body.split("\n") if r2 else "") + names
+        if len(args[0]) + len(args[1]) < spacewiki.offload.SMALL_LINES:
+            diff = diff_lines(*args)
+        else:
+            try:
+                diff = spacewiki.offload.run('diff', diff_lines, *args)
+            except spacewiki.offload.TaskTimeout:
+                return [{'contents':
+                         "These revisions differ too much to compare",
+                         'type': 'meta'}]
+        if cache is not None:
+            cache.put_diff(key[0], key[1], diff[2:])
+        return diff
 
     def diffTo(self, prev):
         return self._makeDiff(self, prev)
@@ -374,10 +641,11 @@ class Revision(BaseModel):
 
     @property
     def next(self):
-        """Returns the next revision if one exists, None otherwise"""
+        """Returns the next revision if one exists, None otherwise. Its body
+        is only loaded if it is read."""
         try:
-            return Revision.select() \
-                           .where(Revision.page == self.page,
+            return Revision.without_body() \
+                           .where(Revision.page == self.page_id,
                                   Revision.id > self.id) \
                            .order_by(Revision.id) \
                            .limit(1)[0]
@@ -385,11 +653,37 @@ class Revision(BaseModel):
             return None
 
 
+def parse_diff(diff):
+    """Classifies each line of a unified diff"""
+    ret = []
+    for line in diff:
+        if line.startswith('+++') or line.startswith('---'):
+            line_type = 'meta'
+        elif line.startswith('@@'):
+            line_type = 'context'
+        elif line.startswith('+'):
+            line_type = 'addition'
+        elif line.startswith('-'):
+            line_type = 'subtraction'
+        ret.append({'contents': line, 'type': line_type})
+    return ret
+
+
+def diff_lines(old, new, fromfile, tofile):
+    """Diffs two lists of lines, returning parse_diff's classified lines.
+    Needs nothing but its arguments, so it can run in a separate process."""
+    return parse_diff(difflib.unified_diff(old, new, lineterm="",
+                                           fromfile=fromfile, tofile=tofile))
+
+
 class Attachment(BaseModel):
     """A file attached to a page"""
     page = peewee.ForeignKeyField(Page, related_name='attachments')
     filename = peewee.CharField(unique=True)
     slug = SlugField(unique=True)
+    # Of the latest upload, if it is an image
+    width = peewee.IntegerField(null=True)
+    height = peewee.IntegerField(null=True)
 
     @staticmethod
     def hashFile(src):
@@ -399,20 +693,36 @@ class Attachment(BaseModel):
         return sha.hexdigest()
 
     @staticmethod
-    def hashPath(sha, src):
+    def hashPath(sha):
+        """Where a blob lives in the upload store. Blobs are named by their
+        content alone, so identical uploads share one file and the filename
+        is only kept in the database."""
+        return "%s/%s/%s" % (sha[0:2], sha[2:4], sha)
+
+    @staticmethod
+    def legacyHashPath(sha, src):
+        """Where uploads were stored before blobs were named by content
+        alone"""
         return "%s/%s/%s-%s" % (sha[0:2], sha[2:4], sha, src)
 
-    @classmethod
-    def findAttachment(cls, pageSlug, fileSlug):
+    @staticmethod
+    def imageSize(src):
+        """Returns the width and height of the image in the file src, or
+        None if it isn't an image"""
         try:
-            Page.get(slug=pageSlug)
-        except peewee.DoesNotExist:
+            return Image.open(src).size
+        except IOError:
             return None
+
+    @classmethod
+    def findAttachment(cls, pageSlug, fileSlug):
+        """Returns the attachment fileSlug of the page at pageSlug, or
+        None"""
         try:
-            attachment = Attachment.get(slug=fileSlug)
+            return cls.select().join(Page) \
+                .where(Page.slug == pageSlug, cls.slug == fileSlug).get()
         except peewee.DoesNotExist:
             return None
-        return attachment
 
     class Meta:  # pylint: disable=missing-docstring,no-init,old-style-class,too-few-public-methods
         indexes = (
@@ -448,7 +758,7 @@ def syncdb():
         get_db()
         current_app.logger.info("Creating tables")
         DATABASE.create_tables([Page, Revision, Softlink, Attachment,
-            AttachmentRevision, DatabaseVersion, Identity], True)
+            AttachmentRevision, DatabaseVersion, Identity, PageLink], True)
 
         start_version = 0
         initial_schema = False
@@ -498,18 +808,123 @@ def migrate_identities(migrator):
         migrator.drop_column('revision', 'tripcode')
     )
 
+def add_lookup_indexes(migrator):
+    playhouse.migrate.migrate(
+        migrator.add_index('revision', ('page_id', 'id'), False),
+        migrator.add_index('revision', ('timestamp',), False),
+        migrator.add_index('softlink', ('src_id', 'dest_id'), False),
+        migrator.add_index('identity', ('auth_type', 'auth_id'), False),
+        migrator.add_index('page', ('title',), False),
+    )
+
+def record_page_links(migrator):  # pylint: disable=unused-argument
+    current_app.logger.info("Recording links between pages")
+    for page in Page.select():
+        revision = Page.latestRevision(page.slug)
+        if revision is not None:
+            page.updateLinks(revision.body)
+
+def content_address_uploads(migrator):  # pylint: disable=unused-argument
+    upload_path = current_app.config.get('UPLOAD_PATH')
+    if upload_path is None or not os.path.exists(upload_path):
+        return
+    current_app.logger.info("Renaming uploads in %s by content", upload_path)
+    uploads = AttachmentRevision.select(AttachmentRevision.sha,
+                                        Attachment.filename) \
+        .join(Attachment) \
+        .tuples()
+    for sha, filename in uploads:
+        legacy = os.path.join(upload_path,
+                              Attachment.legacyHashPath(sha, filename))
+        saved_name = os.path.join(upload_path, Attachment.hashPath(sha))
+        if not os.path.exists(legacy):
+            continue
+        if os.path.exists(saved_name):
+            os.remove(legacy)
+        else:
+            os.rename(legacy, saved_name)
+    # Thumbnails of the old names are regenerated on demand, and swept up by
+    # uploads gc
+
+# Enough of the start of a file for PIL to find the size of any common image
+IMAGE_HEADER_BYTES = 256 * 1024
+
+def record_image_sizes(migrator):
+    columns = [column.name for column in DATABASE.get_columns('attachment')]
+    for name in ('width', 'height'):
+        if name not in columns:
+            playhouse.migrate.migrate(migrator.add_column(
+                'attachment', name, peewee.IntegerField(null=True)))
+    # Reading the images takes a while, too long to hold a transaction open
+    return fill_image_sizes
+
+def fill_image_sizes():
+    """Records the size of attached images that have none, reading only the
+    start of each file"""
+    attachments = [attachment for attachment in
+                   Attachment.select().where(Attachment.width >> None)
+                   if (mimetypes.guess_type(attachment.filename)[0] or '')
+                   .startswith('image/')]
+    if not attachments:
+        return
+    current_app.logger.info("Recording the size of %d attached images",
+                            len(attachments))
+    store = spacewiki.storage.blob_store()
+    for attachment in attachments:
+        latest = attachment.revisions.first()
+        key = Attachment.hashPath(latest.sha) if latest else None
+        if key is None or not store.exists(key):
+            continue
+        src = store.open(key)
+        try:
+            # Not every store's files can seek
+            size = Attachment.imageSize(StringIO(src.read(IMAGE_HEADER_BYTES)))
+        finally:
+            src.close()
+        if size is not None:
+            Attachment.update(width=size[0], height=size[1]) \
+                .where(Attachment.id == attachment.id).execute()
+
+def record_includes(migrator):
+    columns = [column.name for column in DATABASE.get_columns('pagelink')]
+    if 'kind' not in columns:
+        playhouse.migrate.migrate(
+            migrator.add_column('pagelink', 'kind',
+                                peewee.CharField(default=PageLink.LINK)),
+            migrator.drop_index('pagelink', 'pagelink_src_id_dest_slug'),
+            migrator.add_index('pagelink', ('src_id', 'dest_slug', 'kind'),
+                               True),
+        )
+    record_page_links(migrator)
+
 MIGRATIONS = (
     migrate_identities,
+    add_lookup_indexes,
+    record_page_links,
+    content_address_uploads,
+    record_image_sizes,
+    record_includes,
 )
 
-def run_migrations(current_revision):
-    """Runs migrations starting at current_revision"""
-    migrator = playhouse.migrate.SqliteMigrator(DATABASE)
+def get_migrator():
+    """Returns a schema migrator for the current database"""
+    if isinstance(DATABASE.obj, peewee.PostgresqlDatabase):
+        return playhouse.migrate.PostgresqlMigrator(DATABASE.obj)
+    if isinstance(DATABASE.obj, peewee.MySQLDatabase):
+        return playhouse.migrate.MySQLMigrator(DATABASE.obj)
+    return playhouse.migrate.SqliteMigrator(DATABASE.obj)
 
-    for migration in MIGRATIONS[current_revision:]:
-        with DATABASE.transaction():
-            current_app.logger.info("Applying migration %d -> %d", current_revision,
-                    current_revision+1)
-            migration(migrator)
-
-    current_app.logger.info("Upgraded to schema %s", current_revision)
+def run_migrations(current_revision):
+    """Runs the migration from current_revision to the next one. A migration
+    may return a function to finish its work once the schema change has
+    been committed."""
+    migrator = get_migrator()
+
+    with DATABASE.transaction():
+        current_app.logger.info("Applying migration %d -> %d", current_revision,
+                current_revision+1)
+        finish = MIGRATIONS[current_revision](migrator)
+    if finish is not None:
+        finish()
+
+    current_app.logger.info("Upgraded to schema %s", current_revision+1)
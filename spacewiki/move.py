@@ -0,0 +1,183 @@
+"""Moves a page and every page beneath it to a new slug
+
+The slugs of the whole subtree are rewritten by a single UPDATE, inside one
+transaction that also leaves #Redirect stubs at the old slugs and rewrites
+the links and includes of pages that pointed into the subtree, if asked to.
+Pages that link into or include from the subtree are found through the
+PageLink table rather than by searching every revision."""
+
+import collections
+import logging
+
+import peewee
+
+from spacewiki import events, model, prerender, typeahead
+from spacewiki.auth import tripcodes
+from spacewiki.importer import chunked
+from spacewiki.redirects import forget as forget_redirects
+from spacewiki.wikiformat import directives, links
+
+Moved = collections.namedtuple('Moved',
+                               'pages redirects referrers rewritten')
+
+
+class MoveCollision(ValueError):
+    """Raised when pages already exist where a subtree would be moved to"""
+
+    def __init__(self, slugs):
+        super(MoveCollision, self).__init__(
+            "Pages already exist at %s" % (', '.join(slugs),))
+        self.slugs = slugs
+
+
+def in_subtree(field, slug):
+    """Matches slug and every slug beneath it, by prefix as Page.subpages
+    does. A range between slug + '/' and slug + '0' would use the index, but
+    only holds under bytewise collation."""
+    return (field == slug) | \
+        (peewee.fn.Substr(field, 1, len(slug) + 1) == slug + '/')
+
+
+def moved_slug(field, old_slug, new_slug):
+    """An expression for where a slug in the subtree at old_slug ends up"""
+    rest = peewee.fn.Substr(field, len(old_slug) + 1)
+    if isinstance(model.DATABASE.obj, peewee.MySQLDatabase):
+        return peewee.fn.CONCAT(new_slug, rest)
+    return peewee.Param(new_slug).concat(rest)
+
+
+def subtree_target(old_slug, new_slug):
+    """Returns a function giving the new slug of any slug in the subtree at
+    old_slug, or None for slugs outside it"""
+    def target(slug):  # pylint: disable=missing-docstring
+        if slug == old_slug or slug.startswith(old_slug + '/'):
+            return new_slug + slug[len(old_slug):]
+        return None
+    return target
+
+
+def collisions(old_slug, new_slug):
+    """Returns the slugs in the way of moving old_slug to new_slug"""
+    moving = model.Page.alias()
+    return [slug for (slug,) in model.Page.select(model.Page.slug)
+            .where(model.Page.slug << moving.select(
+                moved_slug(moving.slug, old_slug, new_slug))
+                   .where(in_subtree(moving.slug, old_slug)))
+            .order_by(model.Page.slug)
+            .tuples()]
+
+
+def _leave_redirects(pages, target, author):
+    rows = [{'slug': slug, 'title': title} for _, slug, title in pages]
+    for chunk in chunked(rows, 2):
+        model.Page.insert_many(chunk).execute()
+    revisions = []
+    for chunk in chunked([row['slug'] for row in rows], 1):
+        for page_id, slug in model.Page.select(model.Page.id,
+                                               model.Page.slug) \
+                .where(model.Page.slug << chunk).tuples():
+            revisions.append({'page': page_id,
+                              'body': '#Redirect ' + target(slug),
+                              'message': 'Moved to ' + target(slug),
+                              'author': author.id})
+    for chunk in chunked(revisions, 4):
+        model.Revision.insert_many(chunk).execute()
+
+
+def _rewrite_referrers(referrers, target, author):
+    rewritten = []
+    for page in referrers:
+        revision = model.Page.latestRevision(page.slug)
+        if revision is None:
+            continue
+        body = links.rewrite(directives.rewrite(revision.body, target), target)
+        if body == revision.body:
+            continue
+        rewritten.append(model.Revision.create(
+            page=page, body=body, author=author,
+            message='Updated links to moved pages'))
+        page.updateLinks(body)
+    return rewritten
+
+
+def move_subtree(old_slug, new_slug, author, redirects=False,
+                 rewrite_links=False):
+    """Moves the page at old_slug and every page beneath it to new_slug.
+    Leaves #Redirect stubs behind if redirects is set, and updates the links
+    and includes of referring pages if rewrite_links is set. Returns a Moved
+    of the (id, old slug, title) of every moved page, the number of
+    redirects left, the referring pages and the revisions that rewrote
+    them."""
+    if new_slug == old_slug:
+        return Moved([], 0, [], [])
+    if new_slug.startswith(old_slug + '/'):
+        raise ValueError("Cannot move %s beneath itself" % (old_slug,))
+    target = subtree_target(old_slug, new_slug)
+    with model.use_primary(), model.DATABASE.transaction():
+        in_the_way = collisions(old_slug, new_slug)
+        if in_the_way:
+            raise MoveCollision(in_the_way)
+        pages = list(model.Page.select(model.Page.id, model.Page.slug,
+                                       model.Page.title)
+                     .where(in_subtree(model.Page.slug, old_slug))
+                     .order_by(model.Page.slug)
+                     .tuples())
+        moved_ids = set(page_id for page_id, _, _ in pages)
+        referrers = [page for page in model.Page.select()
+                     .join(model.PageLink, on=model.PageLink.src)
+                     .where(in_subtree(model.PageLink.dest_slug, old_slug))
+                     .distinct()
+                     .order_by(model.Page.slug)]
+        model.Page.update(slug=moved_slug(model.Page.slug, old_slug,
+                                          new_slug)) \
+            .where(in_subtree(model.Page.slug, old_slug)) \
+            .execute()
+        for page in referrers:
+            if page.id in moved_ids:
+                page.slug = target(page.slug)
+        if redirects:
+            _leave_redirects(pages, target, author)
+        rewritten = []
+        if rewrite_links:
+            rewritten = _rewrite_referrers(referrers, target, author)
+
+    for _, slug, _ in pages:
+        prerender.page_changed(slug)
+        prerender.page_changed(target(slug))
+        events.page_changed(slug)
+        events.page_changed(target(slug))
+    for revision in rewritten:
+        prerender.page_changed(revision.page.slug, revision)
+        events.page_changed(revision.page.slug)
+    forget_redirects()
+    titles = typeahead.indexed()
+    if titles is not None:
+        for _, slug, title in pages:
+            titles.rename(slug, target(slug), title)
+            if redirects:
+                titles.add(slug, title)
+    logging.info("Moved %d pages from %s to %s", len(pages), old_slug,
+                 new_slug)
+    return Moved(pages, len(pages) if redirects else 0, referrers, rewritten)
+
+
+@model.MANAGER.option('old_slug', help="Page to move, along with its subpages")
+@model.MANAGER.option('new_slug', help="Where to move it to")
+@model.MANAGER.option('--redirect', dest='redirects', default=False,
+                      action='store_true',
+                      help="Leave redirects at the old slugs")
+@model.MANAGER.option('--rewrite-links', dest='rewrite_links', default=False,
+                      action='store_true',
+                      help="Point links to the moved pages at their new slugs")
+def move(old_slug, new_slug, redirects, rewrite_links):
+    """Moves a page and every page beneath it"""
+    model.get_db()
+    moved = move_subtree(old_slug, new_slug, tripcodes.new_anon_user(),
+                         redirects, rewrite_links)
+    print "Moved %d pages" % (len(moved.pages),)
+    if rewrite_links:
+        print "Rewrote links on %d pages" % (len(moved.rewritten),)
+    elif moved.referrers:
+        print "Pages linking to the old slugs:"
+        for page in moved.referrers:
+            print "    " + page.slug
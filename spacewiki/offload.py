@@ -0,0 +1,129 @@
+"""Runs CPU heavy work in a pool, off the thread serving requests
+
+The gevent server runs every request on one thread, so rendering markdown,
+sanitizing HTML, diffing revisions or scaling images there stalls every other
+connection until it is done. run() hands such work to a pool of
+OFFLOAD_WORKERS threads or processes, picked by OFFLOAD_POOL, and waits for it
+in a way that lets the gevent hub keep serving. Processes sidestep the GIL,
+but can only be given picklable, module level functions and arguments.
+
+By default a pre-forked server's workers split the CPUs between their pools,
+rather than each starting one per CPU.
+
+Each kind of task has a budget in OFFLOAD_BUDGETS. A task that runs over
+raises TaskTimeout, and callers answer with a cheaper fallback. It keeps
+running in the pool all the same, so once OFFLOAD_BACKLOG tasks are queued
+or running, new ones raise TaskTimeout at once instead of piling up."""
+
+import atexit
+from flask import current_app
+import multiprocessing
+import multiprocessing.pool
+import sys
+import threading
+
+# Work smaller than this is quicker done than handed to the pool
+SMALL_TEXT = 4096
+SMALL_LINES = 200
+
+_LOCK = threading.Lock()
+
+
+class TaskTimeout(Exception):
+    """Raised when a task runs over its budget, or the pool is too far
+    behind to start it in time"""
+
+
+class TaskPool(object):
+    """A pool of threads or processes that holds at most backlog tasks
+    queued or running"""
+
+    def __init__(self, kind, workers, backlog):
+        if kind == 'process':
+            self.pool = multiprocessing.Pool(workers)
+        elif kind == 'thread':
+            self.pool = multiprocessing.pool.ThreadPool(workers)
+        else:
+            raise ValueError("Unknown OFFLOAD_POOL %r" % (kind,))
+        self.backlog = backlog
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, args):
+        """Queues func(*args), returning its AsyncResult, or raises
+        TaskTimeout if the backlog is full"""
+        with self._lock:
+            self._pending = [result for result in self._pending
+                             if not result.ready()]
+            if len(self._pending) >= self.backlog:
+                raise TaskTimeout()
+            result = self.pool.apply_async(func, args)
+            self._pending.append(result)
+            return result
+
+    def terminate(self):
+        """Stops the workers, abandoning their tasks"""
+        self.pool.terminate()
+
+
+def default_workers(config):
+    """Returns how many workers a pool gets if OFFLOAD_WORKERS doesn't say:
+    this process's share of the CPUs"""
+    return max(1, multiprocessing.cpu_count() //
+               max(1, config.get('SERVER_WORKERS') or 1))
+
+
+def task_pool():
+    """Returns the pool for the current app, or None to run tasks inline"""
+    kind = current_app.config.get('OFFLOAD_POOL')
+    if not kind:
+        return None
+    pool = current_app.extensions.get('spacewiki_offload')
+    if pool is None:
+        with _LOCK:
+            pool = current_app.extensions.get('spacewiki_offload')
+            if pool is None:
+                workers = current_app.config.get('OFFLOAD_WORKERS') or \
+                    default_workers(current_app.config)
+                backlog = current_app.config.get('OFFLOAD_BACKLOG') or \
+                    workers * 4
+                pool = TaskPool(kind, workers, backlog)
+                atexit.register(pool.terminate)
+                current_app.extensions['spacewiki_offload'] = pool
+    return pool
+
+
+def _cooperative():
+    """Returns True if waiting should yield to the gevent hub, which only
+    runs on the main thread"""
+    gevent = sys.modules.get('gevent')
+    return gevent is not None and \
+        isinstance(threading.current_thread(), threading._MainThread)  # pylint: disable=protected-access
+
+
+def wait(result, budget):
+    """Waits up to budget seconds for a pool's AsyncResult, raising
+    TaskTimeout if it isn't ready by then"""
+    if _cooperative():
+        import gevent
+        # Blocks one of the hub's helper threads instead of the hub
+        waiter = gevent.get_hub().threadpool.spawn(result.wait, budget)
+        try:
+            waiter.get(timeout=budget)
+        except gevent.Timeout:
+            pass
+    else:
+        result.wait(budget)
+    if not result.ready():
+        raise TaskTimeout()
+    return result.get()
+
+
+def run(kind, func, *args):
+    """Runs func(*args) in the pool and returns its result, raising
+    TaskTimeout if it takes longer than the budget for kind"""
+    pool = task_pool()
+    if pool is None:
+        return func(*args)
+    budget = current_app.config.get('OFFLOAD_BUDGETS', {}).get(kind)
+    return wait(pool.submit(func, args), budget)
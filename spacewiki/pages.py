@@ -5,7 +5,7 @@ from flask import (Blueprint, request, current_app, redirect, url_for,
 import logging
 import peewee
 
-from spacewiki import model, editor
+from spacewiki import model, editor, redirects
 
 BLUEPRINT = Blueprint('pages', __name__)
 
@@ -57,11 +57,9 @@ def view(slug=None, revision=None, extension=None, redirectFrom=None,
         elif last_page is not None:
             logging.debug("Could not parse referrer: %s", last_page_slug)
 
-        if revision.body.startswith("#Redirect"):
-            new_slug = revision.body.split(' ', 1)[1]
-            logging.debug("Redirect to %s", new_slug)
-
-            return view(slug=new_slug, redirectFrom=slug)
+        target = redirects.redirect_target(revision.body)
+        if target is not None:
+            return follow_redirect(slug, target, revision, last_page)
 
         return render_template('page.html',
                                revision=revision, page=revision.page,
@@ -72,3 +70,31 @@ def view(slug=None, revision=None, extension=None, redirectFrom=None,
             return view(slug='docs', redirectFrom=slug, missingIndex=True)
         else:
             return editor.edit(slug, redirectFrom=redirectFrom)
+
+
+def follow_redirect(slug, target, revision, last_page):
+    """Shows the page at the end of a chain of redirects, looking the whole
+    chain up in the redirect map rather than viewing every hop"""
+    redirect_map = redirects.redirect_map()
+    while True:
+        chain = redirect_map.follow(slug, target)
+        if chain.loop:
+            logging.warning("Redirect loop: %s", ' -> '.join(chain.slugs))
+            return render_template('page.html',
+                                   revision=revision, page=revision.page,
+                                   redirectLoop=chain.slugs)
+        logging.debug("Redirect to %s", chain.target)
+        final = model.Page.latestRevision(chain.target)
+        if final is None:
+            return editor.edit(chain.target, redirectFrom=slug)
+        final_target = redirects.redirect_target(final.body)
+        if final_target is None:
+            break
+        # Written by another process since the map was built
+        redirect_map.set(chain.target, final_target)
+
+    if last_page is not None and last_page != final.page:
+        final.page.makeSoftlinkFrom(last_page)
+    return render_template('page.html',
+                           revision=final, page=final.page,
+                           redirectFrom=slug)
@@ -0,0 +1,160 @@
+"""Renders revisions in the background as soon as they are saved, so that
+readers find a warm copy in the render cache"""
+
+import atexit
+from flask import current_app, has_request_context, request
+import itertools
+import logging
+import peewee
+import Queue
+import threading
+
+from spacewiki import cache, events, model
+
+PRIORITY_SAVED = 0
+PRIORITY_DEPENDENT = 10
+
+
+class RenderQueue(object):
+    """A deduplicating priority queue of revisions to render, drained by a
+    pool of worker threads"""
+
+    def __init__(self, app, workers=2):
+        self.app = app
+        self.workers = workers
+        self._queue = Queue.PriorityQueue()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._threads = []
+        self._stopped = False
+
+    def put(self, revision_id, priority=PRIORITY_DEPENDENT, base_url=None):
+        """Queues a revision for rendering. A revision that is already queued
+        is only queued again if the new priority is more urgent. Returns
+        True if the revision was queued."""
+        with self._lock:
+            if self._stopped:
+                return False
+            queued = self._pending.get(revision_id)
+            if queued is not None and queued <= priority:
+                return False
+            self._pending[revision_id] = priority
+            self._start()
+        self._queue.put((priority, next(self._counter), revision_id,
+                         base_url))
+        return True
+
+    def join(self):
+        """Blocks until every queued revision has been rendered"""
+        self._queue.join()
+
+    def stop(self):
+        """Drops every queued render and waits for the workers to finish
+        what they are rendering. Warming a cache is pointless in a process
+        that is about to exit, and daemon threads that are still running
+        during interpreter shutdown can crash it."""
+        with self._lock:
+            self._stopped = True
+            self._pending.clear()
+        for thread in self._threads:
+            self._queue.put((-1, next(self._counter), None, None))
+        for thread in self._threads:
+            thread.join(10)
+
+    def render(self, revision_id, base_url=None):
+        """Renders a revision into the render cache"""
+        with self.app.test_request_context('/', base_url=base_url):
+            if model.DATABASE.obj is None:
+                model.get_db()
+            try:
+                revision = model.Revision.get(id=revision_id)
+            except peewee.DoesNotExist:
+                return
+            revision.html  # pylint: disable=pointless-statement
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run,
+                                      name='prerender-%d' % (len(self._threads),))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            priority, _, revision_id, base_url = self._queue.get()
+            if revision_id is None:
+                self._queue.task_done()
+                return
+            try:
+                with self._lock:
+                    # Superseded by a more urgent copy of the same job
+                    if self._pending.get(revision_id) != priority:
+                        continue
+                    del self._pending[revision_id]
+                self.render(revision_id, base_url)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Could not prerender revision %s",
+                                  revision_id)
+            finally:
+                self._queue.task_done()
+
+
+def render_queue():
+    """Returns the render queue for the current app, or None if
+    prerendering is disabled"""
+    workers = current_app.config.get('PRERENDER_WORKERS', 0)
+    if not workers:
+        return None
+    queue = current_app.extensions.get('spacewiki_prerender')
+    if queue is None:
+        queue = current_app.extensions.setdefault(
+            'spacewiki_prerender',
+            RenderQueue(current_app._get_current_object(), workers))
+        atexit.register(queue.stop)
+    return queue
+
+
+def dependents(slug):
+    """Returns the ids of the latest revisions of the pages that link to,
+    include, or for an attachment: key, own what slug names"""
+    if slug.startswith('attachment:'):
+        pages = model.Attachment.select(model.Attachment.page) \
+            .where(model.Attachment.slug == slug[len('attachment:'):])
+    else:
+        pages = model.PageLink.select(model.PageLink.src) \
+            .where(model.PageLink.dest_slug == slug)
+    return [revision_id for (revision_id,) in
+            model.Revision.select(peewee.fn.Max(model.Revision.id))
+            .where(model.Revision.page << pages)
+            .group_by(model.Revision.page)
+            .tuples()]
+
+
+def page_changed(slug, revision=None):
+    """Drops cached renders that depended on slug and queues fresh renders
+    of them, along with revision if one was just saved. Pages that depend on
+    slug but were only ever rendered by other processes are queued too."""
+    stale = cache.render_cache().invalidate(slug)
+    queue = render_queue()
+    if queue is None:
+        return
+    base_url = request.url_root if has_request_context() else None
+    if revision is not None:
+        queue.put(revision.id, PRIORITY_SAVED, base_url)
+    for revision_id in set(stale).union(dependents(slug)):
+        queue.put(revision_id, PRIORITY_DEPENDENT, base_url)
+
+
+@events.subscribe('page')
+def page_changed_elsewhere(slug):
+    """Drops and re-renders what depended on slug, after another process
+    changed it"""
+    page_changed(slug)
+
+
+@events.subscribe('all')
+def everything_changed(key=None):  # pylint: disable=unused-argument
+    """Drops every cached render"""
+    cache.render_cache().clear()
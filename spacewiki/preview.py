@@ -0,0 +1,213 @@
+"""Incremental rendering for the editor's live preview
+
+The editor posts the whole body along with a session token, a sequence
+number and the sequence number of the last response it applied. The body is
+split into the top level blocks the markdown lexer finds, and only blocks
+the editor hasn't already been sent are rendered. The response lists the blocks in order, with HTML
+only for the new ones:
+
+    {"seq": 3, "blocks": [{"id": "ab12..."}, {"id": "cd34...", "html": "..."}]}
+
+A request that is overtaken by a newer one from the same session stops
+rendering and answers {"seq": 2, "superseded": true}."""
+
+import collections
+from flask import current_app
+import hashlib
+import mistune
+import threading
+import time
+
+from spacewiki import model
+from spacewiki.wikiformat import Resolver, markdown
+
+# Blocks that define something for the whole page, which a block rendered on
+# its own would miss
+PAGE_WIDE = frozenset(['def_links', 'def_footnotes'])
+
+_RULES = markdown.WikiBlockLexer.default_rules
+_GRAMMAR = markdown.WikiBlockGrammar()
+
+
+def split_blocks(text):
+    """Splits wikitext into the blocks the markdown lexer finds at the top
+    level, so lists, quotes, HTML and fenced code stay whole. Text that
+    defines reference links or footnotes is left in one block, as they are
+    used from anywhere in the page."""
+    source = text = mistune.preprocessing(text).strip('\n')
+    blocks = []
+    while text:
+        for rule in _RULES:
+            match = getattr(_GRAMMAR, rule).match(text)
+            if match:
+                break
+        if rule in PAGE_WIDE:
+            return [source]
+        if rule != 'newline':
+            blocks.append(match.group(0).strip('\n'))
+        text = text[len(match.group(0)):]
+    return blocks
+
+
+def block_id(slug, block):
+    """Names a block by its content, and the page it is rendered on since
+    relative links depend on that"""
+    return hashlib.sha1(slug.encode('utf-8') + '\0' +
+                        block.encode('utf-8')).hexdigest()
+
+
+class CachingResolver(Resolver):
+    """A Resolver that remembers its answers, so links and includes that
+    appear in block after block are only looked up once"""
+
+    def __init__(self):
+        super(CachingResolver, self).__init__()
+        self._answers = {}
+
+    def _cached(self, kind, slug, lookup):
+        key = (kind, slug)
+        if key not in self._answers:
+            self._answers[key] = lookup(slug)
+        return self._answers[key]
+
+    def page_exists(self, slug):
+        return self._cached('page', slug,
+                            super(CachingResolver, self).page_exists)
+
+    def pages_exist(self, slugs):
+        unknown = [slug for slug in slugs
+                   if ('page', slug) not in self._answers]
+        if unknown:
+            existing = super(CachingResolver, self).pages_exist(unknown)
+            for slug in unknown:
+                self._answers[('page', slug)] = slug in existing
+        self.dependencies.update(slugs)
+        return set(slug for slug in slugs if self._answers[('page', slug)])
+
+    def latest_revision(self, slug):
+        return self._cached('revision', slug,
+                            super(CachingResolver, self).latest_revision)
+
+    def attachments(self, page_slug, slugs):
+        unknown = [slug for slug in slugs
+                   if ('attachment', page_slug, slug) not in self._answers]
+        if unknown:
+            found = super(CachingResolver, self).attachments(page_slug,
+                                                             unknown)
+            for slug in unknown:
+                self._answers[('attachment', page_slug, slug)] = \
+                    found.get(slug)
+        self.dependencies.update('attachment:' + slug for slug in slugs)
+        return dict((slug, self._answers[('attachment', page_slug, slug)])
+                    for slug in slugs
+                    if self._answers[('attachment', page_slug, slug)])
+
+
+class PreviewSession(object):
+    """The state of one editor's preview: rendered blocks, resolved links,
+    and which blocks each response sent"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.latest = -1
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.started = time.time()
+        self.resolver = CachingResolver()
+        self.rendered = {}
+        self.sent = collections.OrderedDict()
+
+    def begin(self, seq):
+        """Registers a request, returning False if a newer one already
+        arrived. Cached lookups are forgotten every ttl seconds so that
+        pages created in the meantime show up."""
+        with self.lock:
+            if seq <= self.latest:
+                return False
+            self.latest = seq
+            if time.time() - self.started > self.ttl:
+                self._reset()
+            return True
+
+    def superseded(self, seq):
+        """Returns True if a newer request has arrived since seq"""
+        return self.latest != seq
+
+    def finish(self, seq, ids):
+        """Remembers which blocks the response to seq carried, dropping
+        renders the document no longer uses"""
+        with self.lock:
+            self.sent[seq] = frozenset(ids)
+            while len(self.sent) > 4:
+                self.sent.popitem(last=False)
+            live = set()
+            for sent in self.sent.values():
+                live.update(sent)
+            for block in set(self.rendered) - live:
+                del self.rendered[block]
+
+    def known(self, base):
+        """Returns the ids of the blocks the client has, given the sequence
+        number of the last response it applied"""
+        with self.lock:
+            return self.sent.get(base, frozenset())
+
+
+class PreviewSessions(object):
+    """A bounded LRU of preview sessions"""
+
+    def __init__(self, size=1000, ttl=10):
+        self.size = size
+        self.ttl = ttl
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Returns the session for a token, starting one if needed"""
+        with self._lock:
+            session = self._sessions.pop(token, None)
+            if session is None:
+                session = PreviewSession(self.ttl)
+            self._sessions[token] = session
+            while len(self._sessions) > self.size:
+                self._sessions.popitem(last=False)
+            return session
+
+
+def preview_sessions():
+    """Returns the preview sessions for the current app"""
+    sessions = current_app.extensions.get('spacewiki_previews')
+    if sessions is None:
+        sessions = current_app.extensions.setdefault(
+            'spacewiki_previews', PreviewSessions(
+                current_app.config.get('PREVIEW_SESSIONS', 1000),
+                current_app.config.get('PREVIEW_RESOLVER_TTL', 10)))
+    return sessions
+
+
+def render_patch(token, seq, base, body, slug):
+    """Renders the blocks of body that the client doesn't have yet"""
+    session = preview_sessions().get(token)
+    if not session.begin(seq):
+        return {'seq': seq, 'superseded': True}
+    known = session.known(base)
+    blocks = []
+    for block in split_blocks(body):
+        if session.superseded(seq):
+            return {'seq': seq, 'superseded': True}
+        ident = block_id(slug, block)
+        patch = {'id': ident}
+        if ident not in known:
+            html = session.rendered.get(ident)
+            if html is None:
+                session.resolver.partial = False
+                html = model.Revision.render_text(block, slug,
+                                                  session.resolver)
+                if not session.resolver.partial:
+                    session.rendered[ident] = html
+            patch['html'] = html
+        blocks.append(patch)
+    session.finish(seq, [block['id'] for block in blocks])
+    return {'seq': seq, 'blocks': blocks}
@@ -0,0 +1,94 @@
+"""Tools for the request profiles spooled by middleware.SamplingProfiler"""
+
+from flask import current_app
+from flask_script import Manager
+import glob
+import logging
+import os
+import pstats
+
+MANAGER = Manager(usage='Profiling tools')
+
+
+def load_spool(spool_dir, route=None):
+    """Merges every spooled profile into one pstats.Stats per route"""
+    merged = {}
+    for route_dir in sorted(glob.glob(os.path.join(spool_dir, '*'))):
+        name = os.path.basename(route_dir)
+        if route is not None and name != route:
+            continue
+        for fname in sorted(glob.glob(os.path.join(route_dir, '*.prof'))):
+            if name in merged:
+                merged[name].add(fname)
+            else:
+                merged[name] = pstats.Stats(fname)
+    return merged
+
+
+def frame_name(func):
+    """Formats a pstats function key as a flamegraph frame"""
+    filename, line, name = func
+    frame = '%s (%s:%d)' % (name, os.path.basename(filename), line)
+    return frame.replace(';', ':')
+
+
+def collapse_stats(stats, root, min_seconds=0.0001):
+    """Converts a pstats.Stats into collapsed stack lines of
+    'root;frame;frame microseconds'.
+
+    pstats only records caller/callee edges, not whole stacks, so time spent
+    below a function is split between its callers in proportion to the
+    cumulative time each edge accounts for."""
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    totals = {}
+
+    def walk(func, path, fraction):  # pylint: disable=missing-docstring
+        _, _, tottime, cumtime, _ = stats.stats[func]
+        path = path + (func,)
+        self_time = tottime * fraction
+        if self_time > 0:
+            key = ';'.join([root] + [frame_name(f) for f in path])
+            totals[key] = totals.get(key, 0) + self_time
+        for callee, edge_time in callees.get(func, ()):
+            if callee in path:
+                continue
+            callee_total = stats.stats[callee][3]
+            if not callee_total:
+                continue
+            share = fraction * edge_time / callee_total
+            if share * callee_total < min_seconds:
+                continue
+            walk(callee, path, share)
+
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if not [c for c in callers if c != func]:
+            walk(func, (), 1.0)
+
+    return ['%s %d' % (key, int(value * 1000000))
+            for key, value in sorted(totals.items())
+            if int(value * 1000000) > 0]
+
+
+@MANAGER.option('-s', '--spool', dest='spool', default=None,
+                help='Profile spool directory, defaults to PROFILE_SPOOL_DIR')
+@MANAGER.option('-r', '--route', dest='route', default=None,
+                help='Only aggregate profiles for this endpoint')
+@MANAGER.option('-o', '--output', dest='output', default=None,
+                help='Write collapsed stacks here instead of stdout')
+def collapse(spool, route, output):
+    """Aggregates spooled profiles into flamegraph.pl input"""
+    if spool is None:
+        spool = current_app.config.get('PROFILE_SPOOL_DIR')
+    lines = []
+    for name, stats in sorted(load_spool(spool, route).items()):
+        logging.info("Collapsing %s", name)
+        lines.extend(collapse_stats(stats, name))
+    if output is None:
+        print '\n'.join(lines)
+    else:
+        with open(output, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
@@ -0,0 +1,171 @@
+"""An in-memory map of every #Redirect page, so that a chain of redirects is
+followed to its final target in one lookup instead of one page view per hop"""
+
+import collections
+from flask import current_app
+import logging
+import threading
+import time
+
+import peewee
+
+from spacewiki import events, model
+
+REDIRECT = '#Redirect'
+
+
+def redirect_target(body):
+    """Returns the slug a #Redirect body points to, or None if body isn't a
+    redirect"""
+    if not body.startswith(REDIRECT):
+        return None
+    parts = body.split(' ', 1)
+    if len(parts) < 2:
+        return None
+    return parts[1].split('\n', 1)[0].strip() or None
+
+
+class Chain(collections.namedtuple('Chain', 'slugs loop')):
+    """The slugs visited following a redirect, starting with the redirect
+    itself. If loop is set, the last slug redirects back into the chain."""
+    __slots__ = ()
+
+    @property
+    def target(self):
+        """Where the chain ends up"""
+        return self.slugs[-1]
+
+    @property
+    def double(self):
+        """True if the chain passes through more than one redirect"""
+        return len(self.slugs) > 2
+
+
+class RedirectMap(object):
+    """The target of every redirect page by slug, along with the resolved
+    chain of every slug looked up since the map last changed"""
+
+    def __init__(self):
+        self._targets = {}
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._targets)
+
+    def __contains__(self, slug):
+        return slug in self._targets
+
+    def load(self, redirects):
+        """Replaces the map with (slug, target) pairs"""
+        targets = dict(redirects)
+        with self._lock:
+            self._targets = targets
+            self._resolved = {}
+
+    def set(self, slug, target):
+        """Records that slug now redirects to target, or no longer redirects
+        if target is None"""
+        with self._lock:
+            if self._targets.get(slug) == target:
+                return
+            if target is None:
+                self._targets.pop(slug, None)
+            else:
+                self._targets[slug] = target
+            self._resolved = {}
+
+    def resolve(self, slug):
+        """Follows redirects from slug until reaching a page that isn't one,
+        or a slug that was already visited"""
+        with self._lock:
+            chain = self._resolved.get(slug)
+            if chain is not None:
+                return chain
+            slugs = [slug]
+            seen = set(slugs)
+            loop = False
+            target = self._targets.get(slug)
+            while target is not None:
+                if target in seen:
+                    loop = True
+                    break
+                slugs.append(target)
+                seen.add(target)
+                target = self._targets.get(target)
+            chain = self._resolved[slug] = Chain(tuple(slugs), loop)
+            return chain
+
+    def follow(self, slug, target):
+        """Follows a redirect from slug to target, and on from there"""
+        rest = self.resolve(target)
+        if slug in rest.slugs:
+            return Chain((slug,) + rest.slugs[:rest.slugs.index(slug)], True)
+        return Chain((slug,) + rest.slugs, rest.loop)
+
+    def chains(self):
+        """Returns the chain of every redirect, by slug"""
+        with self._lock:
+            slugs = sorted(self._targets)
+        return [self.resolve(slug) for slug in slugs]
+
+
+def load_map(redirects):
+    """Fills a RedirectMap from the latest revision of every page"""
+    start = time.time()
+    latest = model.Revision.select(peewee.fn.Max(model.Revision.id)) \
+        .group_by(model.Revision.page)
+    rows = model.Revision.select(model.Page.slug, model.Revision.body) \
+        .join(model.Page) \
+        .where(model.Revision.id << latest,
+               peewee.fn.Substr(model.Revision.body, 1,
+                                len(REDIRECT)) == REDIRECT) \
+        .tuples()
+    redirects.load((slug, redirect_target(body))
+                   for slug, body in rows.iterator()
+                   if redirect_target(body) is not None)
+    logging.info("Mapped %d redirects in %.2fs", len(redirects),
+                 time.time() - start)
+
+
+def redirect_map():
+    """Returns the redirect map for the current app, building it from the
+    database the first time"""
+    redirects = current_app.extensions.get('spacewiki_redirects')
+    if redirects is None:
+        with model.use_primary():
+            fresh = RedirectMap()
+            load_map(fresh)
+        redirects = current_app.extensions.setdefault('spacewiki_redirects',
+                                                      fresh)
+    return redirects
+
+
+def indexed():
+    """Returns the redirect map if it has been built, otherwise None"""
+    return current_app.extensions.get('spacewiki_redirects')
+
+
+def forget():
+    """Drops the redirect map after a change too big to apply piecemeal, so
+    the next lookup rebuilds it"""
+    current_app.extensions.pop('spacewiki_redirects', None)
+
+
+@events.subscribe('page')
+def refresh(slug):
+    """Re-reads whether slug is a redirect, after another process changed
+    it"""
+    redirects = indexed()
+    if redirects is None:
+        return
+    revision = model.Page.latestRevision(slug)
+    redirects.set(slug, None if revision is None else
+                  redirect_target(revision.body))
+
+
+@events.subscribe('all')
+def everything_changed(key=None):  # pylint: disable=unused-argument
+    """Drops the redirect map, after another process changed more than it
+    could describe"""
+    forget()
@@ -0,0 +1,340 @@
+"""A pre-forking server, so one machine can serve from every core
+
+The arbiter binds the listening socket, then forks workers that each run a
+gevent WSGIServer on it, letting the kernel spread connections between them.
+Workers warm their caches before they accept anything. A worker retires once
+it has served max_requests requests or grown past max_rss bytes, finishing
+what it is serving before it exits, and the arbiter forks a fresh one.
+
+Signals to the arbiter:
+
+* ``HUP`` replaces every worker. Each old worker is retired as soon as a
+  new one is warm, so there is never a moment without workers accepting.
+* ``TERM`` and ``INT`` retire every worker and exit once they are done."""
+
+import errno
+import logging
+import os
+import peewee
+import resource
+import select
+import signal
+import socket
+import time
+
+from spacewiki import events, model, redirects, typeahead
+
+WARM_PAGES = 50
+
+# The generation of workers that have been told to retire
+RETIRED = -1
+
+
+def rss():
+    """Returns the resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Not Linux; the peak is the best there is
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def warm_up(app, pages=WARM_PAGES):
+    """Loads the title index and redirect map, and renders the index page
+    and the pages edited most recently, before a worker takes traffic"""
+    start = time.time()
+    with app.test_request_context('/'):
+        model.get_db()
+        # Listen before loading, so no change goes unheard
+        events.bus()
+        typeahead.title_index()
+        redirects.redirect_map()
+        recent = model.Revision.select(peewee.fn.MAX(model.Revision.id)) \
+            .group_by(model.Revision.page) \
+            .order_by(peewee.fn.MAX(model.Revision.id).desc()) \
+            .limit(pages)
+        revisions = list(model.Revision.select().where(
+            model.Revision.id << recent))
+        index = model.Page.latestRevision(app.config['INDEX_PAGE'])
+        if index is not None:
+            revisions.append(index)
+        for revision in revisions:
+            revision.html  # pylint: disable=pointless-statement
+    logging.info("Worker %d warmed up %d pages in %.2fs", os.getpid(),
+                 len(revisions), time.time() - start)
+
+
+class Worker(object):
+    """Serves requests from the shared socket in a forked process"""
+
+    def __init__(self, app, listener, ready, max_requests=0, max_rss=0,
+                 graceful_timeout=30, warm_pages=WARM_PAGES):
+        self.app = app
+        self.listener = listener
+        self.ready = ready
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.graceful_timeout = graceful_timeout
+        self.warm_pages = warm_pages
+        self.handled = 0
+        self.server = None
+        self.done = None
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        finally:
+            self.handled += 1
+            if self.worn_out():
+                self.retire()
+
+    def worn_out(self):
+        """Returns True if this worker should make way for a fresh one"""
+        if self.max_requests and self.handled >= self.max_requests:
+            logging.info("Worker %d served %d requests, recycling",
+                         os.getpid(), self.handled)
+            return True
+        if self.max_rss and rss() > self.max_rss:
+            logging.info("Worker %d grew to %d bytes, recycling", os.getpid(),
+                         rss())
+            return True
+        return False
+
+    def retire(self):
+        """Stops accepting connections and exits once the ones being served
+        are done"""
+        import gevent
+        if self.server is not None and not self.done.is_set():
+            gevent.spawn(self._stop)
+
+    def _stop(self):
+        self.server.stop(self.graceful_timeout)
+        self.done.set()
+
+    def run(self):
+        """Warms up, then serves until retired"""
+        import gevent
+        import gevent.event
+        import gevent.pool
+        from gevent.pywsgi import WSGIServer
+        gevent.reinit()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if self.warm_pages:
+            warm_up(self.app, self.warm_pages)
+        self.done = gevent.event.Event()
+        # gevent accepts until the socket would block
+        self.listener.setblocking(0)
+        self.server = WSGIServer(self.listener, self, spawn=gevent.pool.Pool(),
+                                 log=logging.getLogger("http"))
+        gevent.signal_handler(signal.SIGTERM, self.retire)
+        self.server.start()
+        os.write(self.ready, '%d\n' % (os.getpid(),))
+        self.done.wait()
+
+
+def _shutdown(app):
+    """Stops the background threads and processes a worker started, since
+    it leaves through os._exit"""
+    bus = app.extensions.get('spacewiki_events')
+    if bus is not None and bus.pid == os.getpid():
+        bus.stop()
+    queue = app.extensions.get('spacewiki_prerender')
+    if queue is not None:
+        queue.stop()
+    pool = app.extensions.get('spacewiki_offload')
+    if pool is not None:
+        pool.terminate()
+    database = app.extensions.get('spacewiki_database')
+    if database is not None and hasattr(database, 'stop'):
+        database.stop()
+
+
+def release_database(app):
+    """Closes the connection the arbiter opened, if any, and stops the
+    writer thread of its database, which a forked worker couldn't use. Each
+    worker opens its own."""
+    database = app.extensions.pop('spacewiki_database', None)
+    if database is not None and hasattr(database, 'stop'):
+        database.stop()
+    elif model.DATABASE.obj is not None and not model.DATABASE.is_closed():
+        model.DATABASE.close()
+
+
+class Arbiter(object):
+    """Keeps a number of workers serving from one listening socket"""
+
+    def __init__(self, app, address, workers, max_requests=0, max_rss=0,
+                 graceful_timeout=30, warm_pages=WARM_PAGES, backlog=1024):
+        self.app = app
+        self.address = address
+        self.count = workers
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.graceful_timeout = graceful_timeout
+        self.warm_pages = warm_pages
+        self.backlog = backlog
+        self.listener = None
+        # pid -> generation, which goes up with every reload
+        self.workers = {}
+        self.generation = 0
+        self.running = False
+        self._ready = None
+        self._ready_buffer = ''
+        self._signals = []
+        self._failed = 0
+
+    def listen(self):
+        """Binds the socket every worker will accept from"""
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen(self.backlog)
+        self.address = self.listener.getsockname()
+        self._ready = os.pipe()
+        logging.info("Listening on %s:%d", *self.address)
+
+    def start(self):
+        """Binds the socket and forks the first workers"""
+        if self.listener is None:
+            self.listen()
+        # Each worker's offload pool takes its share of the CPUs
+        self.app.config['SERVER_WORKERS'] = self.count
+        release_database(self.app)
+        self.running = True
+        self.maintain()
+
+    def spawn(self):
+        """Forks a worker of the current generation"""
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return pid
+        code = 0
+        try:
+            os.close(self._ready[0])
+            Worker(self.app, self.listener, self._ready[1], self.max_requests,
+                   self.max_rss, self.graceful_timeout, self.warm_pages).run()
+        except BaseException:  # pylint: disable=broad-except
+            logging.exception("Worker %d failed", os.getpid())
+            code = 1
+        finally:
+            try:
+                _shutdown(self.app)
+            finally:
+                os._exit(code)  # pylint: disable=protected-access
+
+    def kill(self, pid, sig=signal.SIGTERM):
+        """Signals a worker, ignoring ones that already exited"""
+        try:
+            os.kill(pid, sig)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+    def reap(self, block=False):
+        """Forgets about workers that have exited. Only waits for our own
+        workers, so other children of the process are left alone."""
+        for pid in list(self.workers):
+            try:
+                done, status = os.waitpid(pid, 0 if block else os.WNOHANG)
+            except OSError as exc:
+                if exc.errno != errno.ECHILD:
+                    raise
+                done, status = pid, 0
+            if not done:
+                continue
+            generation = self.workers.pop(pid)
+            # Workers told to retire may be killed before they can say so
+            if status and generation != RETIRED and self.running:
+                logging.warning("Worker %d exited with status %d", pid,
+                                status)
+                self._failed = time.time()
+
+    def current(self):
+        """Returns the pids of the workers of the current generation"""
+        return [pid for pid, generation in self.workers.items()
+                if generation == self.generation]
+
+    def maintain(self):
+        """Reaps exited workers and forks replacements"""
+        self.reap()
+        # Don't fork as fast as workers can crash
+        if self.running and time.time() - self._failed > 1:
+            for _ in range(self.count - len(self.current())):
+                self.spawn()
+
+    def reload(self):
+        """Starts a new generation of workers, which take over from the old
+        ones as they warm up"""
+        logging.info("Reloading %d workers", self.count)
+        self.generation += 1
+        self.maintain()
+
+    def worker_ready(self, pid):
+        """Retires an old worker for every new one that is ready"""
+        if self.workers.get(pid) != self.generation:
+            return
+        old = [old_pid for old_pid, generation in self.workers.items()
+               if RETIRED < generation < self.generation]
+        if old:
+            self.kill(min(old))
+            self.workers[min(old)] = RETIRED
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds for workers to report ready"""
+        try:
+            readable, _, _ = select.select([self._ready[0]], [], [], timeout)
+        except select.error as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            return
+        if readable:
+            self._ready_buffer += os.read(self._ready[0], 4096)
+        while '\n' in self._ready_buffer:
+            line, self._ready_buffer = self._ready_buffer.split('\n', 1)
+            self.worker_ready(int(line))
+
+    def stop(self, timeout=None):
+        """Retires every worker, killing those still busy after timeout
+        seconds, and closes the socket"""
+        self.running = False
+        if timeout is None:
+            timeout = self.graceful_timeout
+        for pid in list(self.workers):
+            self.kill(pid)
+            self.workers[pid] = RETIRED
+        deadline = time.time() + timeout
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGKILL)
+        self.reap(block=True)
+        self.listener.close()
+        for fd in self._ready:
+            os.close(fd)
+
+    def _signal(self, signum, frame):  # pylint: disable=unused-argument
+        self._signals.append(signum)
+
+    def run(self):
+        """Serves until told to stop by a signal"""
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGCHLD):
+            signal.signal(signum, self._signal)
+        self.start()
+        while self.running:
+            self.wait(1)
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum in (signal.SIGTERM, signal.SIGINT):
+                    logging.info("Shutting down")
+                    self.running = False
+            self.maintain()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self.stop()
@@ -6,6 +6,18 @@ SITE_NAME = 'SpaceWiki'
 INDEX_PAGE = 'index'
 UPLOAD_PATH = 'uploads'
 
+# Where uploads are kept: 'local' for UPLOAD_PATH, or 's3' for a bucket on any
+# S3 compatible service. Local uploads are redirected to UPLOAD_URL if the
+# web server serves UPLOAD_PATH from there. See spacewiki.storage.
+UPLOAD_STORAGE = os.environ.get('UPLOAD_STORAGE', 'local')
+UPLOAD_URL = None
+S3_ENDPOINT = os.environ.get('S3_ENDPOINT')
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
+S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+S3_REGION = os.environ.get('S3_REGION', 'us-east-1')
+S3_URL_EXPIRES = 3600
+
 ADMIN_EMAILS = None
 TEMP_DIR = None
 
@@ -13,6 +25,86 @@ TWITTER_CARD_SITE = None
 
 SECRET_SESSION_KEY = None
 
+# Read replicas of DATABASE_URL, used by read-only requests. Users stay on the
+# primary for REPLICA_STICKY_SECONDS after writing something.
+DATABASE_REPLICA_URLS = os.environ.get('DATABASE_REPLICA_URLS', '').split()
+REPLICA_STICKY_SECONDS = 30
+
+# Run sqlite:// databases in WAL mode with a single writer thread, for
+# servers with concurrent writers. See spacewiki.database.
+SQLITE_PRODUCTION = False
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 268435456,
+    'busy_timeout': 10000,
+}
+
+RENDER_CACHE_SIZE = 1000
+# Keep renders and diffs in a file shared by every worker on the machine,
+# rather than RENDER_CACHE_SIZE renders in each process. The file is emptied
+# when DATABASE_URL changes. See spacewiki.cache.
+RENDER_CACHE_PATH = os.environ.get('RENDER_CACHE_PATH')
+RENDER_CACHE_BYTES = 256 * 1024 * 1024
+# Revisions kept parsed in each process, so re-rendering them after a page
+# they link to or include changes only resolves links and includes again
+PARSE_CACHE_SIZE = 5000
+
+# Tell the other processes and nodes serving the wiki what changed, so they
+# can update their caches: 'postgres' for NOTIFY on EVENT_CHANNEL, or
+# 'socket' for processes on this host. See spacewiki.events.
+EVENT_BUS = os.environ.get('EVENT_BUS')
+EVENT_CHANNEL = 'spacewiki'
+EVENT_SOCKET_DIR = os.environ.get('EVENT_SOCKET_DIR', '/tmp/spacewiki-events')
+PRERENDER_WORKERS = 2
+
+# Live preview state is kept for this many editors, and looked up links are
+# re-checked after this many seconds
+PREVIEW_SESSIONS = 1000
+PREVIEW_RESOLVER_TTL = 10
+
+# Markdown rendering, diffs and thumbnails run in a pool of OFFLOAD_WORKERS
+# 'thread's or 'process'es, so they don't hold up the gevent server; set
+# OFFLOAD_POOL to None to run them inline. By default each pre-forked worker
+# gets its share of the CPUs, as every one of them has a pool of its own.
+# Tasks that run over their budget in seconds fall back to something cheaper,
+# as do tasks that find OFFLOAD_BACKLOG (default four per worker) already
+# queued or running.
+OFFLOAD_POOL = 'thread'
+OFFLOAD_WORKERS = None
+OFFLOAD_BACKLOG = None
+OFFLOAD_BUDGETS = {
+    'render': 5,
+    'diff': 5,
+    'thumbnail': 10,
+}
+
+# Limits on expensive routes, by endpoint, in each worker: how many requests
+# run at once, how many more may queue and for how many seconds before the
+# rest get a 503, and how many requests a second (in bursts of up to 'burst')
+# each client may make before getting a 429. 'uploads.thumbnail' limits
+# scaling images to sizes not thumbnailed before, which a gallery page does
+# for every image at once the first time it is viewed. Clients are told apart
+# by ADMISSION_CLIENT_HEADER if set, eg 'X-Real-IP' behind a proxy. See
+# spacewiki.admission.
+ADMISSION_LIMITS = {
+    'history.diff': {'concurrency': 4, 'queue': 16, 'timeout': 5,
+                     'rate': 1, 'burst': 10},
+    'editor.preview': {'concurrency': 8, 'queue': 32, 'timeout': 5,
+                       'rate': 5, 'burst': 20},
+    'uploads.thumbnail': {'concurrency': 4, 'queue': 256, 'timeout': 30,
+                          'rate': 20, 'burst': 1000},
+    'specials.search': {'concurrency': 4, 'queue': 16, 'timeout': 5,
+                        'rate': 2, 'burst': 10},
+    'specials.allPages': {'concurrency': 2, 'queue': 16, 'timeout': 5,
+                          'rate': 1, 'burst': 5},
+}
+ADMISSION_CLIENT_HEADER = None
+
+PROFILE_SPOOL_DIR = None
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_SECRET = None
+
 try:
     from local_settings import *  # pylint: disable=unused-wildcard-import,wildcard-import
 except ImportError:
@@ -1,8 +1,8 @@
 """Various special pages"""
 
-from flask import Blueprint, render_template, request
+from flask import Blueprint, jsonify, render_template, request, url_for
 
-from spacewiki import model
+from spacewiki import model, redirects, typeahead
 
 BLUEPRINT = Blueprint('specials', __name__)
 
@@ -20,3 +20,50 @@ def allPages():
     pages = model.Page.select().order_by(model.Page.title)
     return render_template('all-pages.html',
                            pages=pages)
+
+
+@BLUEPRINT.route("/.orphaned-pages")
+def orphanedPages():
+    """Lists the pages that no other page links to"""
+    return render_template('orphaned-pages.html',
+                           pages=model.Page.orphaned())
+
+
+@BLUEPRINT.route("/.wanted-pages")
+def wantedPages():
+    """Lists the pages that are linked to but don't exist yet"""
+    return render_template('wanted-pages.html', wanted=model.Page.wanted())
+
+
+@BLUEPRINT.route("/.redirects")
+def redirectChains():
+    """Lists redirect loops, double redirects and redirects to pages that
+    don't exist"""
+    chains = redirects.redirect_map().chains()
+    targets = list(set(chain.target for chain in chains if not chain.loop))
+    existing = set()
+    for start in xrange(0, len(targets), 900):
+        existing.update(slug for (slug,) in model.Page.select(model.Page.slug)
+                        .where(model.Page.slug << targets[start:start + 900])
+                        .tuples())
+    return render_template(
+        'redirects.html',
+        loops=[chain for chain in chains if chain.loop],
+        broken=[chain for chain in chains
+                if not chain.loop and chain.target not in existing],
+        double=[chain for chain in chains
+                if not chain.loop and chain.double and
+                chain.target in existing],
+        count=len(chains))
+
+
+@BLUEPRINT.route("/.complete")
+def complete():
+    """Suggests pages whose title or slug starts with the query"""
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    results = typeahead.title_index().complete(query, limit)
+    return jsonify(query=query, results=[
+        {'slug': slug, 'title': title, 'hits': hits,
+         'url': url_for('pages.view', slug=slug)}
+        for slug, title, hits in results])
@@ -0,0 +1,350 @@
+"""Where uploaded blobs and their thumbnails are kept
+
+Blobs are addressed by keys like those of Attachment.hashPath. UPLOAD_STORAGE
+picks the backend:
+
+* ``local`` keeps them in a sharded tree under UPLOAD_PATH. Files are sent
+  with send_file, which hands them to the web server when USE_X_SENDFILE is
+  set, or redirected to UPLOAD_URL if the tree is served from there.
+* ``s3`` keeps them in S3_BUCKET on any S3 compatible service at S3_ENDPOINT,
+  and readers are redirected to a presigned URL, so blob bytes never pass
+  through the app."""
+
+import calendar
+from flask import current_app, redirect, send_file
+import datetime
+import hashlib
+import hmac
+import httplib
+import os
+import shutil
+import tempfile
+import time
+import urllib
+import urlparse
+from xml.etree import ElementTree
+
+CHUNK_SIZE = 64 * 1024
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+# How long an S3 object counts as recently used after this process copied it
+# onto itself, so that serving a thumbnail doesn't copy it every time
+S3_TOUCH_INTERVAL = 600
+
+
+class StorageError(IOError):
+    """Raised when the storage backend refuses a request"""
+
+
+class LocalStore(object):
+    """Blobs in a directory tree on local disk"""
+
+    def __init__(self, root, base_url=None):
+        self.root = root
+        self.base_url = base_url
+
+    def path(self, key):
+        """Where the blob at key lives on disk"""
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        """Returns True if a blob is stored at key"""
+        return os.path.exists(self.path(key))
+
+    def size(self, key):
+        """Returns the size in bytes of the blob at key"""
+        return os.path.getsize(self.path(key))
+
+    def _prepare(self, key):
+        dirname = os.path.dirname(self.path(key))
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created by a concurrent upload
+                if not os.path.isdir(dirname):
+                    raise
+
+    def put(self, key, fileobj, size=None):  # pylint: disable=unused-argument
+        """Streams fileobj into the blob at key"""
+        self._prepare(key)
+        handle, tmpname = tempfile.mkstemp(dir=os.path.dirname(self.path(key)))
+        try:
+            with os.fdopen(handle, 'wb') as fh:
+                shutil.copyfileobj(fileobj, fh, CHUNK_SIZE)
+            os.rename(tmpname, self.path(key))
+        except:
+            os.remove(tmpname)
+            raise
+
+    def put_file(self, key, src):
+        """Moves the file at src into the blob at key"""
+        self._prepare(key)
+        shutil.move(src, self.path(key))
+
+    def open(self, key):
+        """Returns a file object reading the blob at key"""
+        return open(self.path(key), 'rb')
+
+    def touch(self, key):
+        """Marks the blob at key as recently used"""
+        os.utime(self.path(key), None)
+
+    def delete(self, key):
+        """Removes the blob at key"""
+        os.remove(self.path(key))
+
+    def walk(self):
+        """Yields (key, size, modification time) for every stored blob"""
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                yield (os.path.relpath(path, self.root).replace(os.sep, '/'),
+                       stat.st_size, stat.st_mtime)
+
+    def serve(self, key, mimetype, filename=None):  # pylint: disable=unused-argument
+        """Returns a response sending the blob at key to the client"""
+        if self.base_url is not None:
+            return redirect(self.base_url.rstrip('/') + '/' + key)
+        return send_file(self.path(key), mimetype=mimetype, conditional=True)
+
+
+def _sign(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _quote(value, safe='-_.~'):
+    return urllib.quote(value.encode('utf-8') if isinstance(value, unicode)
+                        else value, safe)
+
+
+def _query_string(query):
+    return '&'.join('%s=%s' % (_quote(name), _quote(value))
+                    for name, value in sorted(query.items()))
+
+
+class S3Store(object):
+    """Blobs in a bucket on an S3 compatible service, addressed path-style
+    and signed with AWS Signature Version 4"""
+
+    def __init__(self, endpoint, bucket, access_key, secret_key,
+                 region='us-east-1', url_expires=3600, timeout=30):
+        self.endpoint = urlparse.urlparse(endpoint)
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.url_expires = url_expires
+        self.timeout = timeout
+        self._touched = {}
+
+    def _path(self, key=None):
+        if key is None:
+            return '/%s' % (self.bucket,)
+        return '/%s/%s' % (self.bucket, key)
+
+    def _scope(self, now):
+        return '%s/%s/s3/aws4_request' % (now.strftime('%Y%m%d'),
+                                          self.region)
+
+    def signature(self, method, path, query, headers, payload_hash, now):
+        """Signs a request, returning the signature and the signed header
+        names. query is a dict of parameters, and headers a dict of
+        lowercased header names to values."""
+        signed = sorted(headers)
+        canonical = '\n'.join([
+            method,
+            _quote(path, '/-_.~'),
+            _query_string(query),
+            ''.join('%s:%s\n' % (name, ' '.join(str(headers[name]).split()))
+                    for name in signed),
+            ';'.join(signed),
+            payload_hash])
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, self._scope(now),
+                             hashlib.sha256(canonical).hexdigest()])
+        key = _sign(('AWS4' + self.secret_key).encode('utf-8'),
+                    now.strftime('%Y%m%d'))
+        for part in (self.region, 's3', 'aws4_request'):
+            key = _sign(key, part)
+        return (hmac.new(key, to_sign, hashlib.sha256).hexdigest(),
+                ';'.join(signed))
+
+    def presign(self, method, path, expires, query=None, now=None):
+        """Returns the query string of a presigned request for path"""
+        now = now or datetime.datetime.utcnow()
+        query = dict(query or {})
+        query.update({
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': '%s/%s' % (self.access_key, self._scope(now)),
+            'X-Amz-Date': now.strftime('%Y%m%dT%H%M%SZ'),
+            'X-Amz-Expires': str(expires),
+            'X-Amz-SignedHeaders': 'host',
+        })
+        query['X-Amz-Signature'], _ = self.signature(
+            method, path, query, {'host': self.endpoint.netloc},
+            UNSIGNED_PAYLOAD, now)
+        return _query_string(query)
+
+    def _request(self, method, path, query=None, body=None, size=None,
+                 expect=(200,), headers=None):
+        now = datetime.datetime.utcnow()
+        query = query or {}
+        headers = dict(headers or {})
+        headers.update({
+            'host': self.endpoint.netloc,
+            'x-amz-content-sha256': UNSIGNED_PAYLOAD,
+            'x-amz-date': now.strftime('%Y%m%dT%H%M%SZ'),
+        })
+        if body is not None:
+            headers['content-length'] = str(size)
+        signature, signed = self.signature(method, path, query, headers,
+                                           UNSIGNED_PAYLOAD, now)
+        headers['authorization'] = (
+            'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, '
+            'Signature=%s' % (self.access_key, self._scope(now), signed,
+                              signature))
+        if self.endpoint.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.endpoint.netloc,
+                                           timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self.endpoint.netloc,
+                                          timeout=self.timeout)
+        url = _quote(path, '/-_.~')
+        if query:
+            url += '?' + _query_string(query)
+        conn.putrequest(method, url, skip_host=True,
+                        skip_accept_encoding=True)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.endheaders()
+        if body is not None:
+            while True:
+                chunk = body.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                conn.send(chunk)
+        response = conn.getresponse()
+        if response.status not in expect:
+            message = response.read()
+            conn.close()
+            raise StorageError("%s %s: %s %s" % (method, path, response.status,
+                                                 message[:200]))
+        return response
+
+    def exists(self, key):
+        """Returns True if a blob is stored at key"""
+        response = self._request('HEAD', self._path(key), expect=(200, 404))
+        response.read()
+        return response.status == 200
+
+    def size(self, key):
+        """Returns the size in bytes of the blob at key"""
+        response = self._request('HEAD', self._path(key))
+        response.read()
+        return int(response.getheader('content-length'))
+
+    def put(self, key, fileobj, size=None):
+        """Streams fileobj into the blob at key. Without a size, fileobj is
+        spooled to a temporary file first to find it."""
+        if size is None:
+            spool = tempfile.TemporaryFile()
+            shutil.copyfileobj(fileobj, spool, CHUNK_SIZE)
+            size = spool.tell()
+            spool.seek(0)
+            fileobj = spool
+        self._request('PUT', self._path(key), body=fileobj, size=size).read()
+
+    def put_file(self, key, src):
+        """Uploads the file at src to the blob at key, then removes it"""
+        with open(src, 'rb') as fh:
+            self.put(key, fh, os.path.getsize(src))
+        os.remove(src)
+
+    def open(self, key):
+        """Returns a file object reading the blob at key"""
+        return self._request('GET', self._path(key))
+
+    def touch(self, key):
+        """Marks the blob at key as recently used. Objects can't be touched
+        in place, so it is copied onto itself, which S3 only allows when
+        the metadata is replaced."""
+        now = time.time()
+        if self._touched.get(key, 0) > now - S3_TOUCH_INTERVAL:
+            return
+        response = self._request('PUT', self._path(key), headers={
+            'content-length': '0',
+            'x-amz-copy-source': _quote(self._path(key), '/-_.~'),
+            'x-amz-metadata-directive': 'REPLACE',
+        })
+        # A copy that fails after starting still answers 200
+        tree = ElementTree.fromstring(response.read())
+        if tree.tag == 'Error':
+            raise StorageError("Copy %s: %s" % (
+                key, tree.findtext('Message') or tree.findtext('Code')))
+        if len(self._touched) > 10000:
+            self._touched.clear()
+        self._touched[key] = now
+
+    def delete(self, key):
+        """Removes the blob at key"""
+        self._request('DELETE', self._path(key), expect=(200, 204)).read()
+
+    def walk(self):
+        """Yields (key, size, modification time) for every stored blob"""
+        query = {'list-type': '2'}
+        while True:
+            response = self._request('GET', self._path(), query)
+            tree = ElementTree.fromstring(response.read())
+            for item in tree.iter(S3_NAMESPACE + 'Contents'):
+                modified = item.find(S3_NAMESPACE + 'LastModified').text
+                yield (item.find(S3_NAMESPACE + 'Key').text,
+                       int(item.find(S3_NAMESPACE + 'Size').text),
+                       calendar.timegm(time.strptime(modified[:19],
+                                                     '%Y-%m-%dT%H:%M:%S')))
+            token = tree.find(S3_NAMESPACE + 'NextContinuationToken')
+            if token is None or not token.text:
+                return
+            query['continuation-token'] = token.text
+
+    def url(self, key, mimetype=None, filename=None):
+        """Returns a presigned URL reading the blob at key"""
+        query = {}
+        if mimetype is not None:
+            query['response-content-type'] = mimetype
+        if filename is not None:
+            query['response-content-disposition'] = \
+                'inline; filename="%s"' % (filename,)
+        path = self._path(key)
+        return '%s://%s%s?%s' % (self.endpoint.scheme, self.endpoint.netloc,
+                                 _quote(path, '/-_.~'),
+                                 self.presign('GET', path, self.url_expires,
+                                              query))
+
+    def serve(self, key, mimetype, filename=None):
+        """Redirects the client to a presigned URL for the blob at key"""
+        return redirect(self.url(key, mimetype, filename))
+
+
+def open_store(config):
+    """Opens the blob store an app's config describes"""
+    backend = config.get('UPLOAD_STORAGE', 'local')
+    if backend == 'local':
+        return LocalStore(config['UPLOAD_PATH'], config.get('UPLOAD_URL'))
+    if backend == 's3':
+        return S3Store(config['S3_ENDPOINT'], config['S3_BUCKET'],
+                       config['S3_ACCESS_KEY'], config['S3_SECRET_KEY'],
+                       config.get('S3_REGION', 'us-east-1'),
+                       config.get('S3_URL_EXPIRES', 3600))
+    raise ValueError("Unknown UPLOAD_STORAGE %r" % (backend,))
+
+
+def blob_store():
+    """Returns the blob store for the current app"""
+    store = current_app.extensions.get('spacewiki_storage')
+    if store is None:
+        store = current_app.extensions.setdefault(
+            'spacewiki_storage', open_store(current_app.config))
+    return store
@@ -0,0 +1,109 @@
+from spacewiki.test import create_test_app
+from spacewiki import admission, model
+from spacewiki.auth import tripcodes
+from PIL import Image
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+
+class LimiterTestCase(unittest.TestCase):
+    def test_queue(self):
+        limiter = admission.Limiter(1, queue=1, timeout=5)
+        self.assertEqual(limiter.acquire(), 'ok')
+        outcomes = []
+        waiting = threading.Thread(
+            target=lambda: outcomes.append(limiter.acquire()))
+        waiting.start()
+        while limiter.queued == 0:
+            time.sleep(0.01)
+        self.assertEqual(limiter.acquire(), 'queue')
+        limiter.release()
+        waiting.join(5)
+        self.assertEqual(outcomes, ['ok'])
+        self.assertEqual((limiter.active, limiter.queued), (1, 0))
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+    def test_timeout(self):
+        limiter = admission.Limiter(1, queue=1, timeout=0.05)
+        self.assertEqual(limiter.acquire(), 'ok')
+        self.assertEqual(limiter.acquire(), 'timeout')
+        self.assertEqual((limiter.active, limiter.queued), (1, 0))
+
+
+class TokenBucketsTestCase(unittest.TestCase):
+    def test_take(self):
+        buckets = admission.TokenBuckets(2, 3, clients=2)
+        self.assertEqual([buckets.take('a', 100) for _ in range(3)],
+                         [0, 0, 0])
+        self.assertEqual(buckets.take('a', 100), 0.5)
+        self.assertEqual(buckets.take('b', 100), 0)
+        self.assertEqual(buckets.take('a', 100.5), 0)
+        self.assertEqual(buckets.take('a', 100.5), 0.5)
+        # Pushes out the least recently seen client
+        buckets.take('c', 100.5)
+        self.assertEqual([buckets.take('b', 100.5) for _ in range(3)],
+                         [0, 0, 0])
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.config['ADMISSION_LIMITS'] = {
+            'specials.search': {'concurrency': 1, 'rate': 1, 'burst': 2},
+            'uploads.thumbnail': {'concurrency': 0, 'timeout': 30},
+        }
+        self._app.config['UPLOAD_PATH'] = tempfile.mkdtemp()
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            page = model.Page.create(title='page', slug='page')
+            page.newRevision('Photo', '', tripcodes.new_anon_user())
+            image = os.path.join(tempfile.mkdtemp(), 'photo.png')
+            Image.new('RGB', (64, 64)).save(image, format='png')
+            page.attachUpload(image, 'photo.png')
+        self.client = self._app.test_client()
+
+    def test_rate_limited(self):
+        for _ in range(2):
+            self.assertEqual(self.client.get('/.search?q=a').status_code, 200)
+        resp = self.client.get('/.search?q=a')
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        other = self._app.test_client()
+        resp = other.get('/.search?q=a',
+                         environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_over_concurrency(self):
+        resp = self.client.get('/page/file/photo.png/32')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '30')
+        self.assertEqual(self.client.get('/page/file/photo.png').status_code,
+                         200)
+        # Thumbnails already made are served whatever the limits
+        self._app.config['ADMISSION_LIMITS'] = {}
+        self._app.extensions.pop('spacewiki_admission')
+        self.assertEqual(
+            self.client.get('/page/file/photo.png/32').status_code, 200)
+        self._app.config['ADMISSION_LIMITS'] = {
+            'uploads.thumbnail': {'concurrency': 0, 'timeout': 30}}
+        self._app.extensions.pop('spacewiki_admission')
+        self.assertEqual(
+            self.client.get('/page/file/photo.png/32').status_code, 200)
+
+    def test_metrics(self):
+        self.client.get('/.search?q=a')
+        self.client.get('/page/file/photo.png/32')
+        metrics = self.client.get('/.metrics').get_data()
+        self.assertTrue('spacewiki_admission_admitted_total'
+                        '{route="specials.search"} 1\n' in metrics)
+        self.assertTrue('spacewiki_admission_active'
+                        '{route="specials.search"} 0\n' in metrics)
+        self.assertTrue('spacewiki_admission_queued'
+                        '{route="uploads.thumbnail"} 0\n' in metrics)
+        self.assertTrue('spacewiki_admission_rejected_total'
+                        '{route="uploads.thumbnail",reason="queue"} 1\n'
+                        in metrics)
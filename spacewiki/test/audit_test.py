@@ -0,0 +1,40 @@
+from spacewiki.test import create_test_app
+from spacewiki import audit, model
+import unittest
+
+NEW_INDEXES = ('revision_page_id_id', 'revision_timestamp',
+               'softlink_src_id_dest_id', 'identity_auth_type_auth_id',
+               'page_title')
+
+
+class AuditTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        with self._app.test_request_context('/'):
+            model.syncdb()
+
+    def _scans(self):
+        return dict((name, scans) for name, _, scans in audit.audit_queries()
+                    if scans)
+
+    def test_fresh_schema(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(self._scans(), {})
+            self.assertEqual(model.DatabaseVersion.get().schema_version,
+                             len(model.MIGRATIONS))
+
+    def test_migration(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            for index in NEW_INDEXES:
+                model.DATABASE.execute_sql('DROP INDEX "%s"' % (index,))
+            model.DatabaseVersion.update(schema_version=1).execute()
+            self.assertTrue('recent changes' in self._scans())
+            self.assertTrue('identity' in self._scans())
+            model.syncdb()
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(model.DatabaseVersion.get().schema_version,
+                             len(model.MIGRATIONS))
+            self.assertEqual(self._scans(), {})
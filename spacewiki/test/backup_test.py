@@ -0,0 +1,136 @@
+from spacewiki.test import create_test_app
+from spacewiki import backup, cache, model, storage
+from spacewiki.auth import tripcodes
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+
+class BackupTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.config['UPLOAD_PATH'] = tempfile.mkdtemp()
+        self.tmpdir = tempfile.mkdtemp()
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            author = tripcodes.new_anon_user()
+            for name in ('one', 'two', 'three'):
+                page = model.Page.create(title=name, slug=name)
+                page.newRevision('First %s' % (name,), '', author)
+                page.newRevision('Second %s' % (name,), 'Edited', author)
+            upload = os.path.join(self.tmpdir, 'notes.txt')
+            with open(upload, 'w') as fh:
+                fh.write('attached')
+            page.attachUpload(upload, 'notes.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        shutil.rmtree(self._app.config['UPLOAD_PATH'])
+
+    def _dump(self, compress=True, chunk_size=2):
+        path = os.path.join(self.tmpdir, 'wiki.tar')
+        with self._app.test_request_context('/'):
+            model.get_db()
+            with open(path, 'wb') as fh:
+                backup.write_dump(fh, compress, chunk_size)
+        return path
+
+    def _restore(self, path):
+        app = create_test_app()
+        app.config['UPLOAD_PATH'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app.config['UPLOAD_PATH'])
+        with app.test_request_context('/'):
+            model.syncdb()
+            model.get_db()
+            with open(path, 'rb') as fh:
+                counts = backup.read_dump(fh)
+        return app, counts
+
+    def _check(self, app):
+        with app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(model.Revision.select().count(), 6)
+            self.assertEqual(model.Page.latestRevision('two').body,
+                             'Second two')
+            attachment = model.Attachment.findAttachment('three', 'notes.txt')
+            fh = storage.blob_store().open(model.Attachment.hashPath(
+                attachment.revisions[0].sha))
+            self.assertEqual(fh.read(), 'attached')
+            fh.close()
+            # Ids carry over, so new rows must not collide with restored ones
+            model.Page.create(title='four', slug='four').newRevision(
+                'Fourth', '', tripcodes.new_anon_user())
+
+    def test_round_trip(self):
+        app, counts = self._restore(self._dump())
+        self.assertEqual(counts['revision'], 6)
+        self.assertEqual(counts['blobs'], 1)
+        self._check(app)
+
+    def test_restore_twice(self):
+        path = self._dump()
+        app, _ = self._restore(path)
+        with app.test_request_context('/'):
+            model.get_db()
+            with open(path, 'rb') as fh:
+                counts = backup.read_dump(fh)
+        self.assertEqual(counts['revision'], 0)
+        self._check(app)
+
+    def test_restore_clears_renders(self):
+        path = self._dump()
+        app = create_test_app()
+        app.config['UPLOAD_PATH'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app.config['UPLOAD_PATH'])
+        with app.test_request_context('/'):
+            model.syncdb()
+            model.get_db()
+            # Rendered from whatever the database held before
+            cache.render_cache().put(1, 'Stale', ['one'])
+            with open(path, 'rb') as fh:
+                backup.read_dump(fh)
+            self.assertEqual(cache.render_cache().get(1), None)
+
+    def test_resume(self):
+        path = self._dump(compress=False)
+        with open(path, 'r+b') as fh:
+            fh.truncate(os.path.getsize(path) // 3)
+        end, last_ids, blobs = backup.scan_dump(path)
+        self.assertTrue(last_ids)
+        self.assertTrue(last_ids.get('revision', 0) < 6)
+        with self._app.test_request_context('/'):
+            model.get_db()
+            with open(path, 'r+b') as fh:
+                fh.truncate(end)
+                fh.seek(end)
+                backup.write_dump(fh, False, 2, last_ids, blobs)
+        app, counts = self._restore(path)
+        self.assertEqual(counts['revision'], 6)
+        self._check(app)
+
+    def test_snapshot(self):
+        database = self._app.config['DATABASE_URL'][len('sqlite:///'):]
+        other = sqlite3.connect(database)
+        self.addCleanup(other.close)
+        # So the edit below needn't wait for the dump
+        other.execute('PRAGMA journal_mode=wal')
+        add_member = backup._add_member
+
+        def edit_midway(tarball, name, data):
+            add_member(tarball, name, data)
+            if name.startswith('records/identity/'):
+                other.execute("INSERT INTO revision "
+                              "(page_id, body, message, timestamp, author_id) "
+                              "SELECT page_id, 'Late', '', timestamp, "
+                              "author_id FROM revision LIMIT 1")
+                other.commit()
+        backup._add_member = edit_midway
+        try:
+            path = self._dump()
+        finally:
+            backup._add_member = add_member
+        app, counts = self._restore(path)
+        self.assertEqual(counts['revision'], 6)
+        self._check(app)
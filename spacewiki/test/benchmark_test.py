@@ -0,0 +1,37 @@
+from spacewiki import benchmark
+import shutil
+import unittest
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app, self.tmpdir = benchmark.create_benchmark_app()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_tiny_run(self):
+        with self._app.test_request_context('/'):
+            wiki = benchmark.SyntheticWiki(self._app, 'tiny')
+            wiki.generate()
+        self.assertEqual(len(wiki.pages), benchmark.SCALES['tiny']['pages'])
+        results = benchmark.run_benchmarks(wiki, iterations=3, warmup=1)
+        self.assertEqual(sorted(results.keys()),
+                         sorted(name for name, _ in benchmark.BENCHMARKS))
+        for result in results.values():
+            self.assertTrue(result['p50'] <= result['p99'])
+            self.assertTrue(result['throughput'] > 0)
+
+    def test_compare(self):
+        baseline = {'pages.view': {'p50': 0.010, 'p99': 0.020}}
+        fast = {'pages.view': {'p50': 0.011, 'p99': 0.020}}
+        slow = {'pages.view': {'p50': 0.030, 'p99': 0.020}}
+        self.assertEqual(benchmark.compare(fast, baseline), [])
+        self.assertEqual(benchmark.compare(slow, baseline),
+                         [('pages.view', 'p50', 0.010, 0.030)])
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        self.assertEqual(benchmark.percentile(samples, 50), 50)
+        self.assertEqual(benchmark.percentile(samples, 99), 99)
+        self.assertEqual(benchmark.percentile([], 99), 0.0)
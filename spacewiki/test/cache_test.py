@@ -0,0 +1,125 @@
+from spacewiki.test import create_test_app
+from spacewiki import cache, model
+from spacewiki.auth import tripcodes
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.filename = os.path.join(self.path, 'renders.sqlite3')
+
+    def test_shared_between_instances(self):
+        first = cache.SharedCache(self.filename)
+        second = cache.SharedCache(self.filename)
+        first.put(1, u'caf\xe9', ['a', 'b'])
+        first.put(2, u'two', ['b'])
+        self.assertEqual(second.get(1), u'caf\xe9')
+        self.assertEqual(sorted(second.invalidate('b')), [1, 2])
+        self.assertEqual(first.get(1), None)
+        self.assertEqual(len(first), 0)
+        self.assertEqual(first.bytes, 0)
+
+    def test_put_after_invalidate(self):
+        shared = cache.SharedCache(self.filename)
+        generation = shared.generation()
+        shared.invalidate('b')
+        self.assertFalse(shared.put(1, u'stale', ['a', 'b'], generation))
+        self.assertEqual(shared.get(1), None)
+        self.assertTrue(shared.put(2, u'fresh', ['a'], generation))
+        generation = shared.generation()
+        self.assertTrue(shared.put(1, u'fresh', ['a', 'b'], generation))
+        shared.clear()
+        self.assertFalse(shared.put(2, u'stale', ['a'], generation))
+
+    def test_identity(self):
+        shared = cache.SharedCache(self.filename, identity='1 sqlite:///a')
+        shared.put(1, u'one', ['a'])
+        shared.put_diff(0, 1, [])
+        self.assertEqual(
+            cache.SharedCache(self.filename, identity='1 sqlite:///a').get(1),
+            u'one')
+        moved = cache.SharedCache(self.filename, identity='1 sqlite:///b')
+        self.assertEqual(moved.get(1), None)
+        self.assertEqual(moved.get_diff(0, 1), None)
+        self.assertEqual(moved.bytes, 0)
+
+    def test_diffs(self):
+        shared = cache.SharedCache(self.filename)
+        lines = [{'contents': u'+added', 'type': 'addition'}]
+        shared.put_diff(0, 1, lines)
+        self.assertEqual(shared.get_diff(0, 1), lines)
+        self.assertEqual(shared.get_diff(1, 0), None)
+
+    def test_evict_least_recently_used(self):
+        shared = cache.SharedCache(self.filename, max_bytes=100)
+        for revision in range(5):
+            shared.put(revision, 'x' * 30, ['a'])
+            # Marks revision 0 as used
+            shared._write('UPDATE renders SET used = ? WHERE revision = 0',
+                          time.time() + 1)
+        self.assertTrue(shared.bytes <= 100)
+        self.assertEqual(shared.get(0), 'x' * 30)
+        self.assertEqual(shared.get(1), None)
+        self.assertEqual(shared.get(2), None)
+        self.assertEqual(sorted(shared.invalidate('a')), [0, 3, 4])
+
+
+class SharedRenderCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self._app = create_test_app()
+        self._app.config['RENDER_CACHE_PATH'] = os.path.join(
+            self.path, 'renders.sqlite3')
+        with self._app.test_request_context('/'):
+            model.syncdb()
+
+    def test_save_invalidates(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            author = tripcodes.new_anon_user()
+            linker = model.Page.create(title='linker', slug='linker')
+            revision = linker.newRevision('See [[linked]]', '', author)
+            self.assertTrue('<sup>?</sup>' in revision.html)
+            # Another worker, sharing nothing but the cache file
+            shared = cache.SharedCache(self._app.config['RENDER_CACHE_PATH'])
+            self.assertEqual(shared.get(revision.id), revision.html)
+            model.Page.create(title='linked', slug='linked').newRevision(
+                'Here', '', author)
+            self.assertEqual(shared.get(revision.id), None)
+
+    def test_diffs_cached(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            author = tripcodes.new_anon_user()
+            page = model.Page.create(title='page', slug='page')
+            page.newRevision('one\ntwo', '', author)
+            revision = page.newRevision('one\nthree', '', author)
+            diff = revision.diffToPrev
+            self.assertEqual(
+                cache.diff_cache().get_diff(revision.id, revision.prev.id),
+                diff[2:])
+            self.assertEqual(revision.diffToPrev, diff)
+            page.slug = 'moved'
+            page.save()
+            revision = model.Revision.get(id=revision.id)
+            self.assertEqual(revision.diffToPrev[0]['contents'],
+                             '--- moved@%d' % (revision.id,))
+
+
+class ParseCacheTestCase(unittest.TestCase):
+    def test_evict_least_recently_used(self):
+        parses = cache.ParseCache(size=2)
+        parses.put((1, 'page'), 'one')
+        parses.put((2, 'page'), 'two')
+        self.assertEqual(parses.get((1, 'page')), 'one')
+        parses.put((3, 'page'), 'three')
+        self.assertEqual(parses.get((2, 'page')), None)
+        self.assertEqual(parses.get((1, 'page')), 'one')
+        self.assertEqual(len(parses), 2)
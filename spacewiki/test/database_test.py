@@ -0,0 +1,101 @@
+from spacewiki.test import create_test_app
+from spacewiki import database, importer, model, settings
+from spacewiki.auth import tripcodes
+import peewee
+import threading
+import unittest
+
+
+class ProductionDatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.config['SQLITE_PRODUCTION'] = True
+        self._app.config['SQLITE_PRAGMAS'] = settings.SQLITE_PRAGMAS
+        with self._app.test_request_context('/'):
+            model.syncdb()
+
+    def tearDown(self):
+        self._app.extensions['spacewiki_database'].stop()
+
+    def test_pragmas(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            db = model.DATABASE.obj
+            self.assertTrue(isinstance(db, database.WriterQueueDatabase))
+            self.assertEqual(db.execute_sql(
+                'PRAGMA journal_mode', require_commit=False).fetchone()[0],
+                             'wal')
+            self.assertEqual(db.execute_sql(
+                'PRAGMA synchronous', require_commit=False).fetchone()[0], 1)
+            self.assertEqual(db.execute_sql(
+                'PRAGMA busy_timeout', require_commit=False).fetchone()[0],
+                             10000)
+
+    def test_shared(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            first = model.DATABASE.obj
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertTrue(model.DATABASE.obj is first)
+
+    def test_transaction(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            importer.BulkImporter(batch_size=3).import_all(
+                {'slug': 'bulk-%d' % (i,), 'body': 'Bulk'} for i in range(10))
+            self.assertEqual(model.Page.select().count(), 10)
+            try:
+                with model.DATABASE.transaction():
+                    model.Page.create(title='Rolled back', slug='rolled-back')
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertEqual(model.Page.select().count(), 10)
+
+    def test_concurrent_writers(self):
+        errors = []
+        threads = 8
+        edits = 15
+
+        def worker(number):
+            try:
+                with self._app.test_request_context('/'):
+                    model.get_db()
+                    author = tripcodes.new_anon_user()
+                    home = model.Page.create(title='Home %d' % (number,),
+                                             slug='home-%d' % (number,))
+                    for i in range(edits):
+                        page, _ = model.Page.get_or_create(
+                            slug='shared-%d' % (i,),
+                            defaults={'title': 'Shared %d' % (i,)})
+                        page.newRevision('Edit %d by %d' % (i, number),
+                                         '', author)
+                        page.makeSoftlinkFrom(home)
+                        author.display_name = 'Writer %d.%d' % (number, i)
+                        author.save()
+                        self.assertTrue(model.Page.latestRevision(
+                            page.slug) is not None)
+                        list(home.softlinks_out)
+                    # Transactions read before they write, which is where
+                    # deferred transactions run into 'database is locked'
+                    importer.BulkImporter(batch_size=5).import_all(
+                        {'slug': 'bulk-%d-%d' % (number, i), 'body': 'Bulk',
+                         'author': 'writer%d' % (number,)}
+                        for i in range(edits))
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+
+        workers = [threading.Thread(target=worker, args=(n,))
+                   for n in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(model.Revision.select().count(),
+                             threads * edits * 2)
+            self.assertEqual(model.Softlink.select(
+                peewee.fn.Sum(model.Softlink.hits)).scalar(), threads * edits)
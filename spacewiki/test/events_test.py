@@ -0,0 +1,175 @@
+from spacewiki.test import create_test_app
+from spacewiki import cache, events, model, redirects, typeahead
+from spacewiki.auth import tripcodes
+import collections
+import errno
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+
+class SocketBusTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.here = create_test_app()
+        self.there = create_test_app()
+        self.there.config['DATABASE_URL'] = self.here.config['DATABASE_URL']
+        for app in (self.here, self.there):
+            app.config['EVENT_BUS'] = 'socket'
+            app.config['EVENT_SOCKET_DIR'] = directory
+            self.addCleanup(self.stop_bus, app)
+        with self.here.test_request_context('/'):
+            model.syncdb()
+            author = tripcodes.new_anon_user()
+            model.Page.create(title='Linker', slug='linker').newRevision(
+                'See [[linked]]', '', author)
+            model.Page.create(title='Old', slug='old').newRevision(
+                'Here', '', author)
+            events.bus()
+        with self.there.test_request_context('/'):
+            model.get_db()
+            events.bus()
+            self.assertEqual(typeahead.title_index().complete('l'),
+                             [('linker', 'Linker', 0)])
+            self.assertEqual(len(redirects.redirect_map()), 0)
+            self.linker = model.Page.latestRevision('linker')
+            self.assertTrue('<sup>?</sup>' in self.linker.html)
+
+    def stop_bus(self, app):
+        bus = app.extensions.get('spacewiki_events')
+        if bus is not None:
+            bus.stop()
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            with self.there.test_request_context('/'):
+                if condition():
+                    return True
+            time.sleep(0.02)
+        return False
+
+    def test_page_changed(self):
+        with self.here.test_request_context('/'):
+            model.get_db()
+            author = tripcodes.new_anon_user()
+            model.Page.create(title='Linked', slug='linked').newRevision(
+                'Now I exist', '', author)
+            model.Page.get(slug='old').newRevision('#Redirect linked', '',
+                                                   author)
+        self.assertTrue(self.wait_for(
+            lambda: cache.render_cache().get(self.linker.id) is None))
+        self.assertTrue(self.wait_for(
+            lambda: redirects.indexed().resolve('old').target == 'linked'))
+        self.assertTrue(self.wait_for(
+            lambda: ('linked', 'Linked', 0) in
+            typeahead.indexed().complete('l')))
+
+    def test_everything_changed(self):
+        with self.here.test_request_context('/'):
+            events.publish('all')
+        self.assertTrue(self.wait_for(
+            lambda: redirects.indexed() is None and
+            typeahead.indexed() is None and
+            len(cache.render_cache()) == 0))
+
+    def test_own_events_ignored(self):
+        calls = []
+        events.SUBSCRIBERS['page'].append(calls.append)
+        self.addCleanup(events.SUBSCRIBERS['page'].remove, calls.append)
+        with self.here.test_request_context('/'):
+            events.bus().deliver(
+                '{"origin": "%s", "kind": "page", "key": "mine"}' %
+                (events.bus().origin,))
+            self.assertEqual(calls, [])
+            events.page_changed('theirs')
+        self.assertTrue(self.wait_for(lambda: calls == ['theirs']))
+
+
+class Unreachable(object):
+    """A socket whose every peer has a full buffer"""
+
+    def sendto(self, payload, path):
+        raise socket.error(errno.ENOBUFS, 'No buffer space available')
+
+    def close(self):
+        pass
+
+
+class SocketTransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_stale_socket_removed(self):
+        gone = events.SocketTransport(self.directory, 'gone')
+        gone._sock.close()
+        here = events.SocketTransport(self.directory, 'here')
+        self.addCleanup(here.close)
+        here.send('{}')
+        self.assertEqual(os.listdir(self.directory), ['here.sock'])
+
+    def test_busy_socket_kept(self):
+        there = events.SocketTransport(self.directory, 'there')
+        self.addCleanup(there.close)
+        here = events.SocketTransport(self.directory, 'here')
+        self.addCleanup(here.close)
+        here._sock.close()
+        here._sock = Unreachable()
+        here.send('{}')
+        self.assertTrue(os.path.exists(there.path))
+
+
+class Connection(object):
+    """Stands in for a psycopg2 connection, over a socket that is always
+    readable, that is lost after polls notifications"""
+
+    def __init__(self, polls):
+        self.polls = polls
+        self.notifies = []
+        self._sock, self._peer = socket.socketpair()
+        self._peer.send('x')
+
+    def set_isolation_level(self, level):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        pass
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def poll(self):
+        if not self.polls:
+            raise IOError("server closed the connection unexpectedly")
+        self.polls -= 1
+        self.notifies.append(Notify('{"kind": "page"}'))
+
+    def close(self):
+        self._sock.close()
+        self._peer.close()
+
+
+Notify = collections.namedtuple('Notify', 'payload')
+
+
+class PostgresTransportTestCase(unittest.TestCase):
+    def test_reconnect(self):
+        connections = [Connection(1), Connection(1)]
+        database = collections.namedtuple('Database', 'get_conn')
+        original = events.connect
+        events.connect = lambda url: database(lambda: connections.pop(0))
+        self.addCleanup(setattr, events, 'connect', original)
+        transport = events.PostgresTransport('postgres:///wiki', 'spacewiki')
+        self.assertEqual(transport.receive(1), ['{"kind": "page"}'])
+        self.assertRaises(IOError, transport.receive, 1)
+        self.assertEqual(transport.receive(1),
+                         [events.MISSED, '{"kind": "page"}'])
+        transport.close()
@@ -0,0 +1,120 @@
+from spacewiki.test import create_test_app
+from spacewiki import export, model
+from spacewiki.auth import tripcodes
+from PIL import Image
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.config['UPLOAD_PATH'] = tempfile.mkdtemp()
+        self.output = tempfile.mkdtemp()
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            author = tripcodes.new_anon_user()
+            index = model.Page.create(title='index', slug='index')
+            index.newRevision('Go to [[other]]\n\n{{attachment:red.png:32}}',
+                              '', author)
+            other = model.Page.create(title='other', slug='other')
+            other.newRevision('Hello from other', '', author)
+            moved = model.Page.create(title='moved', slug='moved')
+            moved.newRevision('#Redirect other', '', author)
+            image = os.path.join(tempfile.mkdtemp(), 'red.png')
+            Image.new('RGB', (64, 64), (255, 0, 0)).save(image, format='png')
+            index.attachUpload(image, 'red.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+        shutil.rmtree(self._app.config['UPLOAD_PATH'])
+
+    def _read(self, *path):
+        with open(os.path.join(self.output, *path), 'r') as fh:
+            return fh.read()
+
+    def test_export(self):
+        self.assertEqual(export.export_site(self._app, self.output, 2), 3)
+        self.assertTrue('Hello from other' in self._read('other',
+                                                         'index.html'))
+        self.assertTrue('url=/other/' in self._read('moved', 'index.html'))
+        index = self._read('index.html')
+        self.assertEqual(index, self._read('index', 'index.html'))
+        self.assertTrue('/index/file/thumb-32/red.png' in index)
+        thumbnail = Image.open(os.path.join(self.output, 'index', 'file',
+                                            'thumb-32', 'red.png'))
+        self.assertEqual(thumbnail.size, (32, 32))
+        self.assertTrue(os.path.exists(os.path.join(self.output, 'index',
+                                                    'file', 'red.png')))
+        self.assertTrue(os.path.isdir(os.path.join(self.output, 'static')))
+        with open(os.path.join(self.output, export.MANIFEST)) as fh:
+            self.assertEqual(sorted(json.load(fh)['pages'].keys()),
+                             ['index', 'moved', 'other'])
+
+    def test_redirect_targets(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            author = tripcodes.new_anon_user()
+            model.Page.create(title='bare', slug='bare').newRevision(
+                '#Redirect', '', author)
+            model.Page.create(title='quoted', slug='quoted').newRevision(
+                '#Redirect Other "Page"><script>\nmore', '', author)
+        export.export_site(self._app, self.output, 1)
+        bare = self._read('bare', 'index.html')
+        self.assertFalse('http-equiv="refresh"' in bare)
+        self.assertTrue('Redirect' in bare)
+        quoted = self._read('quoted', 'index.html')
+        self.assertTrue('url=/other-pagescript/' in quoted)
+        self.assertFalse('<script>' in quoted)
+
+    def test_incremental(self):
+        export.export_site(self._app, self.output, 1)
+        self.assertEqual(
+            export.export_site(self._app, self.output, 1, incremental=True),
+            0)
+        with self._app.test_request_context('/'):
+            model.get_db()
+            other = model.Page.get(slug='other')
+            other.newRevision('Changed', '', tripcodes.new_anon_user())
+            model.Page.create(title='new', slug='new').newRevision(
+                'New page', '', tripcodes.new_anon_user())
+        # other changed, new is new, and index links to other and is next
+        # to new
+        self.assertEqual(
+            export.export_site(self._app, self.output, 1, incremental=True),
+            3)
+        self.assertTrue('Changed' in self._read('other', 'index.html'))
+
+    def test_incremental_structure(self):
+        export.export_site(self._app, self.output, 1)
+        author = tripcodes.new_anon_user()
+        with self._app.test_request_context('/'):
+            model.get_db()
+            child = model.Page.create(title='Child', slug='other/child')
+            child.newRevision('Under other', '', author)
+        # other lists its new subpage
+        self.assertEqual(
+            export.export_site(self._app, self.output, 1, incremental=True),
+            2)
+        self.assertTrue('Child' in self._read('other', 'index.html'))
+        with self._app.test_request_context('/'):
+            model.get_db()
+            child.newRevision('Back to [[other]]', '', author)
+        # other has a new backlink
+        self.assertEqual(
+            export.export_site(self._app, self.output, 1, incremental=True),
+            2)
+        self.assertTrue('/other/child' in self._read(
+            'other', 'index.html').split('class="backlinks"')[1])
+        with self._app.test_request_context('/'):
+            model.get_db()
+            model.Page.create(title='Navigation',
+                              slug='.spacewiki/navigation-list').newRevision(
+                                  'other/child', '', author)
+        # Every page shows the navigation, and redirects show no page at all
+        self.assertEqual(
+            export.export_site(self._app, self.output, 1, incremental=True),
+            4)
@@ -0,0 +1,106 @@
+from spacewiki.test import create_test_app
+from spacewiki import importer, model
+from spacewiki.auth import tripcodes
+from StringIO import StringIO
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+
+class ImporterTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self.tmpdir = tempfile.mkdtemp()
+        with self._app.app_context():
+            model.syncdb()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, contents):
+        path = os.path.join(self.tmpdir, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(contents)
+        return path
+
+    def test_directory(self):
+        self._write('tree/Shop Tools.md', 'Lathe')
+        self._write('tree/shop-tools/Drill Press.md', 'Drill')
+        self._write('tree/notes.txt', 'Ignored')
+        with self._app.test_request_context('/'):
+            model.get_db()
+            bulk = importer.BulkImporter(batch_size=1)
+            bulk.import_all(importer.read_source(
+                os.path.join(self.tmpdir, 'tree'), 'wiki'))
+            self.assertEqual(bulk.revision_count, 2)
+            page = model.Page.get(slug='wiki/shop-tools/drill-press')
+            self.assertEqual(page.title, 'Drill Press')
+            self.assertEqual(model.Page.latestRevision(page.slug).body,
+                             'Drill')
+
+    def test_jsonl_history(self):
+        records = [
+            {'slug': 'history', 'title': 'History', 'body': 'one',
+             'author': 'alice#secret', 'timestamp': '2015-01-01T00:00:00'},
+            {'slug': 'history', 'body': 'two', 'author': 'bob',
+             'message': 'Second'},
+            {'slug': 'other', 'body': 'other'},
+        ]
+        path = self._write('dump.jsonl',
+                           '\n'.join(json.dumps(r) for r in records))
+        with self._app.test_request_context('/'):
+            model.get_db()
+            existing = model.Page.create(title='Other', slug='other')
+            importer.BulkImporter(batch_size=2).import_all(
+                importer.read_source(path))
+            page = model.Page.get(slug='history')
+            revisions = list(page.revisions.order_by(model.Revision.id))
+            self.assertEqual([r.body for r in revisions], ['one', 'two'])
+            self.assertEqual(revisions[0].timestamp.year, 2015)
+            self.assertEqual(revisions[1].message, 'Second')
+            self.assertTrue(revisions[0].author.handle.startswith('alice$'))
+            self.assertEqual(revisions[1].author.handle, 'bob')
+            self.assertEqual(model.Page.latestRevision('other').page.id,
+                             existing.id)
+            self.assertEqual(model.Identity.select().count(), 3)
+
+    def test_tarball(self):
+        path = os.path.join(self.tmpdir, 'dump.tar.gz')
+        with tarfile.open(path, 'w:gz') as tarball:
+            for name, contents in (('a.md', 'A'), ('more.jsonl',
+                                   json.dumps({'slug': 'b', 'body': 'B'}))):
+                info = tarfile.TarInfo(name)
+                info.size = len(contents)
+                tarball.addfile(info, StringIO(contents))
+        with self._app.test_request_context('/'):
+            model.get_db()
+            importer.BulkImporter().import_all(importer.read_source(path))
+            self.assertEqual(model.Page.latestRevision('a').body, 'A')
+            self.assertEqual(model.Page.latestRevision('b').body, 'B')
+
+    def test_links_recorded(self):
+        records = [
+            {'slug': 'linker', 'body': 'See [[first]]'},
+            {'slug': 'includer', 'body': '{{template}}'},
+            {'slug': 'linker', 'body': 'See [[second]] and `[[code]]`'},
+        ]
+        with self._app.test_request_context('/'):
+            model.get_db()
+            linker = model.Page.create(title='Linker', slug='linker')
+            linker.newRevision('See [[old]]', '', tripcodes.new_anon_user())
+        # As the import commands run it
+        with self._app.app_context():
+            model.get_db()
+            importer.BulkImporter(batch_size=2).import_all(records)
+            self.assertEqual(
+                sorted(model.PageLink.select(model.Page.slug,
+                                             model.PageLink.dest_slug,
+                                             model.PageLink.kind)
+                       .join(model.Page).tuples()),
+                [('includer', 'template', 'include'),
+                 ('linker', 'second', 'link')])
@@ -0,0 +1,120 @@
+from spacewiki.test import create_test_app
+from spacewiki import model, move
+from spacewiki.auth import tripcodes
+from spacewiki.wikiformat import directives, links
+import unittest
+
+
+class MoveTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.secret_key = 'move'
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            author = tripcodes.new_anon_user()
+            for slug, body in (('tools', 'See [[tools/laser]]'),
+                               ('tools/laser', 'Cuts things'),
+                               ('tools/laser/safety', 'Goggles'),
+                               ('toolshed', 'Not a subpage'),
+                               ('index', '[[Tools/Laser]] {{tools/laser}}'),
+                               ('other', '[[tools|The tools]] [[toolshed]]')):
+                model.Page.create(title=slug, slug=slug).newRevision(
+                    body, '', author)
+        self.app = self._app.test_client()
+
+    def test_rewrite(self):
+        target = move.subtree_target('a', 'b/a')
+        with self._app.test_request_context('/'):
+            self.assertEqual(links.rewrite('[[A]] [[a/c|C]] [[ab]]', target),
+                             '[[b/a|A]] [[b/a/c|C]] [[ab]]')
+            self.assertEqual(directives.rewrite('{{a/c}} {{attachment:a}}',
+                                                target),
+                             '{{b/a/c}} {{attachment:a}}')
+            self.assertEqual(
+                links.rewrite('[[A]] `[[a]]`\n\n    [[a]]', target),
+                '[[b/a|A]] `[[a]]`\n\n    [[a]]')
+            self.assertEqual(directives.rewrite('{{a}} `{{a}}`', target),
+                             '{{b/a}} `{{a}}`')
+
+    def test_move_subtree(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            moved = move.move_subtree('tools', 'workshop/tools',
+                                      tripcodes.new_anon_user())
+            self.assertEqual(len(moved.pages), 3)
+            self.assertEqual([page.slug for page in moved.referrers],
+                             ['index', 'other', 'workshop/tools'])
+            self.assertEqual(sorted(slug for (slug,) in model.Page.select(
+                model.Page.slug).tuples()),
+                ['index', 'other', 'toolshed', 'workshop/tools',
+                 'workshop/tools/laser', 'workshop/tools/laser/safety'])
+
+    def test_redirects_and_links(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            moved = move.move_subtree('tools', 'shop',
+                                      tripcodes.new_anon_user(),
+                                      redirects=True, rewrite_links=True)
+            self.assertEqual(moved.redirects, 3)
+            self.assertEqual(len(moved.rewritten), 3)
+            self.assertEqual(model.Page.latestRevision('index').body,
+                             '[[shop/laser|Tools/Laser]] {{shop/laser}}')
+            self.assertEqual(model.Page.latestRevision('shop').body,
+                             'See [[shop/laser|tools/laser]]')
+            self.assertEqual(model.Page.latestRevision('tools/laser').body,
+                             '#Redirect shop/laser')
+            self.assertEqual(
+                [p.slug for p in model.Page.get(slug='shop/laser').backlinks],
+                ['index', 'shop'])
+        resp = self.app.get('/tools/laser/safety')
+        self.assertTrue('Goggles' in resp.data)
+
+    def test_includes_rewritten(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            model.Page.create(title='bench', slug='bench').newRevision(
+                'Safety first: {{tools/laser/safety}}', '',
+                tripcodes.new_anon_user())
+            moved = move.move_subtree('tools', 'equipment',
+                                      tripcodes.new_anon_user(),
+                                      redirects=True, rewrite_links=True)
+            self.assertTrue('bench' in
+                            [page.slug for page in moved.referrers])
+            self.assertEqual(model.Page.latestRevision('bench').body,
+                             'Safety first: {{equipment/laser/safety}}')
+            self.assertEqual(
+                [p.slug for p in
+                 model.Page.get(slug='equipment/laser/safety').backlinks],
+                [])
+        self.assertTrue('Goggles' in self.app.get('/bench').data)
+
+    def test_collision(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            model.Page.create(title='x', slug='shop/laser')
+            with self.assertRaises(move.MoveCollision) as raised:
+                move.move_subtree('tools', 'shop', tripcodes.new_anon_user())
+            self.assertEqual(raised.exception.slugs, ['shop/laser'])
+            with self.assertRaises(ValueError):
+                move.move_subtree('tools', 'tools/old',
+                                  tripcodes.new_anon_user())
+            self.assertEqual(model.Page.get(slug='tools/laser').title,
+                             'tools/laser')
+
+    def test_editor_moves_subpages(self):
+        resp = self.app.post('/tools', data={
+            'title': 'Shop',
+            'slug': 'shop',
+            'body': 'Moved',
+            'author': '',
+            'message': '',
+            'redirect': 'on',
+        })
+        self.assertEqual(resp.status_code, 302)
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(model.Page.get(slug='shop').title, 'Shop')
+            self.assertEqual(model.Page.latestRevision('shop').body, 'Moved')
+            model.Page.get(slug='shop/laser/safety')
+            self.assertEqual(model.Page.latestRevision('tools').body,
+                             '#Redirect shop')
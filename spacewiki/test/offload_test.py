@@ -0,0 +1,101 @@
+from spacewiki.test import create_test_app
+from spacewiki import model, offload
+from spacewiki.auth import tripcodes
+import gevent
+import time
+import unittest
+
+
+def slow_diff(*args):
+    time.sleep(1)
+    return []
+
+
+class OffloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.config['OFFLOAD_POOL'] = 'thread'
+        self._app.config['OFFLOAD_WORKERS'] = 2
+        self._app.config['OFFLOAD_BUDGETS'] = {'diff': 0.1}
+        self.addCleanup(self.close_pool)
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            page = model.Page.create(title='big', slug='big')
+            author = tripcodes.new_anon_user()
+            page.newRevision('\n'.join('line %d' % i for i in range(300)), '',
+                             author)
+            page.newRevision('\n'.join('line %d' % (i * 2)
+                                       for i in range(300)), '', author)
+
+    def close_pool(self):
+        pool = self._app.extensions.get('spacewiki_offload')
+        if pool is not None:
+            pool.terminate()
+
+    def test_inline(self):
+        self._app.config['OFFLOAD_POOL'] = None
+        with self._app.test_request_context('/'):
+            self.assertEqual(offload.run('render', sorted, [2, 1]), [1, 2])
+            self.assertTrue('spacewiki_offload' not in self._app.extensions)
+
+    def test_process_pool(self):
+        self._app.config['OFFLOAD_POOL'] = 'process'
+        text = '*emphasis* ' * 1000
+        with self._app.test_request_context('/'):
+            self.assertEqual(model.Revision.render_text(text, 'big'),
+                             model.Revision.render_text(text, 'big'))
+            self.assertTrue('<em>emphasis</em>' in
+                            model.Revision.render_text(text, 'big'))
+
+    def test_budget(self):
+        with self._app.test_request_context('/'):
+            with self.assertRaises(offload.TaskTimeout):
+                offload.run('diff', time.sleep, 1)
+
+    def test_backlog(self):
+        self._app.config['OFFLOAD_BACKLOG'] = 1
+        with self._app.test_request_context('/'):
+            with self.assertRaises(offload.TaskTimeout):
+                offload.run('diff', time.sleep, 0.3)
+            # Still running, so there's no room for another
+            with self.assertRaises(offload.TaskTimeout):
+                offload.run('render', sorted, [2, 1])
+            time.sleep(0.4)
+            self.assertEqual(offload.run('render', sorted, [2, 1]), [1, 2])
+
+    def test_default_workers(self):
+        self.assertTrue(offload.default_workers({}) >= 1)
+        self.assertEqual(offload.default_workers({'SERVER_WORKERS': 10 ** 6}),
+                         1)
+
+    def test_hub_keeps_running(self):
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(time.time())
+                gevent.sleep(0.01)
+
+        ticker = gevent.spawn(tick)
+        try:
+            with self._app.test_request_context('/'):
+                start = time.time()
+                offload.run('render', time.sleep, 0.3)
+            # The ticker ran all through the wait, not only after it
+            self.assertTrue(len([t for t in ticks if t < start + 0.3]) > 5)
+        finally:
+            ticker.kill()
+
+    def test_diff_fallback(self):
+        with self._app.test_request_context('/'):
+            old, new = model.Page.get(slug='big').revisions
+            self.assertTrue({'contents': '+line 598', 'type': 'addition'}
+                            in old.diffTo(new))
+            original = model.diff_lines
+            model.diff_lines = slow_diff
+            try:
+                diff = old.diffTo(new)
+            finally:
+                model.diff_lines = original
+            self.assertEqual(len(diff), 1)
+            self.assertTrue('differ too much' in diff[0]['contents'])
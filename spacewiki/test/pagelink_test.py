@@ -0,0 +1,88 @@
+from spacewiki.test import create_test_app
+from spacewiki import model
+from spacewiki.auth import tripcodes
+from spacewiki.wikiformat import links
+import unittest
+
+
+class PageLinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            author = tripcodes.new_anon_user()
+            for slug, body in (('index', 'See [[Tools]] and [[Missing]]'),
+                               ('tools', '[[Laser Cutter|the laser]]'),
+                               ('laser-cutter', 'Back to [[tools]]'),
+                               ('lonely', 'Wants [[missing]], [[Other]]')):
+                model.Page.create(title=slug, slug=slug).newRevision(
+                    body, '', author)
+        self.app = self._app.test_client()
+
+    def test_parse(self):
+        with self._app.test_request_context('/'):
+            self.assertEqual(
+                links.parse('[[A Page]]\n[[b|Title]] [[a page]]'),
+                set(['a-page', 'b']))
+            self.assertEqual(
+                links.parse('`[[code]]` [[a]]\n\n    [[block]]'),
+                set(['a']))
+
+    def test_backlinks(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            tools = model.Page.get(slug='tools')
+            self.assertEqual([p.slug for p in tools.backlinks],
+                             ['index', 'laser-cutter'])
+            model.Page.get(slug='index').newRevision(
+                'No more links', '', tripcodes.new_anon_user())
+            self.assertEqual([p.slug for p in tools.backlinks],
+                             ['laser-cutter'])
+        self.assertTrue('What links here' in self.app.get('/tools').data)
+
+    def test_orphaned_and_wanted(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual([p.slug for p in model.Page.orphaned()],
+                             ['lonely'])
+            self.assertEqual(list(model.Page.wanted()),
+                             [('missing', 2), ('other', 1)])
+        self.assertTrue('lonely' in self.app.get('/.orphaned-pages').data)
+        self.assertTrue('missing' in self.app.get('/.wanted-pages').data)
+
+    def test_migration(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            model.PageLink.delete().execute()
+            model.DatabaseVersion.update(schema_version=2).execute()
+            model.syncdb()
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(model.PageLink.select().count(), 6)
+
+    def test_includes_migration(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            model.Page.create(title='shop', slug='shop').newRevision(
+                '{{tools}}', '', tripcodes.new_anon_user())
+            model.DATABASE.drop_table(model.PageLink)
+            model.DATABASE.execute_sql(
+                'CREATE TABLE pagelink (id INTEGER NOT NULL PRIMARY KEY, '
+                'src_id INTEGER NOT NULL, dest_slug VARCHAR(255) NOT NULL)')
+            model.DATABASE.execute_sql(
+                'CREATE UNIQUE INDEX pagelink_src_id_dest_slug '
+                'ON pagelink (src_id, dest_slug)')
+            model.DatabaseVersion.update(
+                schema_version=len(model.MIGRATIONS) - 1).execute()
+            model.syncdb()
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(
+                [(link.src.slug, link.kind) for link in
+                 model.PageLink.select().where(
+                     model.PageLink.dest_slug == 'tools')
+                 .order_by(model.PageLink.kind)],
+                [('shop', 'include'), ('index', 'link'),
+                 ('laser-cutter', 'link')])
+            self.assertEqual(model.DatabaseVersion.get().schema_version,
+                             len(model.MIGRATIONS))
@@ -0,0 +1,136 @@
+from spacewiki.test import create_test_app
+from spacewiki import cache, model, prerender
+from spacewiki.auth import tripcodes
+from StringIO import StringIO
+import shutil
+import tempfile
+import unittest
+
+
+class RenderCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        render_cache = cache.RenderCache(2)
+        render_cache.put(1, 'one', ['a'])
+        render_cache.put(2, 'two', ['b'])
+        render_cache.get(1)
+        render_cache.put(3, 'three', ['c'])
+        self.assertEqual(render_cache.get(1), 'one')
+        self.assertEqual(render_cache.get(2), None)
+        self.assertEqual(render_cache.get(3), 'three')
+        self.assertEqual(render_cache.invalidate('b'), [])
+
+    def test_invalidate(self):
+        render_cache = cache.RenderCache()
+        render_cache.put(1, 'one', ['a', 'b'])
+        render_cache.put(2, 'two', ['b'])
+        self.assertEqual(sorted(render_cache.invalidate('b')), [1, 2])
+        self.assertEqual(render_cache.get(1), None)
+        self.assertEqual(render_cache.invalidate('a'), [])
+
+    def test_put_after_invalidate(self):
+        render_cache = cache.RenderCache()
+        generation = render_cache.generation()
+        render_cache.invalidate('b')
+        self.assertFalse(render_cache.put(1, 'stale', ['a', 'b'], generation))
+        self.assertEqual(render_cache.get(1), None)
+        self.assertTrue(render_cache.put(2, 'fresh', ['a'], generation))
+        render_cache.clear()
+        self.assertFalse(render_cache.put(2, 'stale', ['a'], generation))
+        self.assertTrue(render_cache.put(2, 'fresh', ['a'],
+                                         render_cache.generation()))
+
+
+class PrerenderTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.config['PRERENDER_WORKERS'] = 2
+        with self._app.app_context():
+            model.syncdb()
+
+    def test_render_on_save(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            author = tripcodes.new_anon_user()
+            page = model.Page.create(title='linker', slug='linker')
+            revision = page.newRevision('See [[linked]]', '', author)
+            queue = prerender.render_queue()
+            queue.join()
+            render_cache = cache.render_cache()
+            self.assertTrue('<sup>?</sup>' in render_cache.get(revision.id))
+
+            linked = model.Page.create(title='linked', slug='linked')
+            linked_revision = linked.newRevision('Hello', '', author)
+            queue.join()
+            self.assertFalse('<sup>?</sup>' in render_cache.get(revision.id))
+            self.assertTrue('Hello' in render_cache.get(linked_revision.id))
+
+    def test_render_uncached_dependents(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            author = tripcodes.new_anon_user()
+            revision = model.Page.create(title='linker', slug='linker') \
+                .newRevision('See [[linked]]', '', author)
+            queue = prerender.render_queue()
+            queue.join()
+            # As if only another process had rendered it
+            render_cache = cache.render_cache()
+            render_cache.clear()
+            model.Page.create(title='linked', slug='linked') \
+                .newRevision('Hello', '', author)
+            queue.join()
+            self.assertFalse('<sup>?</sup>' in render_cache.get(revision.id))
+
+    def test_render_on_upload(self):
+        self._app.config['UPLOAD_PATH'] = tempfile.mkdtemp()
+        try:
+            with self._app.test_request_context('/'):
+                model.get_db()
+                revision = model.Page.create(title='gallery', slug='gallery') \
+                    .newRevision('{{attachment:notes.txt}}', '',
+                                 tripcodes.new_anon_user())
+                queue = prerender.render_queue()
+                queue.join()
+                render_cache = cache.render_cache()
+                self.assertFalse('notes.txt' in render_cache.get(revision.id))
+            self._app.test_client().post('/gallery/attach', data={
+                'file': (StringIO('NOTES'), 'notes.txt')})
+            with self._app.test_request_context('/'):
+                queue.join()
+                self.assertTrue('notes.txt' in render_cache.get(revision.id))
+        finally:
+            shutil.rmtree(self._app.config['UPLOAD_PATH'])
+
+    def test_deduplicate(self):
+        with self._app.app_context():
+            queue = prerender.RenderQueue(self._app, workers=0)
+            self.assertTrue(queue.put(1, prerender.PRIORITY_DEPENDENT))
+            self.assertFalse(queue.put(1, prerender.PRIORITY_DEPENDENT))
+            self.assertTrue(queue.put(1, prerender.PRIORITY_SAVED))
+            self.assertFalse(queue.put(1, prerender.PRIORITY_DEPENDENT))
+
+    def test_changed_while_rendering(self):
+        # Rendered here rather than by the workers, so the render can be
+        # interrupted
+        self._app.config['PRERENDER_WORKERS'] = 0
+        with self._app.test_request_context('/'):
+            model.get_db()
+            author = tripcodes.new_anon_user()
+            revision = model.Page.create(title='linker', slug='linker') \
+                .newRevision('See [[linked]]', '', author)
+            render_text = model.Revision.render_text
+
+            def save_linked(*args):
+                html = render_text(*args)
+                # Saved after the render looked linked up, before it's put
+                model.Page.create(title='linked', slug='linked') \
+                    .newRevision('Hello', '', author)
+                return html
+            model.Revision.render_text = staticmethod(save_linked)
+            try:
+                html = model.Revision.get(id=revision.id).html
+            finally:
+                model.Revision.render_text = staticmethod(render_text)
+            self.assertTrue('<sup>?</sup>' in html)
+            self.assertEqual(cache.render_cache().get(revision.id), None)
+            self.assertFalse('<sup>?</sup>' in
+                             model.Revision.get(id=revision.id).html)
@@ -0,0 +1,74 @@
+from spacewiki.test import create_test_app
+from spacewiki import model, preview
+import json
+import unittest
+
+
+class PreviewTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        with self._app.app_context():
+            model.syncdb()
+        self.app = self._app.test_client()
+
+    def _post(self, seq, base, body, session='editor'):
+        resp = self.app.post('/preview', data={
+            'session': session, 'seq': seq, 'base': base, 'body': body,
+            'slug': 'page'})
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(resp.data)
+
+    def test_split_blocks(self):
+        text = 'a\nb\n\n\nc\r\n\r\n```\nx\n\ny\n```\n'
+        self.assertEqual(preview.split_blocks(text),
+                         ['a\nb', 'c', '```\nx\n\ny\n```'])
+
+    def test_split_blocks_whole(self):
+        text = '1. one\n\n2. two\n\n   more of two\n\n<div>\n\nhi\n\n</div>'
+        self.assertEqual(preview.split_blocks(text),
+                         ['1. one\n\n2. two\n\n   more of two',
+                          '<div>\n\nhi\n\n</div>'])
+        # Definitions apply to the whole page
+        text = 'See [the site][site]\n\n[site]: http://example.com'
+        self.assertEqual(preview.split_blocks(text), [text])
+
+    def test_plain_preview(self):
+        resp = self.app.post('/preview', data={'body': '*hi*', 'slug': 'page'})
+        self.assertTrue('<em>hi</em>' in resp.data)
+
+    def test_incremental(self):
+        first = self._post(1, -1, 'One\n\nTwo [[other]]\n\nThree')
+        self.assertEqual(len(first['blocks']), 3)
+        self.assertTrue(all('html' in block for block in first['blocks']))
+        second = self._post(2, 1, 'One\n\nTwo [[other]]\n\nThree!\n\nFour')
+        self.assertEqual([block['id'] for block in second['blocks'][:2]],
+                         [block['id'] for block in first['blocks'][:2]])
+        self.assertEqual(['html' in block for block in second['blocks']],
+                         [False, False, True, True])
+        self.assertTrue('Four' in second['blocks'][3]['html'])
+        # A client that lost track of the last response gets everything
+        third = self._post(3, -1, 'One\n\nTwo [[other]]\n\nThree!\n\nFour')
+        self.assertTrue(all('html' in block for block in third['blocks']))
+
+    def test_superseded(self):
+        self._post(5, -1, 'Newer')
+        self.assertEqual(self._post(4, -1, 'Older'),
+                         {'seq': 4, 'superseded': True})
+        self.assertFalse('superseded' in self._post(1, -1, 'Other',
+                                                    session='another'))
+
+    def test_cached_resolution(self):
+        lookups = []
+        with self._app.test_request_context('/'):
+            model.get_db()
+            resolver = preview.CachingResolver()
+            original = model.Page.__dict__['latestRevision']
+            try:
+                model.Page.latestRevision = classmethod(
+                    lambda cls, slug, body=True: lookups.append(slug))
+                resolver.latest_revision('other')
+                resolver.latest_revision('other')
+            finally:
+                model.Page.latestRevision = original
+        self.assertEqual(lookups, ['other'])
+        self.assertEqual(resolver.dependencies, set(['other']))
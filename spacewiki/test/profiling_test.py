@@ -0,0 +1,54 @@
+from spacewiki.test import create_test_app
+from spacewiki import middleware, model, profiling
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+        self._app = create_test_app()
+        self._app.wsgi_app = middleware.SamplingProfiler(
+            self._app.wsgi_app, self._app.url_map, self.spool,
+            secret='sekrit')
+        with self._app.app_context():
+            model.syncdb()
+        self.app = self._app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool)
+
+    def test_unsampled(self):
+        self.assertEqual(self.app.get('/.search?q=foo').status_code, 200)
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_header(self):
+        resp = self.app.get('/.search?q=foo',
+                            headers={'X-Spacewiki-Profile': 'sekrit'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(os.listdir(self.spool), ['specials.search'])
+        self.assertEqual(
+            len(glob.glob(os.path.join(self.spool, 'specials.search', '*'))),
+            1)
+
+    def test_wrong_secret(self):
+        self.app.get('/.search?q=foo', headers={'X-Spacewiki-Profile': 'no'})
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_collapse(self):
+        for _ in range(2):
+            self.app.get('/.search?q=foo',
+                         headers={'X-Spacewiki-Profile': 'sekrit'})
+        merged = profiling.load_spool(self.spool)
+        self.assertEqual(merged.keys(), ['specials.search'])
+        lines = profiling.collapse_stats(merged['specials.search'],
+                                         'specials.search')
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('specials.search;'))
+            self.assertTrue(int(count) > 0)
+        self.assertTrue([l for l in lines if 'search (specials.py' in l])
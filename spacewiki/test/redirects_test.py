@@ -0,0 +1,79 @@
+from spacewiki.test import create_test_app
+from spacewiki import model, redirects
+from spacewiki.auth import tripcodes
+import unittest
+
+
+class RedirectMapTestCase(unittest.TestCase):
+    def test_resolve(self):
+        redirect_map = redirects.RedirectMap()
+        redirect_map.load([('a', 'b'), ('b', 'c'), ('x', 'y'), ('y', 'x')])
+        self.assertEqual(redirect_map.resolve('a'),
+                         (('a', 'b', 'c'), False))
+        self.assertTrue(redirect_map.resolve('a').double)
+        self.assertEqual(redirect_map.resolve('c'), (('c',), False))
+        self.assertEqual(redirect_map.resolve('x'), (('x', 'y'), True))
+        self.assertEqual(redirect_map.follow('new', 'a').target, 'c')
+        redirect_map.set('b', None)
+        self.assertEqual(redirect_map.resolve('a').target, 'b')
+
+    def test_redirect_target(self):
+        self.assertEqual(redirects.redirect_target('#Redirect foo\nbar'),
+                         'foo')
+        self.assertEqual(redirects.redirect_target('#Redirect'), None)
+        self.assertEqual(redirects.redirect_target('Not a redirect'), None)
+
+
+class RedirectTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            author = tripcodes.new_anon_user()
+            for slug, body in (('first', '#Redirect second'),
+                               ('second', '#Redirect third'),
+                               ('third', 'The end of the line'),
+                               ('ping', '#Redirect pong'),
+                               ('pong', '#Redirect ping'),
+                               ('lost', '#Redirect nowhere')):
+                model.Page.create(title=slug, slug=slug).newRevision(
+                    body, '', author)
+        self.app = self._app.test_client()
+
+    def test_chain(self):
+        resp = self.app.get('/first')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('The end of the line' in resp.data)
+        self.assertTrue('Redirected from' in resp.data)
+
+    def test_loop(self):
+        resp = self.app.get('/ping')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('Redirect loop' in resp.data)
+
+    def test_map_follows_saves(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            redirect_map = redirects.redirect_map()
+            self.assertEqual(len(redirect_map), 5)
+            self.assertEqual(redirect_map.resolve('first').target, 'third')
+            model.Page.get(slug='second').newRevision(
+                'Stop here', '', tripcodes.new_anon_user())
+            self.assertEqual(redirect_map.resolve('first').target, 'second')
+        self.assertTrue('Stop here' in self.app.get('/first').data)
+
+    def test_stale_map(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            redirects.redirect_map().set('second', None)
+        self.assertTrue('The end of the line' in self.app.get('/first').data)
+
+    def test_special_page(self):
+        resp = self.app.get('/.redirects')
+        self.assertEqual(resp.status_code, 200)
+        loops, rest = resp.data.split('Broken redirects')
+        broken, double = rest.split('Double redirects')
+        self.assertTrue('ping' in loops)
+        self.assertTrue('nowhere' in broken)
+        self.assertTrue('first' in double)
+        self.assertFalse('first' in broken)
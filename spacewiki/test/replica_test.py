@@ -0,0 +1,64 @@
+from spacewiki.test import create_test_app
+from spacewiki import cache, model
+from spacewiki.auth import tripcodes
+import unittest
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """Uses a second, diverged sqlite database as the replica so it is
+    obvious which database each request read from"""
+
+    def setUp(self):
+        replica = create_test_app()
+        self._app = create_test_app()
+        self._app.secret_key = 'replica'
+        self._app.config['DATABASE_REPLICA_URLS'] = [
+            replica.config['DATABASE_URL']]
+        for app, body in ((self._app, 'From the primary'),
+                          (replica, 'From the replica')):
+            with app.test_request_context('/'):
+                model.syncdb()
+                page = model.Page.create(title='shared', slug='shared')
+                page.newRevision(body, '', tripcodes.new_anon_user())
+                model.Page.create(title='other', slug='other').newRevision(
+                    'Other', '', tripcodes.new_anon_user())
+        # A real replica never has a different revision under the same id,
+        # so nothing kept by revision id while saving may be reused here
+        self._app.extensions.pop('spacewiki_parse_cache', None)
+        self.replica = replica
+        self.app = self._app.test_client()
+
+    def test_reads_from_replica(self):
+        self.assertTrue('From the replica' in self.app.get('/shared').data)
+        self.assertTrue('From the primary' in self.app.get('/shared/edit').data)
+
+    def test_replica_renders_not_cached(self):
+        self.assertTrue('From the replica' in self.app.get('/shared').data)
+        with self._app.test_request_context('/'):
+            self.assertEqual(len(cache.render_cache()), 0)
+            self._app.extensions.pop('spacewiki_parse_cache', None)
+            model.get_db()
+            self.assertTrue('From the primary' in
+                            model.Page.latestRevision('shared').html)
+            self.assertEqual(len(cache.render_cache()), 1)
+
+    def test_sticky_after_write(self):
+        self.app.post('/shared', data={'title': 'shared', 'slug': 'shared',
+                                       'body': 'Edited', 'author': '',
+                                       'message': ''})
+        self.assertTrue('Edited' in self.app.get('/shared').data)
+        self._app.config['REPLICA_STICKY_SECONDS'] = -1
+        self.app.post('/shared', data={'title': 'shared', 'slug': 'shared',
+                                       'body': 'Edited again', 'author': '',
+                                       'message': ''})
+        self.assertTrue('From the replica' in self.app.get('/shared').data)
+
+    def test_softlinks_written_to_primary(self):
+        self.app.get('/shared', headers={'Referer': 'http://localhost/other',
+                                         'Host': 'localhost'})
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(model.Softlink.select().count(), 1)
+        with self.replica.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(model.Softlink.select().count(), 0)
@@ -0,0 +1,58 @@
+from spacewiki.test import create_test_app
+from spacewiki import model
+from spacewiki.auth import tripcodes
+import unittest
+
+
+class RevisionMetadataTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            author = tripcodes.new_anon_user()
+            self.page = model.Page.create(title='minutes', slug='minutes')
+            self.ids = [self.page.newRevision('Minutes %d' % (i,),
+                                              'Meeting %d' % (i,), author).id
+                        for i in range(3)]
+
+    def test_body_deferred(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            revision = model.Page.latestRevision('minutes', body=False)
+            self.assertFalse('body' in revision._data)
+            self.assertEqual(revision.message, 'Meeting 2')
+            self.assertEqual(revision.body, 'Minutes 2')
+            self.assertTrue('body' in revision._data)
+            self.assertTrue('body' in
+                            model.Page.latestRevision('minutes')._data)
+
+    def test_history(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            history = self.page.history()
+            self.assertEqual([revision.id for revision in history], self.ids)
+            self.assertEqual([revision.message for revision in history],
+                             ['Meeting 0', 'Meeting 1', 'Meeting 2'])
+            self.assertEqual(history[0].prev, None)
+            self.assertEqual(history[2].prev.id, self.ids[1])
+            for revision in history:
+                self.assertEqual(revision.page.slug, 'minutes')
+                self.assertTrue(revision.author.display_name)
+                self.assertFalse('body' in revision._data)
+            self.assertEqual(history[1].diffStatsToPrev(),
+                             {'additions': 1, 'subtractions': 1})
+        resp = self._app.test_client().get('/minutes/history')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('Meeting 1' in resp.get_data())
+
+    def test_neighbours(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            first, middle, last = [model.Revision.get(id=revision_id)
+                                   for revision_id in self.ids]
+            self.assertEqual(middle.prev.id, first.id)
+            self.assertEqual(middle.prev.body, 'Minutes 0')
+            self.assertEqual(middle.next.id, last.id)
+            self.assertEqual(last.next, None)
+            self.assertFalse(middle.is_latest)
+            self.assertTrue(last.is_latest)
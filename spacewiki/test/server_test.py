@@ -0,0 +1,87 @@
+from spacewiki.test import create_test_app
+from spacewiki import cache, model, server
+from spacewiki.auth import tripcodes
+import os
+import threading
+import time
+import unittest
+import urllib2
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.add_url_rule('/test/pid', 'pid', lambda: str(os.getpid()))
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            author = tripcodes.new_anon_user()
+            model.Page.create(title='index', slug='index').newRevision(
+                'Welcome', '', author)
+            model.Page.create(title='recent', slug='recent').newRevision(
+                '*Recently* edited', '', author)
+            model.DATABASE.close()
+
+    def start(self, **kwargs):
+        arbiter = server.Arbiter(self._app, ('127.0.0.1', 0), 2, **kwargs)
+        arbiter.start()
+        self.addCleanup(arbiter.stop, 5)
+        return arbiter
+
+    def pid(self, arbiter):
+        """Asks a worker for its pid, minding the workers meanwhile as
+        Arbiter.run would"""
+        result = []
+        client = threading.Thread(target=lambda: result.append(int(
+            urllib2.urlopen('http://127.0.0.1:%d/test/pid' % (
+                arbiter.address[1],), timeout=10).read())))
+        client.start()
+        while client.is_alive():
+            arbiter.wait(0.05)
+            arbiter.maintain()
+        return result[0]
+
+    def test_warm_up(self):
+        server.warm_up(self._app)
+        with self._app.test_request_context('/'):
+            for slug in ('index', 'recent'):
+                revision = model.Page.latestRevision(slug)
+                self.assertTrue(cache.render_cache().get(revision.id)
+                                is not None)
+
+    def test_serves_from_workers(self):
+        arbiter = self.start()
+        pid = self.pid(arbiter)
+        self.assertTrue(pid in arbiter.workers)
+        self.assertNotEqual(pid, os.getpid())
+
+    def test_recycle(self):
+        arbiter = self.start(max_requests=2)
+        pids = set(self.pid(arbiter) for _ in range(8))
+        self.assertTrue(len(pids) >= 3)
+        self.assertEqual(len(arbiter.current()), 2)
+
+    def test_reload(self):
+        arbiter = self.start()
+        old = set(arbiter.workers)
+        arbiter.reload()
+        deadline = time.time() + 10
+        while set(arbiter.workers) & old and time.time() < deadline:
+            arbiter.wait(0.1)
+            arbiter.maintain()
+        self.assertFalse(set(arbiter.workers) & old)
+        self.assertEqual(len(arbiter.workers), 2)
+        self.assertFalse(self.pid(arbiter) in old)
+
+    def test_release_database(self):
+        self._app.config['SQLITE_PRODUCTION'] = True
+        with self._app.test_request_context('/'):
+            model.get_db()
+            database = self._app.extensions['spacewiki_database']
+        server.release_database(self._app)
+        self.assertTrue(database.is_stopped())
+        self.assertFalse('spacewiki_database' in self._app.extensions)
+        # Nothing opened, as without --syncdb
+        original = model.DATABASE.obj
+        self.addCleanup(setattr, model.DATABASE, 'obj', original)
+        model.DATABASE.obj = None
+        server.release_database(self._app)
@@ -27,7 +27,8 @@ class SlugTestCase(unittest.TestCase):
         self.assertEqual(SlugField.mangle_full_slug('', 'foo/bar'), ('foo', 'bar'))
 
     def test_mid_edit_rename(self):
-        with test_database(test_db, [model.Page, model.Revision, model.Identity]):
+        with test_database(test_db, [model.Page, model.Revision, model.Identity,
+                                     model.PageLink]):
             self.app.post('/test2', data={
                 'title': 'test2',
                 'slug': 'test2',
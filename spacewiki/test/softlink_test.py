@@ -77,7 +77,7 @@ class SoftlinkTestCase(unittest.TestCase):
         assume(src != '' and dest != '')
 
         with test_database(test_db, [model.Softlink, model.Page, model.Revision,
-            model.Identity, model.Attachment]):
+            model.Identity, model.Attachment, model.PageLink]):
             startPage = model.Page.create(title='index', slug=src)
             endPage = model.Page.create(title='page', slug=dest)
             with self._app.app_context():
@@ -1,30 +1,121 @@
 from spacewiki.test import create_test_app
 from spacewiki import model, wikiformat, auth
-from spacewiki.wikiformat import directives
+from spacewiki.wikiformat import Resolver, markdown
 import unittest
-from playhouse.test_utils import test_database
-from peewee import SqliteDatabase
 
-test_db = SqliteDatabase(':memory:')
+# Wikitext and the HTML the regex pipeline used to render it as
+CORPUS = (
+    ('See [[Tools]].\n\nAnd [[missing|the missing page]].',
+     '<p>See <a href="/tools">Tools</a>.</p>\n'
+     '<p>And <a href="/missing">the missing page<sup>?</sup></a>.</p>\n'),
+    ('> quote [[tools|Tools *b*]]',
+     '<blockquote><p>quote <a href="/tools">Tools <em>b</em></a></p>\n'
+     '</blockquote>\n'),
+    ('* item [[tools]]\n* {{greeting}}',
+     '<ul>\n<li>item <a href="/tools">tools</a></li>\n<li>'
+     '<a class="template-edit" href="greeting">Edit Template</a>Hello '
+     '<a href="/tools">tools</a></li>\n</ul>\n'),
+    ('Before\n\n{{header}}\n\nAfter',
+     '<p>Before</p>\n<p><a class="template-edit" href="header">'
+     'Edit Template</a># Header</p>\n<p>Body</p>\n<p>After</p>\n'),
+    ('Say {{greeting}}!',
+     '<p>Say <a class="template-edit" href="greeting">Edit Template</a>'
+     'Hello <a href="/tools">tools</a>!</p>\n'),
+    ('{{missing}}',
+     '<p>{{<a href="/missing">missing<sup>?</sup></a>}}</p>\n'),
+    ('{{attachment:missing.png}}', ''),
+    ('## Heading [[tools]]',
+     '<h2>Heading <a href="/tools">tools</a></h2>\n'),
+)
+
 
 class ParserTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_test_app()
+        with self.app.test_request_context('/'):
+            model.syncdb()
+            author = auth.tripcodes.new_anon_user()
+            for slug, body in (('tools', 'Tools'),
+                               ('greeting', 'Hello [[tools]]'),
+                               ('header', '# Header\n\nBody'),
+                               ('recursive', '{{recursive}}')):
+                model.Page.create(title=slug, slug=slug).newRevision(
+                    body, '', author)
+
+    def render(self, text):
+        with self.app.test_request_context('/'):
+            model.get_db()
+            return wikiformat.render_wikitext(text, 'page')
 
     def test_directives(self):
-        with test_database(test_db, [model.Page, model.Revision]):
-            self.assertEqual(directives.render("", ''), "")
-            self.assertEqual(directives.render("{{foo}}", ''), "{{[[foo]]}}")
+        self.assertEqual(self.render("{{foo}}"),
+                         '<p>{{<a href="/foo">foo<sup>?</sup></a>}}</p>\n')
 
     def test_full_empty_render(self):
-        with test_database(test_db, [model.Page, model.Revision]):
-            self.assertEqual(wikiformat.render_wikitext("", ''), "")
+        self.assertEqual(self.render(""), "")
 
     def test_recursive_templates(self):
-        with test_database(test_db, [model.Page, model.Revision, model.Identity]):
-            with self.app.app_context():
-                page = model.Page.create(title='recursive', slug='recursive')
-                page.newRevision('{{recursive}}', '',
-                        auth.tripcodes.new_anon_user())
-                canary = "{{Max include depth of"
-                self.assertTrue(canary in directives.render("{{recursive}}", ''))
+        canary = "{{Max include depth of 11 reached before "
+        self.assertTrue(canary in self.render("{{recursive}}"))
+
+    def test_corpus(self):
+        for text, html in CORPUS:
+            self.assertEqual(self.render(text), html)
+
+    def test_links_do_not_span(self):
+        self.assertEqual(self.render('See [[Tools]] and [[missing|it]].'),
+                         '<p>See <a href="/tools">Tools</a> and '
+                         '<a href="/missing">it<sup>?</sup></a>.</p>\n')
+        self.assertEqual(self.render('*em [[tools]]* and **[[tools|b]]**'),
+                         '<p><em>em <a href="/tools">tools</a></em> and '
+                         '<strong><a href="/tools">b</a></strong></p>\n')
+
+    def test_code_left_alone(self):
+        self.assertEqual(self.render('`[[tools]] {{greeting}}`'),
+                         '<p><code>[[tools]] {{greeting}}</code></p>\n')
+        self.assertEqual(self.render('    [[tools]]\n    {{greeting}}'),
+                         '<pre><code>[[tools]]\n{{greeting}}\n'
+                         '</code></pre>\n')
+
+    def test_dependencies(self):
+        with self.app.test_request_context('/'):
+            model.get_db()
+            resolver = Resolver()
+            wikiformat.render_wikitext(
+                '[[tools]] {{greeting}} `[[code]]`\n\n'
+                '{{attachment:photo.png}} [[other|Other]]', 'page', resolver)
+        self.assertEqual(resolver.dependencies,
+                         set(['tools', 'greeting', 'other',
+                              'attachment:photo.png']))
+
+    def test_parse_reused(self):
+        parses = []
+        original = markdown.parse
+
+        def counting_parse(text, mode=markdown.PAGE):
+            parses.append(mode)
+            return original(text, mode)
+
+        markdown.parse = counting_parse
+        self.addCleanup(setattr, markdown, 'parse', original)
+        with self.app.test_request_context('/'):
+            model.get_db()
+            author = auth.tripcodes.new_anon_user()
+            page = model.Page.create(title=u'caf\xe9', slug='cafe')
+            revision = page.newRevision(
+                u'Caf\xe9 [[new page]]\n\n{{greeting}}', '', author)
+            html = revision.html
+            self.assertTrue(u'Caf\xe9 <a href="/new-page">new page<sup>?'
+                            in html)
+            self.assertEqual(parses, [markdown.PAGE, markdown.BLOCK])
+            model.Page.create(title='new page', slug='new-page').newRevision(
+                'Here', '', author)
+            # Saving new-page parsed it, to record its links
+            self.assertEqual(parses, [markdown.PAGE, markdown.BLOCK,
+                                      markdown.PAGE])
+            html = model.Revision.get(id=revision.id).html
+            self.assertTrue(u'Caf\xe9 <a href="/new-page">new page</a>'
+                            in html)
+            self.assertTrue('Hello <a href="/tools">tools</a>' in html)
+            self.assertEqual(parses, [markdown.PAGE, markdown.BLOCK,
+                                      markdown.PAGE])
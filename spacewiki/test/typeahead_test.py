@@ -0,0 +1,93 @@
+from spacewiki.test import create_test_app
+from spacewiki import model, typeahead
+from spacewiki.auth import tripcodes
+import json
+import random
+import time
+import unittest
+
+
+class TitleIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = typeahead.TitleIndex()
+        self.index.load([('tools/drill-press', 'Drill Press'),
+                         ('tools/drills', 'Drills'),
+                         ('dryer', 'Dryer'),
+                         ('laser', 'Laser Cutter')],
+                        {'tools/drills': 5, 'dryer': 1})
+
+    def _slugs(self, prefix):
+        return [slug for slug, _, _ in self.index.complete(prefix)]
+
+    def test_ranking(self):
+        self.assertEqual(self._slugs('dr'),
+                         ['tools/drills', 'dryer', 'tools/drill-press'])
+        self.assertEqual(self._slugs('DRILL P'), ['tools/drill-press'])
+        self.assertEqual(self._slugs('tools/'),
+                         ['tools/drills', 'tools/drill-press'])
+        self.assertEqual(self._slugs(''), [])
+
+    def test_updates(self):
+        self.index.hit('tools/drill-press', 10)
+        self.assertEqual(self._slugs('dr')[0], 'tools/drill-press')
+        self.index.rename('laser', 'tools/laser', 'Laser')
+        self.assertEqual(self._slugs('laser'), ['tools/laser'])
+        self.index.remove('dryer')
+        self.assertEqual(self._slugs('dry'), [])
+        self.index.add('dryer', 'Clothes Dryer')
+        self.assertEqual(self._slugs('clothes'), ['dryer'])
+        self.assertEqual(len(self.index), 4)
+
+    def test_large_index(self):
+        rng = random.Random(1)
+        words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                         for _ in range(rng.randint(3, 9)))
+                 for _ in range(5000)]
+        pages = []
+        for number in range(100000):
+            title = ' '.join(rng.sample(words, 2)) + ' %d' % (number,)
+            pages.append((model.SlugField.slugify(title), title))
+        index = typeahead.TitleIndex()
+        index.load(pages, dict((slug, rng.randint(0, 100))
+                               for slug, _ in pages[::7]))
+        queries = [title[:rng.randint(1, 8)] for _, title in
+                   rng.sample(pages, 1000)]
+        for query in queries:
+            index.complete(query)
+        start = time.time()
+        for query in queries:
+            index.complete(query)
+        self.assertTrue((time.time() - start) / len(queries) < 0.001)
+
+
+class CompleteTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.secret_key = 'complete'
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            model.Page.create(title='Drill Press', slug='drill-press') \
+                .newRevision('Drill', '', tripcodes.new_anon_user())
+        self.app = self._app.test_client()
+
+    def _complete(self, query):
+        return json.loads(self.app.get('/.complete?q=' + query).data)
+
+    def test_complete(self):
+        results = self._complete('dri')['results']
+        self.assertEqual([r['slug'] for r in results], ['drill-press'])
+        self.assertEqual(results[0]['url'], '/drill-press')
+
+    def test_save_updates_index(self):
+        self._complete('dri')
+        self.app.post('/grinder', data={'title': 'Grinder', 'slug': 'grinder',
+                                        'body': 'Grind', 'author': '',
+                                        'message': ''})
+        self.assertEqual(self._complete('grin')['results'][0]['slug'],
+                         'grinder')
+        self.app.post('/drill-press', data={
+            'title': 'Pillar Drill', 'slug': 'pillar-drill', 'body': 'Drill',
+            'author': '', 'message': ''})
+        self.assertEqual(self._complete('dri')['results'], [])
+        self.assertEqual(self._complete('pillar')['results'][0]['slug'],
+                         'pillar-drill')
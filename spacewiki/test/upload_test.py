@@ -1,10 +1,14 @@
 from spacewiki.test import create_test_app
-from spacewiki import model
+from spacewiki import model, storage, uploads
+from spacewiki.auth import tripcodes
+from spacewiki.wikiformat import Resolver
 import unittest
 import tempfile
 import hashlib
 from StringIO import StringIO
+from PIL import Image
 import os
+import time
 from playhouse.test_utils import test_database
 from peewee import SqliteDatabase
 
@@ -26,7 +30,7 @@ class UploadTestCase(unittest.TestCase):
           sha.update('')
           emptySha = sha.hexdigest()
           uploadedFile = os.path.join(self._app.config['UPLOAD_PATH'],
-            model.Attachment.hashPath(emptySha, 'empty.txt'))
+            model.Attachment.hashPath(emptySha))
 
           self.assertTrue(os.path.exists(uploadedFile))
           resp = self.app.get('/index/file/empty.txt')
@@ -43,7 +47,7 @@ class UploadTestCase(unittest.TestCase):
           sha.update('FOOBAR')
           emptySha = sha.hexdigest()
           uploadedFile = os.path.join(self._app.config['UPLOAD_PATH'],
-            model.Attachment.hashPath(emptySha, 'foo.bar'))
+            model.Attachment.hashPath(emptySha))
 
           self.assertTrue(os.path.exists(uploadedFile))
           resp = self.app.get('/index/file/foo.bar')
@@ -63,9 +67,217 @@ class UploadTestCase(unittest.TestCase):
             sha.update('BARFOO')
             emptySha = sha.hexdigest()
             uploadedFile = os.path.join(self._app.config['UPLOAD_PATH'],
-              model.Attachment.hashPath(emptySha, 'foo.bar'))
+              model.Attachment.hashPath(emptySha))
 
             self.assertTrue(os.path.exists(uploadedFile))
             resp = self.app.get('/index/file/foo.bar')
             self.assertEqual(resp.status_code, 200)
             self.assertEqual(resp.data, 'BARFOO')
+
+    def _stored(self):
+        stored = []
+        for dirpath, _, filenames in os.walk(self._app.config['UPLOAD_PATH']):
+            stored.extend(filenames)
+        return sorted(stored)
+
+    def test_duplicate_content(self):
+        with test_database(test_db, [model.Attachment,
+            model.AttachmentRevision, model.Page]):
+            self.app.post('/index/attach', data={
+              'file': (StringIO('SAME'), 'one.txt')
+            })
+            self.app.post('/index/attach', data={
+              'file': (StringIO('SAME'), 'two.txt')
+            })
+            sha = hashlib.sha256('SAME').hexdigest()
+            self.assertEqual(self._stored(), [sha])
+            self.assertEqual(self.app.get('/index/file/two.txt').data, 'SAME')
+            with self._app.test_request_context('/'):
+                self.assertEqual(uploads.deduplicated(
+                    storage.blob_store()), (1, 4))
+            # Uploading it again makes it young enough to escape uploads gc
+            blob = os.path.join(self._app.config['UPLOAD_PATH'],
+                                model.Attachment.hashPath(sha))
+            os.utime(blob, (time.time() - 7200, time.time() - 7200))
+            self.app.post('/index/attach', data={
+              'file': (StringIO('SAME'), 'three.txt')
+            })
+            self.assertTrue(time.time() - os.path.getmtime(blob) < 3600)
+
+    def test_garbage_collection(self):
+        with test_database(test_db, [model.Attachment,
+            model.AttachmentRevision, model.Page]):
+            self.app.post('/index/attach', data={
+              'file': (StringIO('OLD'), 'foo.bar')
+            })
+            self.app.post('/index/attach', data={
+              'file': (StringIO('NEW'), 'foo.bar')
+            })
+            upload_path = self._app.config['UPLOAD_PATH']
+            old = os.path.join(upload_path, model.Attachment.hashPath(
+                hashlib.sha256('OLD').hexdigest()))
+            new = os.path.join(upload_path, model.Attachment.hashPath(
+                hashlib.sha256('NEW').hexdigest()))
+            # Nothing references OLD, but the revision that did is kept
+            model.AttachmentRevision.delete().where(
+                model.AttachmentRevision.sha ==
+                hashlib.sha256('OLD').hexdigest()).execute()
+            for path in (old + '-100', new + '-100', new + '-200'):
+                with open(path, 'w') as fh:
+                    fh.write('thumbnail')
+            long_ago = time.time() - 90 * 86400
+            for path in (old, old + '-100', new, new + '-100'):
+                os.utime(path, (long_ago, long_ago))
+
+            with self._app.test_request_context('/'):
+                files, reclaimed = uploads.collect_garbage(
+                    storage.blob_store(), dry_run=True,
+                    thumbnail_age=30 * 86400)
+                self.assertEqual(files, {'unreferenced blobs': 1,
+                                         'orphaned thumbnails': 1,
+                                         'stale thumbnails': 1})
+                self.assertEqual(reclaimed['unreferenced blobs'], 3)
+                self.assertTrue(os.path.exists(old))
+                uploads.collect_garbage(storage.blob_store(), grace=0)
+            self.assertEqual(self._stored(), [
+                os.path.basename(new), os.path.basename(new) + '-100',
+                os.path.basename(new) + '-200'])
+
+
+class ContentAddressMigrationTestCase(unittest.TestCase):
+    def test_migration(self):
+        app = create_test_app()
+        app.config['UPLOAD_PATH'] = tempfile.mkdtemp()
+        sha = hashlib.sha256('LEGACY').hexdigest()
+        with app.test_request_context('/'):
+            model.syncdb()
+            model.get_db()
+            page = model.Page.create(title='index', slug='index')
+            for name in ('a.txt', 'b.txt'):
+                attachment = model.Attachment.create(page=page, filename=name,
+                                                     slug=name)
+                model.AttachmentRevision.create(attachment=attachment, sha=sha)
+                legacy = os.path.join(app.config['UPLOAD_PATH'],
+                                      model.Attachment.legacyHashPath(sha, name))
+                if not os.path.exists(os.path.dirname(legacy)):
+                    os.makedirs(os.path.dirname(legacy))
+                with open(legacy, 'w') as fh:
+                    fh.write('LEGACY')
+            model.DatabaseVersion.update(schema_version=3).execute()
+            model.syncdb()
+        blob_dir = os.path.join(app.config['UPLOAD_PATH'], sha[0:2], sha[2:4])
+        self.assertEqual(os.listdir(blob_dir), [sha])
+
+
+class ImageAttachmentTestCase(unittest.TestCase):
+    def setUp(self):
+        self._app = create_test_app()
+        self._app.config['UPLOAD_PATH'] = tempfile.mkdtemp()
+        with self._app.test_request_context('/'):
+            model.syncdb()
+            author = tripcodes.new_anon_user()
+            self.gallery = model.Page.create(title='gallery', slug='gallery')
+            self.gallery.newRevision('Pictures', '', author)
+            other = model.Page.create(title='other', slug='other')
+            for page, name, size in ((self.gallery, 'wide.png', (300, 100)),
+                                     (self.gallery, 'tall.png', (50, 200)),
+                                     (other, 'elsewhere.png', (10, 10))):
+                image = os.path.join(tempfile.mkdtemp(), name)
+                Image.new('RGB', size, (255, 0, 0)).save(image, format='png')
+                page.attachUpload(image, name)
+            notes = os.path.join(tempfile.mkdtemp(), 'notes.txt')
+            with open(notes, 'w') as fh:
+                fh.write('Not an image')
+            self.gallery.attachUpload(notes, 'notes.txt')
+
+    def test_size_recorded(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            wide = model.Attachment.get(slug='wide.png')
+            self.assertEqual((wide.width, wide.height), (300, 100))
+            notes = model.Attachment.get(slug='notes.txt')
+            self.assertEqual((notes.width, notes.height), (None, None))
+
+    def test_sizes_filled_in(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            model.Attachment.update(width=None, height=None).execute()
+            model.fill_image_sizes()
+            wide = model.Attachment.get(slug='wide.png')
+            self.assertEqual((wide.width, wide.height), (300, 100))
+            notes = model.Attachment.get(slug='notes.txt')
+            self.assertEqual((notes.width, notes.height), (None, None))
+
+    def test_find_scoped_to_page(self):
+        with self._app.test_request_context('/'):
+            model.get_db()
+            self.assertEqual(
+                model.Attachment.findAttachment('gallery', 'wide.png').slug,
+                'wide.png')
+            self.assertEqual(
+                model.Attachment.findAttachment('gallery', 'elsewhere.png'),
+                None)
+        client = self._app.test_client()
+        self.assertEqual(client.get('/other/file/wide.png').status_code, 404)
+
+    def test_thumbnail_size(self):
+        # Ones whose float rounding once came out a pixel different
+        for size, max_size in (((1473, 1798), 602), ((372, 2428), 303)):
+            img = Image.new('L', size)
+            img.thumbnail(uploads._thumbnail_box(size[0], size[1], max_size))
+            self.assertEqual(
+                uploads.thumbnail_size(size[0], size[1], max_size), img.size)
+        for size in ((300, 100), (50, 200), (64, 64), (333, 77)):
+            for max_size in (32, 100, 128, 400):
+                thumbnail = StringIO()
+                uploads.make_thumbnail(StringIO(self._png(size)), thumbnail,
+                                       max_size)
+                thumbnail.seek(0)
+                self.assertEqual(
+                    uploads.thumbnail_size(size[0], size[1], max_size),
+                    Image.open(thumbnail).size)
+
+    def test_thumbnail_size_range(self):
+        # thumbnail_size follows the rounding of the Pillow setup.py pins
+        for width in xrange(1, 260, 23):
+            for height in xrange(1, 260, 19):
+                png = self._png((width, height))
+                for max_size in (7, 32, 100, 128):
+                    thumbnail = StringIO()
+                    uploads.make_thumbnail(StringIO(png), thumbnail, max_size)
+                    thumbnail.seek(0)
+                    self.assertEqual(
+                        uploads.thumbnail_size(width, height, max_size),
+                        Image.open(thumbnail).size,
+                        (width, height, max_size))
+
+    def _png(self, size):
+        data = StringIO()
+        Image.new('RGB', size).save(data, format='png')
+        return data.getvalue()
+
+    def test_render_batched(self):
+        lookups = []
+        original = Resolver.attachments
+
+        def counting_attachments(resolver, page_slug, slugs):
+            lookups.append(sorted(slugs))
+            return original(resolver, page_slug, slugs)
+
+        Resolver.attachments = counting_attachments
+        self.addCleanup(setattr, Resolver, 'attachments', original)
+        with self._app.test_request_context('/'):
+            model.get_db()
+            html = model.Revision.render_text(
+                '{{attachment:wide.png}}\n\n{{attachment:tall.png:100}} '
+                '{{attachment:notes.txt}} {{attachment:elsewhere.png}}',
+                'gallery')
+        self.assertEqual(lookups, [['elsewhere.png', 'notes.txt', 'tall.png',
+                                    'wide.png']])
+        self.assertTrue('<img alt="wide.png" height="100" '
+                        'src="/gallery/file/wide.png" width="300">' in html)
+        self.assertTrue('<img alt="tall.png" height="100" '
+                        'src="/gallery/file/tall.png/100" width="25">' in html)
+        self.assertTrue('<img alt="notes.txt" src="/gallery/file/notes.txt">'
+                        in html)
+        self.assertFalse('elsewhere' in html)
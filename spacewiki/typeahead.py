@@ -0,0 +1,179 @@
+"""An in-memory index of page titles and slugs for autocompletion"""
+
+import bisect
+from flask import current_app
+import heapq
+import logging
+import threading
+import time
+
+import peewee
+
+from spacewiki import events, model
+
+# Prefixes matching more entries than this are ranked once and remembered
+SCAN_LIMIT = 500
+# How long a remembered ranking may ignore changes in hit counts
+RANKING_TTL = 60
+# Sorts after every character a title can contain
+HIGHEST = u'\U0010ffff'
+
+
+class TitleIndex(object):
+    """Page titles and slugs in one sorted list of (lowercased key, slug),
+    so that every entry starting with a prefix sits in one contiguous run
+    found with two bisections. Matches are ranked by how often readers
+    followed softlinks to the page."""
+
+    def __init__(self):
+        self._entries = []
+        self._titles = {}
+        self._hits = {}
+        self._rankings = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._titles)
+
+    @staticmethod
+    def _keys(slug, title):
+        return set([title.lower(), slug.lower(),
+                    slug.rsplit('/', 1)[-1].lower()])
+
+    def load(self, pages, hits):
+        """Replaces the index with (slug, title) pairs and a dict of hit
+        counts by slug"""
+        entries = []
+        titles = {}
+        for slug, title in pages:
+            titles[slug] = title
+            entries.extend((key, slug) for key in self._keys(slug, title))
+        entries.sort()
+        with self._lock:
+            self._entries = entries
+            self._titles = titles
+            self._hits = dict(hits)
+            self._rankings.clear()
+
+    def add(self, slug, title):
+        """Adds a page, or updates the title of an existing one"""
+        with self._lock:
+            self._remove(slug)
+            self._titles[slug] = title
+            for key in self._keys(slug, title):
+                bisect.insort(self._entries, (key, slug))
+                self._forget(key)
+
+    def remove(self, slug):
+        """Removes a page"""
+        with self._lock:
+            self._remove(slug)
+
+    def rename(self, old_slug, slug, title):
+        """Moves a page to a new slug, keeping its hits"""
+        with self._lock:
+            hits = self._hits.pop(old_slug, 0)
+            self._remove(old_slug)
+        self.add(slug, title)
+        self.hit(slug, hits)
+
+    def hit(self, slug, count=1):
+        """Records that a page was reached through a softlink"""
+        with self._lock:
+            self._hits[slug] = self._hits.get(slug, 0) + count
+
+    def _remove(self, slug):
+        title = self._titles.pop(slug, None)
+        if title is None:
+            return
+        for key in self._keys(slug, title):
+            idx = bisect.bisect_left(self._entries, (key, slug))
+            if idx < len(self._entries) and self._entries[idx] == (key, slug):
+                del self._entries[idx]
+            self._forget(key)
+
+    def _forget(self, key):
+        for length in xrange(1, len(key) + 1):
+            self._rankings.pop(key[:length], None)
+
+    def _rank(self, entries, limit):
+        slugs = set(slug for _, slug in entries)
+        return heapq.nsmallest(limit, slugs, key=lambda slug: (
+            -self._hits.get(slug, 0), len(self._titles[slug]),
+            self._titles[slug].lower()))
+
+    def complete(self, prefix, limit=10):
+        """Returns up to limit (slug, title, hits) for pages whose title,
+        slug or last slug component starts with prefix, most visited
+        first"""
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        with self._lock:
+            lo = bisect.bisect_left(self._entries, (prefix,))
+            hi = bisect.bisect_left(self._entries, (prefix + HIGHEST,), lo)
+            if hi - lo > SCAN_LIMIT:
+                ranked, expires = self._rankings.get(prefix, (None, 0))
+                if ranked is None or len(ranked) < limit or \
+                   expires < time.time():
+                    ranked = self._rank(self._entries[lo:hi],
+                                        max(limit, 10))
+                    self._rankings[prefix] = (ranked,
+                                              time.time() + RANKING_TTL)
+                ranked = ranked[:limit]
+            else:
+                ranked = self._rank(self._entries[lo:hi], limit)
+            return [(slug, self._titles[slug], self._hits.get(slug, 0))
+                    for slug in ranked]
+
+
+def load_index(index):
+    """Fills a TitleIndex from the database"""
+    start = time.time()
+    pages = model.Page.select(model.Page.slug, model.Page.title).tuples()
+    hits = model.Softlink.select(
+        model.Page.slug, peewee.fn.Sum(model.Softlink.hits)) \
+        .join(model.Page, on=model.Softlink.dest) \
+        .group_by(model.Page.slug) \
+        .tuples()
+    index.load(pages.iterator(), ((slug, count or 0) for slug, count in hits))
+    logging.info("Indexed %d page titles in %.2fs", len(index),
+                 time.time() - start)
+
+
+def title_index():
+    """Returns the title index for the current app, building it from the
+    database the first time"""
+    index = current_app.extensions.get('spacewiki_titles')
+    if index is None:
+        with model.use_primary():
+            fresh = TitleIndex()
+            load_index(fresh)
+        index = current_app.extensions.setdefault('spacewiki_titles', fresh)
+    return index
+
+
+def indexed():
+    """Returns the title index if it has been built, otherwise None, so that
+    writes don't pay for building it"""
+    return current_app.extensions.get('spacewiki_titles')
+
+
+@events.subscribe('page')
+def refresh(slug):
+    """Re-reads the title of slug, after another process changed it"""
+    titles = indexed()
+    if titles is None:
+        return
+    try:
+        page = model.Page.get(slug=slug)
+    except peewee.DoesNotExist:
+        titles.remove(slug)
+    else:
+        titles.add(page.slug, page.title)
+
+
+@events.subscribe('all')
+def forget(key=None):  # pylint: disable=unused-argument
+    """Drops the title index, so the next lookup rebuilds it"""
+    current_app.extensions.pop('spacewiki_titles', None)
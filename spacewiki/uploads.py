@@ -1,16 +1,25 @@
 """Page attachments and uploads"""
 
-from flask import current_app, Blueprint, render_template, request, redirect, url_for, Response
+import collections
+from flask import Blueprint, render_template, request, redirect, url_for, Response
+from flask_script import Manager
 import logging
 import peewee
 from PIL import Image
 import os
+import re
 import tempfile
+import time
 import werkzeug
+from StringIO import StringIO
 
-from spacewiki import model
+from spacewiki import admission, events, model, offload, prerender, storage
 
 BLUEPRINT = Blueprint('uploads', __name__)
+MANAGER = Manager(usage='Upload store tools')
+
+# A blob, or a thumbnail or pre-content-addressing copy of one
+STORE_NAME = re.compile(r'^([0-9a-f]{64})(?:-(.+))?$')
 
 
 @BLUEPRINT.route("/<path:slug>/attach", methods=['GET'])
@@ -37,10 +46,75 @@ def attach(slug):
     tmpname = os.path.join(tempfile.mkdtemp(), "upload")
     with model.DATABASE.transaction():
         uploaded_file.save(tmpname)
-        page.attachUpload(tmpname, fname, current_app.config['UPLOAD_PATH'])
+        attachment = page.attachUpload(tmpname, fname)
+    # Once committed, so renders queued for it and other processes told
+    # about it can see the new upload
+    prerender.page_changed('attachment:' + attachment.slug)
+    events.page_changed('attachment:' + attachment.slug)
     return redirect(url_for('pages.view', slug=page.slug))
 
 
+def thumbnail_path(key, max_size):
+    """Where the thumbnail of the blob at key is kept"""
+    return '%s-%s' % (key, max_size)
+
+
+def _thumbnail_box(width, height, max_size):
+    """Returns the size make_thumbnail asks Image.thumbnail for"""
+    if width > height:
+        scale = float(max_size) / width
+        width = max_size
+        height = height * scale
+    else:
+        scale = float(max_size) / height
+        height = max_size
+        width = width * scale
+    # Image.thumbnail can't scale a sliver down to less than a pixel
+    return max(width, 1), max(height, 1)
+
+
+def make_thumbnail(src, dest, max_size):
+    """Scales the image at src down to fit in a max_size square, saving it
+    as a png at dest"""
+    img = Image.open(src)
+    img.thumbnail(_thumbnail_box(img.size[0], img.size[1], max_size),
+                  Image.ANTIALIAS)
+    img.save(dest, format='png')
+
+
+def thumbnail_size(width, height, max_size):
+    """Returns the size make_thumbnail scales a width by height image to"""
+    box = _thumbnail_box(width, height, max_size)
+    # As Image.thumbnail in the Pillow setup.py pins rounds, down to the
+    # same float operations
+    if width > box[0]:
+        height = int(max(height * box[0] / width, 1))
+        width = int(box[0])
+    if height > box[1]:
+        width = int(max(width * box[1] / height, 1))
+        height = int(box[1])
+    return width, height
+
+
+def thumbnail_bytes(data, max_size):
+    """Returns the png thumbnail of the image in data"""
+    thumbnail = StringIO()
+    make_thumbnail(StringIO(data), thumbnail, max_size)
+    return thumbnail.getvalue()
+
+
+def store_thumbnail(store, key, thumbnail_key, max_size):
+    """Makes a thumbnail of the blob at key, storing it at thumbnail_key.
+    Raises offload.TaskTimeout if scaling takes too long."""
+    src = store.open(key)
+    try:
+        original = src.read()
+    finally:
+        src.close()
+    thumbnail = offload.run('thumbnail', thumbnail_bytes, original, max_size)
+    store.put(thumbnail_key, StringIO(thumbnail), len(thumbnail))
+
+
 @BLUEPRINT.route("/<path:slug>/file/<fileslug>")
 @BLUEPRINT.route("/<path:slug>/file/<fileslug>/<size>")
 def get_attachment(slug, fileslug, size=None):
@@ -61,32 +135,114 @@ def get_attachment(slug, fileslug, size=None):
     if max_size is not None and max_size <= 0:
         raise werkzeug.exceptions.NotFound()
 
-    def generate(prefix):
-        """Generator that streams a file's contents"""
-        fname = model.Attachment.hashPath(latest_revision.sha,
-                                          attachment.filename)
-        if max_size is not None:
-            resized_fname = os.path.join(prefix, fname)+'-%s' % (max_size)
-            if not os.path.exists(resized_fname):
-                img = Image.open(os.path.join(prefix, fname))
-                width, height = img.size
-                if width > height:
-                    scale = float(max_size) / width
-                    width = max_size
-                    height = height * scale
-                else:
-                    scale = float(max_size) / height
-                    height = max_size
-                    width = width * scale
-                img.thumbnail([width, height], Image.ANTIALIAS)
-                img.save(resized_fname, format='png')
-            upload_fh = open(resized_fname, 'r')
+    store = storage.blob_store()
+    fname = model.Attachment.hashPath(latest_revision.sha)
+    if max_size is not None:
+        resized_fname = thumbnail_path(fname, max_size)
+        if store.exists(resized_fname):
+            # Marks the thumbnail as in use, see collect_garbage
+            store.touch(resized_fname)
+            fname = resized_fname
         else:
-            upload_fh = open(os.path.join(prefix, fname))
-        buf = upload_fh.read(2048)
-        while buf:
-            yield buf
-            buf = upload_fh.read(2048)
+            # Only scaling is limited, not serving thumbnails already made
+            with admission.admitted('uploads.thumbnail'):
+                try:
+                    store_thumbnail(store, fname, resized_fname, max_size)
+                    fname = resized_fname
+                except offload.TaskTimeout:
+                    # Too big to scale in time; the browser can scale it
+                    # instead
+                    logging.warning("Thumbnailing %s timed out", fname)
     # FIXME: mimetype detection
     mimetype = 'image/png; charset=binary'
-    return Response(generate(current_app.config['UPLOAD_PATH']), mimetype=mimetype)
+    return store.serve(fname, mimetype, attachment.filename)
+
+
+def referenced_blobs():
+    """The mark phase: the sha of every blob an attachment revision uses"""
+    return set(sha for (sha,) in model.AttachmentRevision.select(
+        model.AttachmentRevision.sha).distinct().tuples().iterator())
+
+
+def sweep(store, referenced, grace=3600, thumbnail_age=None):
+    """The sweep phase: yields (key, size, kind) for every blob in the store
+    that nothing needs. Files younger than grace seconds are left alone,
+    since an upload moves its blob into place before its revision is
+    committed. Thumbnails of live blobs are only swept once they haven't
+    been served for thumbnail_age seconds."""
+    now = time.time()
+    for key, size, modified in store.walk():
+        match = STORE_NAME.match(key.rsplit('/', 1)[-1])
+        if match is None or now - modified < grace:
+            continue
+        sha, suffix = match.groups()
+        if suffix is None:
+            if sha not in referenced:
+                yield key, size, 'unreferenced blobs'
+        elif sha not in referenced:
+            yield key, size, 'orphaned thumbnails' \
+                if suffix.isdigit() else 'copies under old names'
+        elif not store.exists(model.Attachment.hashPath(sha)):
+            # Maybe the only copy of an upload from before blobs were named
+            # by content
+            continue
+        elif not suffix.isdigit():
+            yield key, size, 'copies under old names'
+        elif thumbnail_age is not None and now - modified > thumbnail_age:
+            yield key, size, 'stale thumbnails'
+
+
+def collect_garbage(store, dry_run=False, grace=3600, thumbnail_age=None):
+    """Removes every file sweep() finds, returning the number of files and
+    bytes reclaimed of each kind"""
+    files = collections.Counter()
+    reclaimed = collections.Counter()
+    for key, size, kind in sweep(store, referenced_blobs(), grace,
+                                 thumbnail_age):
+        logging.debug("Sweeping %s (%s)", key, kind)
+        if not dry_run:
+            store.delete(key)
+        files[kind] += 1
+        reclaimed[kind] += size
+    return files, reclaimed
+
+
+def deduplicated(store):
+    """Returns how many blobs are shared by more than one attachment, and
+    how many bytes storing them once saves"""
+    count = peewee.fn.Count(model.AttachmentRevision.id)
+    shared = model.AttachmentRevision.select(model.AttachmentRevision.sha,
+                                             count) \
+        .group_by(model.AttachmentRevision.sha) \
+        .having(count > 1) \
+        .tuples()
+    blobs = saved = 0
+    for sha, uses in shared.iterator():
+        key = model.Attachment.hashPath(sha)
+        if store.exists(key):
+            blobs += 1
+            saved += (uses - 1) * store.size(key)
+    return blobs, saved
+
+
+@MANAGER.option('--dry-run', dest='dry_run', default=False,
+                action='store_true', help="Only report what would be removed")
+@MANAGER.option('--grace', dest='grace', type=int, default=3600,
+                help="Leave files younger than this many seconds alone")
+@MANAGER.option('--thumbnail-age', dest='thumbnail_age', type=int, default=30,
+                help="Remove thumbnails not served for this many days")
+def gc(dry_run, grace, thumbnail_age):
+    """Removes unreferenced blobs and stale thumbnails from the upload
+    store"""
+    model.get_db()
+    store = storage.blob_store()
+    files, reclaimed = collect_garbage(store, dry_run, grace,
+                                       thumbnail_age * 86400)
+    verb = "Would reclaim" if dry_run else "Reclaimed"
+    for kind in sorted(files):
+        print "%s %d bytes from %d %s" % (verb, reclaimed[kind], files[kind],
+                                          kind)
+    print "%s %d bytes in total" % (verb, sum(reclaimed.values()))
+    blobs, saved = deduplicated(store)
+    print "%d blobs are shared between attachments, saving %d bytes" % (
+        blobs, saved)
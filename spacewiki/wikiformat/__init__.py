@@ -1,10 +1,16 @@
 """Implementation of SpaceWiki's wikitext syntax"""
 import bleach
 from flask import url_for
+from jinja2 import escape
 import peewee
 import re
 
+from spacewiki import cache, offload
 from . import links, directives, markdown
+from .resolver import Resolver
+
+TOO_SLOW = '<p><em>This page is taking a while to format, so here is its ' \
+    'source for now.</em></p><pre>%s</pre>'
 
 TAG_WHITELIST = [
     'ul', 'li', 'ol', 'p', 'table', 'div', 'tr', 'th', 'td', 'em', 'big', 'b',
@@ -18,7 +24,7 @@ ATTRIBUTE_WHITELIST = {
     '*': ['style', 'class', 'id', 'tabindex', 'name'],
     'td': ['colspan', 'rowspan'],
     'a': ['href'],
-    'img': ['src', 'alt'],
+    'img': ['src', 'alt', 'width', 'height'],
     'form': ['action', 'method'],
     'input': ['type', 'placeholder', 'value'],
 }
@@ -36,7 +42,36 @@ def safetags(text):
                         strip_comments=False)
 
 
-def render_wikitext(text, slug):
-    """Renders a string of wikitext as HTML"""
-    return safetags(markdown.render(links.render(directives.render(text, slug))))
+def parsed(revision, mode=markdown.PAGE):
+    """Returns the Document of a revision parsed in mode, keeping it in the
+    parse cache"""
+    documents = cache.parse_cache()
+    key = (revision.id, mode)
+    document = documents.get(key)
+    if document is None:
+        document = markdown.parse(revision.body, mode)
+        documents.put(key, document)
+    return document
+
 
+def render_wikitext(text, slug, resolver=None, revision=None):
+    """Renders a string of wikitext as HTML. If text is the body of revision,
+    its parse is cached so only links and includes are resolved again next
+    time. Sanitizing is the CPU heavy part, and needs nothing but the HTML,
+    so big pages are sanitized in the offload pool. If that takes longer
+    than its budget the source is shown instead, and resolver is marked
+    partial."""
+    if resolver is None:
+        resolver = Resolver()
+    if revision is None:
+        document = markdown.parse(text)
+    else:
+        document = parsed(revision)
+    html = markdown.emit(document, slug, resolver, parsed)
+    if len(html) < offload.SMALL_TEXT:
+        return safetags(html)
+    try:
+        return offload.run('render', safetags, html)
+    except offload.TaskTimeout:
+        resolver.partial = True
+        return TOO_SLOW % (escape(text),)
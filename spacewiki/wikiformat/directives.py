@@ -1,63 +1,34 @@
-"""Implements {{directives}} in wikitext"""
+"""Finding and rewriting {{directives}} in wikitext. They are rendered by
+the markdown parser, in markdown.py, which leaves directives in code alone,
+and so do these."""
 
-from flask import url_for
-import peewee
 import re
 
-from spacewiki import model
+from . import markdown
 
 DIRECTIVE_SYNTAX = re.compile(r'\{\{(.+?)\}\}')
 
-def do_attachment(pageSlug, slug):
-    size = None
-
-    tokens = slug.split(':', 1)
-
-    if len(tokens) == 1:
-        image_slug = slug
-    else:
-        image_slug, size = tokens
-
-    try:
-        model.Attachment.get(slug=image_slug)
-    except peewee.DoesNotExist:
-        # FIXME: Return markdown that indicates this attachment doesn't exist
-        return None
-
-    if size is None:
-        img_url = url_for('uploads.get_attachment',
-                          slug=pageSlug, fileslug=image_slug)
-    else:
-        img_url = url_for('uploads.get_attachment',
-                          slug=pageSlug, fileslug=image_slug, size=size)
-
-    full_url = url_for('uploads.get_attachment',
-                       slug=pageSlug, fileslug=image_slug)
-
-    return '[![%s](%s)](%s)' % (image_slug, img_url, full_url)
-
-
-def do_template(match, pageSlug, depth):
-    """Replaces a template regex match with the template contents,
-    recursively"""
-    slug = match.groups()[0]
-    if depth > 10:
-        return "{{Max include depth of %s reached before [[%s]]}}" % (
-            depth, slug
-        )
-    if slug.startswith("attachment:"):
-        image_slug = slug.split(':', 1)[1]
-        return do_attachment(pageSlug, image_slug)
-    else:
-        replacement = model.Page.latestRevision(slug)
-    if replacement is None:
-        return "{{[[%s]]}}" % (slug,)
-    return '<a class="template-edit" href="'+replacement.page.slug+'">Edit Template</a>'+render(replacement.body, pageSlug,
-            depth=depth+1)
-
-
-def render(s, pageSlug, depth=0):
-    def do_template_with_depth(*args):  # pylint: disable=missing-docstring
-        return do_template(*args, pageSlug=pageSlug, depth=depth)
-
-    return DIRECTIVE_SYNTAX.sub(do_template_with_depth, s)
+def includes(document):
+    """Returns the set of slugs a parsed Document includes"""
+    return set(node.slug for node in document.nodes
+               if isinstance(node, markdown.Include))
+
+
+def rewrite(s, target):
+    """Points includes at new slugs. target is called with the slug of every
+    include and returns its new slug, or None to leave it alone."""
+    def rewrite_include(match):  # pylint: disable=missing-docstring
+        slug = match.groups()[0]
+        if slug.startswith("attachment:"):
+            return match.group(0)
+        new_slug = target(slug)
+        if new_slug is None:
+            return match.group(0)
+        return "{{%s}}" % (new_slug,)
+
+    rendered = set(match.start() for match in markdown.rendered_matches(
+        s, DIRECTIVE_SYNTAX, '{{%s}}'))
+    return DIRECTIVE_SYNTAX.sub(
+        lambda match: rewrite_include(match) if match.start() in rendered
+        else match.group(0), s)
+
@@ -1,31 +1,44 @@
-"""Implementation of wiki links in SpaceWiki's wikitext"""
+"""Finding and rewriting wiki links in SpaceWiki's wikitext. They are
+rendered by the markdown parser, in markdown.py, which leaves [[links]] in
+code alone, and so do these."""
 import re
-import flask
 
 from spacewiki import model
+from . import markdown
+
+# One link at a time, never spanning from one link into the next
+SINGLE_LINK_SYNTAX = re.compile(r'\[\[([^\]|]+?)(?:\|([^\]]+?))?\]\]')
+
+
+def parse(text):
+    """Returns the set of slugs text links to"""
+    return in_document(markdown.parse(text))
+
+
+def in_document(document):
+    """Returns the set of slugs a parsed Document links to"""
+    slugs = set(node.slug for node in document.nodes
+                if isinstance(node, markdown.Link))
+    slugs.discard('')
+    return slugs
+
+
+def rewrite(text, target):
+    """Points links at new slugs. target is called with the slug of every
+    link and returns its new slug, or None to leave the link alone. Links
+    keep the text they were shown with."""
+    def rewrite_link(match):  # pylint: disable=missing-docstring
+        link, title = match.groups()
+        if title is None:
+            title = link
+        slug = target(model.SlugField.slugify(link))
+        if slug is None:
+            return match.group(0)
+        return "[[%s|%s]]" % (slug, title)
+
+    rendered = set(match.start() for match in markdown.rendered_matches(
+        text, SINGLE_LINK_SYNTAX, '[[%s]]'))
+    return SINGLE_LINK_SYNTAX.sub(
+        lambda match: rewrite_link(match) if match.start() in rendered
+        else match.group(0), text)
 
-LINK_SYNTAX = re.compile(r'\[\[(.+?)\]\]')
-TITLED_LINK_SYNTAX = re.compile(r'\[\[(.+?)\|(.+?)\]\]')
-
-
-def make_wikilink(match):
-    """Regex callback to process a wikilink into markdown"""
-    groups = match.groups()
-    if len(groups) == 1:
-        title = groups[0]
-        link = groups[0]
-    else:
-        title = groups[1]
-        link = groups[0]
-    link = model.SlugField.slugify(link)
-    if model.Page.select().where(model.Page.slug == link).exists():
-        return "[%s](%s)" % (title, flask.url_for('pages.view', slug=link))
-    else:
-        return "[%s<sup>?</sup>](%s)" % (title, flask.url_for('pages.view', slug=link))
-
-
-def render(text):
-    """Parses text for wikitext links and renders them as markdown"""
-    text = TITLED_LINK_SYNTAX.sub(make_wikilink, text)
-    text = LINK_SYNTAX.sub(make_wikilink, text)
-    return text
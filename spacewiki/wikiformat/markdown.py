@@ -1,10 +1,231 @@
-"""Markdown portion of wikitext implementation"""
+"""Markdown portion of wikitext implementation
 
+[[Links]] and {{directives}} are rules of the markdown lexers, so a page is
+tokenized once and links inside code are left alone. Rendering happens in two
+steps:
+
+* parse() turns wikitext into a Document: runs of finished HTML with a node
+  between each, for every link, include and attachment. Parsing looks
+  nothing up, so the Document of a revision never goes stale and can be
+  kept for as long as there is room.
+* emit() resolves the nodes of a Document through a resolver and joins the
+  result into HTML. This is all that has to be redone when a page that a
+  revision links to or includes changes."""
+
+import flask
 import mistune
 import re
 
+from spacewiki import model, uploads
+
+# Includes nested deeper than this are shown as a link instead
+MAX_INCLUDE_DEPTH = 10
+
+EDIT_TEMPLATE = '<a class="template-edit" href="%s">Edit Template</a>'
+
+# Stands in for a node in the HTML being parsed
+NODE = re.compile(u'\x00(\\d+)\x00')
+
+# What a revision is parsed as: a page of its own, or a template included on
+# a line of its own or within a line
+PAGE, BLOCK, INLINE = 'page', 'block', 'inline'
+
+_HTML = mistune.Renderer()
+
+
+class Link(object):
+    """The end of a link's text, where it is marked if the page it links to
+    doesn't exist yet"""
+    __slots__ = ('slug',)
+
+    def __init__(self, slug):
+        self.slug = slug
+
+    def expand(self, out, context, depth):  # pylint: disable=unused-argument
+        """Leaves the link to be resolved along with every other link"""
+        out.append(self)
+
+
+class Include(object):
+    """A {{directive}} including the latest revision of another page"""
+    __slots__ = ('slug', 'block')
+
+    def __init__(self, slug, block):
+        self.slug = slug
+        self.block = block
+
+    def expand(self, out, context, depth):
+        """Expands to the included page one level deeper"""
+        if depth > MAX_INCLUDE_DEPTH:
+            return _too_deep(self.slug, self.block, out, context, depth)
+        revision = context.resolver.latest_revision(self.slug)
+        if revision is None:
+            return _expand_text('\\{\\{[[%s]]\\}\\}' % (self.slug,),
+                                self.block, out, context, depth)
+        document = context.parsed(revision, BLOCK if self.block else INLINE)
+        _expand(document, out, context.including(self.slug), depth + 1)
+
+
+class Attachment(object):
+    """A {{directive}} showing a thumbnail of a file attached to the page
+    being rendered"""
+    __slots__ = ('slug', 'size', 'block')
+
+    def __init__(self, slug, size, block):
+        self.slug = slug
+        self.size = size
+        self.block = block
+
+    def expand(self, out, context, depth):
+        """Leaves the attachment to be looked up along with every other
+        attachment"""
+        if depth > MAX_INCLUDE_DEPTH:
+            slug = 'attachment:' + self.slug
+            if self.size is not None:
+                slug += ':' + self.size
+            return _too_deep(slug, self.block, out, context, depth)
+        out.append(self)
+
+    def html(self, page_slug, size):
+        """Returns the thumbnail linking to the full file, given the size of
+        the attachment if the page has it, or nothing if it doesn't"""
+        if size is None:
+            # FIXME: Return markup that indicates this attachment doesn't exist
+            return ''
+        width, height = size
+        full_url = flask.url_for('uploads.get_attachment', slug=page_slug,
+                                 fileslug=self.slug)
+        if self.size is None:
+            img_url = full_url
+        else:
+            img_url = flask.url_for('uploads.get_attachment', slug=page_slug,
+                                    fileslug=self.slug, size=self.size)
+            try:
+                max_size = int(self.size)
+            except ValueError:
+                max_size = 0
+            if width is not None and max_size > 0:
+                width, height = uploads.thumbnail_size(width, height,
+                                                       max_size)
+            else:
+                width = None
+        img = '<img src="%s" alt="%s"' % (mistune.escape_link(img_url),
+                                          mistune.escape(self.slug, True))
+        if width is not None:
+            img += ' width="%d" height="%d"' % (width, height)
+        html = _HTML.link(full_url, None, img + '>')
+        if self.block:
+            html = _HTML.paragraph(html)
+        return html.encode('utf-8')
+
+
+class EditLink(object):
+    """The link to edit a template, in front of its included text"""
+    __slots__ = ()
+
+    def expand(self, out, context, depth):  # pylint: disable=unused-argument
+        """Expands to a link to the template being included"""
+        out.append((EDIT_TEMPLATE % (context.template,)).encode('utf-8'))
+
+
+class Document(object):
+    """Parsed wikitext: a node between every two chunks of HTML. Chunks are
+    kept encoded as UTF-8, taking a quarter of the memory of unicode."""
+    __slots__ = ('chunks', 'nodes')
+
+    def __init__(self, chunks, nodes):
+        self.chunks = chunks
+        self.nodes = nodes
+
+
+class Context(object):
+    """What nodes are expanded with: the page being rendered, the template
+    being included if any, the resolver, and a function returning the
+    Document of a revision parsed in a mode"""
+    __slots__ = ('slug', 'template', 'resolver', 'parsed')
+
+    def __init__(self, slug, template, resolver, parsed):
+        self.slug = slug
+        self.template = template
+        self.resolver = resolver
+        self.parsed = parsed
+
+    def including(self, template):
+        """Returns the context for expanding the template at the slug
+        template"""
+        return Context(self.slug, template, self.resolver, self.parsed)
+
+
+class WikiBlockGrammar(mistune.BlockGrammar):
+    """Block grammar, plus includes standing alone in a block"""
+    directive = re.compile(
+        r'^ *\{\{((?:[^}\n]|\}(?!\}))+?)\}\} *(?:\n{2,}|\n*$)')
+
+
+class WikiBlockLexer(mistune.BlockLexer):
+    """Block lexer that understands {{directives}}"""
+    grammar_class = WikiBlockGrammar
+
+    default_rules = list(mistune.BlockLexer.default_rules)
+    default_rules.insert(default_rules.index('paragraph'), 'directive')
+
+    def parse_directive(self, match):  # pylint: disable=missing-docstring
+        self.tokens.append({'type': 'directive', 'text': match.group(1)})
+
+
+class WikiInlineGrammar(mistune.InlineGrammar):
+    """Inline grammar, plus [[links]] and {{directives}}"""
+    wikilink = re.compile(r'^\[\[([^\]|]+?)(?:\|([^\]]+?))?\]\]')
+    directive = re.compile(r'^\{\{(.+?)\}\}')
+    # Stops at { too, so directives get a chance to match
+    text = re.compile(r'^[\s\S]+?(?=[\\<!\[_*`~{]|https?://| {2,}\n|$)')
+
+
+class WikiInlineLexer(mistune.InlineLexer):
+    """Inline lexer that turns [[links]] and {{directives}} into nodes"""
+    grammar_class = WikiInlineGrammar
+
+    default_rules = list(mistune.InlineLexer.default_rules)
+    default_rules.insert(default_rules.index('escape') + 1, 'directive')
+    default_rules.insert(default_rules.index('escape') + 1, 'wikilink')
+
+    def __init__(self, renderer, nodes, **kwargs):
+        super(WikiInlineLexer, self).__init__(renderer, **kwargs)
+        self.nodes = nodes
+
+    def node(self, node):
+        """Returns the placeholder for a node in the HTML"""
+        self.nodes.append(node)
+        return u'\x00%d\x00' % (len(self.nodes) - 1,)
+
+    def directive(self, slug, block):
+        """Returns the placeholder for a directive"""
+        if slug.startswith('attachment:'):
+            tokens = slug.split(':', 2)
+            size = tokens[2] if len(tokens) == 3 else None
+            return self.node(Attachment(tokens[1], size, block))
+        return self.node(Include(slug, block))
+
+    def output_wikilink(self, match):  # pylint: disable=missing-docstring
+        link = model.SlugField.slugify(match.group(1))
+        self._in_link = True
+        text = self.output(match.group(2) or match.group(1))
+        self._in_link = False
+        return self.renderer.link(flask.url_for('pages.view', slug=link),
+                                  None, text + self.node(Link(link)))
+
+    def output_directive(self, match):  # pylint: disable=missing-docstring
+        return self.directive(match.group(1), False)
+
+
 class WikiRenderer(mistune.Renderer):
     """Specialization of markdown renderer that handles wiki format additions"""
+
+    def __init__(self, **kwargs):
+        super(WikiRenderer, self).__init__(**kwargs)
+        # The WikiMarkdown this renders for
+        self.wiki = None
+
     def block_html(self, html):
         tokens = html.split('\n', 1)
         if len(tokens) == 2:
@@ -13,8 +234,7 @@ class WikiRenderer(mistune.Renderer):
             first_line = html
             rest = ""
         tags = re.match('^<(.+?)>(.*)', html)
-        renderer = WikiRenderer()
-        parser = mistune.Markdown(renderer=renderer)
+        parser = WikiMarkdown(self.wiki.inline.nodes)
         if tags:
             tag, tag_tail = tags.groups()
             rest = tag_tail + rest
@@ -25,8 +245,124 @@ class WikiRenderer(mistune.Renderer):
         return ret
 
 
-def render(text):
-    """Renders a string of markdown text as HTML"""
-    renderer = WikiRenderer()
-    parser = mistune.Markdown(renderer=renderer)
-    return parser.render(text)
+class WikiMarkdown(mistune.Markdown):
+    """Markdown parser for wikitext, adding the nodes it finds to nodes"""
+
+    def __init__(self, nodes):
+        renderer = WikiRenderer()
+        super(WikiMarkdown, self).__init__(
+            renderer=renderer, inline=WikiInlineLexer(renderer, nodes),
+            block=WikiBlockLexer(WikiBlockGrammar()))
+        renderer.wiki = self
+
+    def output_directive(self):  # pylint: disable=missing-docstring
+        return self.inline.directive(self.token['text'], True)
+
+
+def _document(html, nodes):
+    parts = NODE.split(html)
+    return Document(tuple(part.encode('utf-8') for part in parts[::2]),
+                    tuple(nodes[int(index)] for index in parts[1::2]))
+
+
+def parse(text, mode=PAGE):
+    """Parses a string of wikitext into a Document. Templates are parsed with
+    a link to edit them in front, as they have always been shown."""
+    if not flask.has_request_context():
+        # Links become URLs as they are parsed, which takes a request, and
+        # imports and migrations parse pages from outside of one
+        with flask.current_app.test_request_context('/'):
+            return parse(text, mode)
+    nodes = []
+    # NUL can't appear in HTML anyway, and would be taken for a node
+    text = text.replace(u'\x00', u'')
+    if mode != PAGE:
+        nodes.append(EditLink())
+        text = u'\x000\x00' + text
+    if mode == INLINE:
+        html = WikiInlineLexer(WikiRenderer(), nodes).output(
+            mistune.preprocessing(text))
+    else:
+        html = WikiMarkdown(nodes).render(text)
+    return _document(html, nodes)
+
+
+def rendered_matches(text, pattern, template):
+    """Returns the matches of pattern in text that the lexer takes for a link
+    or directive, rather than leaving alone as code. Each match is swapped
+    for template filled in with a numbered stand-in, and the stand-ins that
+    come out of parsing as nodes are the ones rendered."""
+    matches = list(pattern.finditer(text))
+    if not matches:
+        return []
+    numbers = iter(xrange(len(matches)))
+    probe = pattern.sub(
+        lambda match: template % ('spacewikiprobe%d' % (next(numbers),)),
+        text)
+    found = set(node.slug for node in parse(probe).nodes
+                if isinstance(node, (Link, Include)))
+    return [match for number, match in enumerate(matches)
+            if 'spacewikiprobe%d' % (number,) in found]
+
+
+def _expand(document, out, context, depth):
+    chunks = document.chunks
+    for index, node in enumerate(document.nodes):
+        out.append(chunks[index])
+        node.expand(out, context, depth)
+    out.append(chunks[-1])
+
+
+def _expand_text(text, block, out, context, depth):
+    """Expands a line of wikitext made up while expanding, as a paragraph if
+    block is set"""
+    nodes = []
+    html = WikiInlineLexer(WikiRenderer(), nodes).output(text)
+    if block:
+        html = _HTML.paragraph(html)
+    _expand(_document(html, nodes), out, context, depth)
+
+
+def _too_deep(slug, block, out, context, depth):
+    _expand_text(
+        '\\{\\{Max include depth of %s reached before [[%s]]\\}\\}' % (
+            depth, slug), block, out, context, depth)
+
+
+def emit(document, slug, resolver, parsed=None):
+    """Renders a Document from the page at slug as unsanitized HTML, looking
+    up link, include and attachment targets through resolver, with every
+    link and every attachment looked up at once. parsed is called with each
+    included revision and the mode to parse it in, and returns its Document;
+    by default it is parsed afresh."""
+    if parsed is None:
+        parsed = lambda revision, mode: parse(revision.body, mode)
+    out = []
+    _expand(document, out, Context(slug, None, resolver, parsed), 0)
+    links = set()
+    files = set()
+    for piece in out:
+        if isinstance(piece, Link):
+            links.add(piece.slug)
+        elif isinstance(piece, Attachment):
+            files.add(piece.slug)
+    existing = resolver.pages_exist(links)
+    sizes = resolver.attachments(slug, files)
+
+    def resolve(piece):  # pylint: disable=missing-docstring
+        if isinstance(piece, Link):
+            if piece.slug in existing:
+                return ''
+            return '<sup>?</sup>'
+        if isinstance(piece, Attachment):
+            return piece.html(slug, sizes.get(piece.slug))
+        return piece
+
+    return ''.join([resolve(piece) for piece in out]).decode('utf-8')
+
+
+def render(text, slug, resolver):
+    """Renders a string of wikitext from the page at slug as unsanitized
+    HTML, looking up link and include targets through resolver. Links to
+    pages that don't exist yet are marked."""
+    return emit(parse(text), slug, resolver)
@@ -0,0 +1,53 @@
+"""Lookups performed while rendering wikitext"""
+
+from spacewiki import model
+
+
+class Resolver(object):
+    """Resolves link, include and attachment targets for a render, and
+    remembers every slug the rendered output depended on"""
+
+    def __init__(self):
+        self.dependencies = set()
+        # Set when the render gave up and shouldn't be cached
+        self.partial = False
+
+    def page_exists(self, slug):
+        """Returns True if a page exists at slug"""
+        self.dependencies.add(slug)
+        return model.Page.select().where(model.Page.slug == slug).exists()
+
+    def pages_exist(self, slugs):
+        """Returns the subset of slugs that pages exist at"""
+        self.dependencies.update(slugs)
+        slugs = list(slugs)
+        existing = set()
+        # Staying under SQLite's limit of 999 parameters
+        for start in xrange(0, len(slugs), 900):
+            query = model.Page.select(model.Page.slug) \
+                .where(model.Page.slug << slugs[start:start + 900])
+            existing.update(page.slug for page in query)
+        return existing
+
+    def latest_revision(self, slug):
+        """Returns the latest revision of the page at slug, or None"""
+        self.dependencies.add(slug)
+        return model.Page.latestRevision(slug, body=False)
+
+    def attachments(self, page_slug, slugs):
+        """Returns the width and height, each None unless it is an image, of
+        every attachment of the page at page_slug among slugs, by slug"""
+        self.dependencies.update('attachment:' + slug for slug in slugs)
+        slugs = list(slugs)
+        found = {}
+        for start in xrange(0, len(slugs), 900):
+            query = model.Attachment.select(model.Attachment.slug,
+                                            model.Attachment.width,
+                                            model.Attachment.height) \
+                .join(model.Page) \
+                .where(model.Page.slug == page_slug,
+                       model.Attachment.slug << slugs[start:start + 900]) \
+                .tuples()
+            for slug, width, height in query:
+                found[slug] = (width, height)
+        return found
@@ -0,0 +1,24 @@
+define(['jquery'], function($) {
+  // Suggests page titles in the search box as the reader types
+  var timer = null;
+  var latest = 0;
+
+  $('input[data-complete-url]').on('input', function() {
+    var input = $(this);
+    var list = $('#' + input.attr('list'));
+    clearTimeout(timer);
+    timer = setTimeout(function() {
+      var request = ++latest;
+      $.getJSON(input.data('complete-url'), {q: input.val()}, function(data) {
+        if (request != latest) {
+          return;
+        }
+        list.empty();
+        $.each(data.results, function(i, result) {
+          list.append($('<option>').attr('value', result.title)
+                                   .text(result.slug));
+        });
+      });
+    }, 100);
+  });
+});
@@ -8,8 +8,49 @@ define(['jquery', 'js/lib/simplemde',
 
   $(document).foundation();
 
+  // Live preview, rendered by the server a block at a time. Only blocks
+  // that changed come back with HTML; the rest are reused from earlier
+  // responses, and responses that arrive out of order are dropped.
+  var body = document.getElementById("body");
+  var preview = {
+    session: Math.random().toString(36).slice(2) + Date.now().toString(36),
+    seq: 0,
+    applied: -1,
+    blocks: {},
+    timer: null
+  };
+
+  function renderPreview(text, element) {
+    clearTimeout(preview.timer);
+    preview.timer = setTimeout(function() {
+      var seq = ++preview.seq;
+      $.post($(body).data('preview-url'), {
+        session: preview.session,
+        seq: seq,
+        base: preview.applied,
+        body: text,
+        slug: $('#slug').val()
+      }).done(function(patch) {
+        if (patch.superseded || seq < preview.applied) {
+          return;
+        }
+        var blocks = {};
+        var html = $.map(patch.blocks, function(block) {
+          blocks[block.id] = block.html !== undefined ? block.html :
+                                                        preview.blocks[block.id];
+          return blocks[block.id];
+        });
+        preview.blocks = blocks;
+        preview.applied = seq;
+        element.innerHTML = html.join('\n');
+      });
+    }, 250);
+    return element.innerHTML;
+  }
+
   var simplemde = new SimpleMDE({
-    element: document.getElementById("body")
+    element: body,
+    previewRender: renderPreview
   });
 
   $('#title-edit').change(function() {